@@ -2,92 +2,339 @@ import os
 import json
 from datetime import datetime
 import logging
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file
-import pandas as pd
+import logging.handlers
+import threading
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
 from werkzeug.utils import secure_filename
-from transformer import transform_data, save_to_csv, get_unique_customers, validate_file
-import tempfile
+import dataset
+import schema
+from session_store import create_store
+import reaper
+import jobs
+import metrics
+import order_history
+import delivery
 import uuid
-import pickle
-
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("app.log"),
-        logging.StreamHandler()
-    ]
-)
+import time
+
+# pandas and the conversion modules (transformer, readers, streaming, grid) are
+# imported by the views that use them, so importing the app and booting a
+# worker stay fast. preload_modules() loads them up front instead.
+
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # For session management
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 app.config['DOWNLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads')
+app.config['DOWNLOAD_ACCEL_PREFIX'] = os.environ.get('QBO_DOWNLOAD_ACCEL_PREFIX') or None  # Internal nginx location of DOWNLOAD_FOLDER, for X-Accel-Redirect
+app.config['USE_X_SENDFILE'] = os.environ.get('QBO_USE_X_SENDFILE', '0') == '1'  # Let the front server send stored downloads
 app.config['ALLOWED_EXTENSIONS'] = {'xlsx', 'xls', 'csv'}
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('QBO_MAX_UPLOAD_MB', 512)) * 1024 * 1024  # Large CSVs are streamed
+app.config['MAX_EXCEL_SIZE'] = 16 * 1024 * 1024  # Excel files are always loaded whole
+app.config['STREAMING_THRESHOLD'] = 16 * 1024 * 1024  # CSVs above this size are processed in chunks
 app.config['SESSION_DATA_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'session_data')
+app.config['SESSION_BACKEND'] = os.environ.get('QBO_SESSION_BACKEND', 'feather')  # 'feather' or 'sqlite'
+app.config['SESSION_DB_PATH'] = os.path.join(app.config['SESSION_DATA_FOLDER'], 'sessions.sqlite3')
+app.config['DATASET_CACHE_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataset_cache')
+app.config['DATASET_CACHE_ENTRIES'] = 8  # Parsed uploads kept in memory per worker
+app.config['COLUMN_MAPPINGS_FILE'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'column_mappings.json')
+app.config['CUSTOMER_ALIASES_DB'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'customer_aliases.sqlite3')  # Kept across sessions
+app.config['INVOICE_LEDGER_DB'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'invoice_ledger.sqlite3')  # Invoice numbers issued so far
+app.config['ORDER_HISTORY_DB'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'order_history.sqlite3')  # Order IDs exported so far
+app.config['ACCESS_DB_PATH'] = os.path.join(app.config['SESSION_DATA_FOLDER'], 'access.sqlite3')
+app.config['REAPER_MAX_AGE'] = reaper.MAX_AGE_SECONDS  # Sessions and files unused this long are removed
+app.config['REAPER_MAX_BYTES'] = reaper.MAX_BYTES  # Oldest data is removed while the total is above this
+app.config['REAPER_INTERVAL'] = reaper.INTERVAL_SECONDS  # Seconds between background sweeps, 0 to disable
+app.config['SESSION_TOUCH_INTERVAL'] = 60  # Minimum seconds between access-time updates for a session
+app.config['JOBS_FOLDER'] = os.path.join(app.config['SESSION_DATA_FOLDER'], 'jobs')
+app.config['JOB_WORKERS'] = jobs.MAX_WORKERS  # Conversion worker processes, 0 to convert inside the request
+app.config['METRICS_FOLDER'] = os.path.join(app.config['SESSION_DATA_FOLDER'], 'metrics')  # Stage timings of every process
+app.config['LOG_FILE'] = os.environ.get('QBO_LOG_FILE', 'app.log')  # Empty to log to the console only
+app.config['LOG_LEVEL'] = os.environ.get('QBO_LOG_LEVEL', 'INFO').upper()
+app.config['LOG_FORMAT'] = os.environ.get('QBO_LOG_FORMAT', 'text')  # 'text' or 'json' (one object per line)
+app.config['LOG_MAX_BYTES'] = int(os.environ.get('QBO_LOG_MAX_MB', 10)) * 1024 * 1024  # app.log is rotated at this size
+app.config['LOG_BACKUPS'] = int(os.environ.get('QBO_LOG_BACKUPS', 5))  # Rotated logs kept
+
+# Share parsed uploads between requests and gunicorn workers
+dataset.configure(cache_dir=app.config['DATASET_CACHE_FOLDER'],
+                  max_entries=app.config['DATASET_CACHE_ENTRIES'],
+                  on_spill=lambda path: access_tracker and access_tracker.track_file(path, 'dataset'))
+schema.configure(mappings_file=app.config['COLUMN_MAPPINGS_FILE'])
+jobs.configure(jobs_dir=app.config['JOBS_FOLDER'], max_workers=app.config['JOB_WORKERS'])
+metrics.configure(metrics_dir=app.config['METRICS_FOLDER'])
+order_history.configure(db_path=app.config['ORDER_HISTORY_DB'])
+
+# Large session data is kept out of the cookie, in the configured store
+session_store_config = (
+    app.config['SESSION_BACKEND'],
+    app.config['SESSION_DB_PATH'] if app.config['SESSION_BACKEND'] == 'sqlite' else app.config['SESSION_DATA_FOLDER']
+)
+
+# Created by init_app(), in the process that serves requests
+session_store = None
+access_tracker = None
+alias_store = None
+_init_lock = threading.Lock()
+_initialized = False
+
+class JsonFormatter(logging.Formatter):
+    """Format each record as one JSON object, for log collectors"""
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def configure_logging():
+    """
+    Log to the console and to a rotating app.log, at LOG_LEVEL (INFO by default)
+    
+    Messages are formatted only when their level is enabled, so DEBUG
+    diagnostics cost nothing in production. Skipped if logging was already
+    set up, e.g. by gunicorn.
+    """
+    handlers = [logging.StreamHandler()]
+    if app.config['LOG_FILE']:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            app.config['LOG_FILE'], maxBytes=app.config['LOG_MAX_BYTES'],
+            backupCount=app.config['LOG_BACKUPS'], encoding='utf-8'
+        ))
+    if app.config['LOG_FORMAT'] == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(process)d] %(message)s')
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    logging.basicConfig(level=app.config['LOG_LEVEL'], handlers=handlers)
+
+def init_app():
+    """
+    Prepare this process to serve requests: logging, folders, the session
+    store, the access index and the background reaper
+
+    Runs once per process, on the first request, so importing the app has no
+    side effects and a preloading gunicorn master opens no files or threads
+    its workers would inherit.
+    """
+    global session_store, access_tracker, _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        configure_logging()
+        
+        # Create necessary directories
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        os.makedirs(app.config['DOWNLOAD_FOLDER'], exist_ok=True)
+        os.makedirs(app.config['SESSION_DATA_FOLDER'], exist_ok=True)
+        
+        # Last-use times of sessions and files, so expired ones can be removed
+        access_tracker = reaper.AccessTracker(app.config['ACCESS_DB_PATH'])
+        session_store = create_store(*session_store_config)
+        
+        if app.config['REAPER_INTERVAL'] > 0:
+            reaper.start_background_reaper(access_tracker, session_store.delete_session,
+                                           interval=app.config['REAPER_INTERVAL'],
+                                           max_age=app.config['REAPER_MAX_AGE'],
+                                           max_bytes=app.config['REAPER_MAX_BYTES'])
+        _initialized = True
 
-# Create necessary directories
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['DOWNLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['SESSION_DATA_FOLDER'], exist_ok=True)
+def preload_modules():
+    """Import pandas and the conversion modules now rather than on first use (see gunicorn.conf.py)"""
+    import transformer, readers, streaming, grid, batch, customer_match  # noqa: F401
+
+def get_session_id():
+    if 'session_id' not in session:
+        session['session_id'] = str(uuid.uuid4())
+    return session['session_id']
 
 # Helper functions for storing large session data in files
 def save_session_data(key, data):
+    import pandas as pd
+    session_id = get_session_id()
+    if isinstance(data, pd.DataFrame):
+        session_store.save_frame(session_id, key, data)
+    else:
+        session_store.save_value(session_id, key, data)
+    access_tracker.touch_session(session_id, size=session_store.session_size(session_id))
+    session['last_touch'] = time.time()
+
+def track_file(path, kind):
+    """Register an upload or download of this session for expiry"""
+    try:
+        access_tracker.track_file(path, kind, session_id=get_session_id())
+    except Exception as e:
+        logger.error("Error tracking %s %s: %s", kind, path, e)
+
+def load_session_data(key, default=None):
     if 'session_id' not in session:
-        session['session_id'] = str(uuid.uuid4())
+        return default
     
-    session_id = session['session_id']
-    session_dir = os.path.join(app.config['SESSION_DATA_FOLDER'], session_id)
-    os.makedirs(session_dir, exist_ok=True)
+    try:
+        return session_store.load_value(session['session_id'], key, default)
+    except Exception as e:
+        logger.error("Error loading session data for %s: %s", key, e)
+        return default
+
+def load_session_frame(key, columns=None, start=None, stop=None, rows=None):
+    """Load a stored frame, optionally only some columns and a [start, stop) range or list of rows"""
+    if 'session_id' not in session:
+        return None
+    
+    try:
+        return session_store.load_frame(session['session_id'], key, columns=columns,
+                                        start=start, stop=stop, rows=rows)
+    except Exception as e:
+        logger.error("Error loading session data for %s: %s", key, e)
+        return None
+
+def grid_page(key, columns, edits=()):
+    """
+    One page of a stored frame for a Tabulator grid with remote pagination
+
+    Args:
+        key (str): Stored frame to page through
+        columns (list): Columns of the stored frame
+        edits (list): {row, field, value} edits to lay over the stored values
+
+    Returns:
+        dict: last_page and the page's records (see grid.page_records)
+    """
+    from grid import parse_grid_params, query_rows, page_count, page_records, apply_edits
+    
+    params = parse_grid_params(request.args)
+    size = params['size']
+    start = (params['page'] - 1) * size
+    query_columns = list(dict.fromkeys(
+        item['field'] for item in params['sorters'] + params['filters'] if item.get('field') in columns
+    ))
     
-    file_path = os.path.join(session_dir, f"{key}.pickle")
-    with open(file_path, 'wb') as f:
-        pickle.dump(data, f)
+    if query_columns:
+        # Sort and filter on just the columns involved, then read the page's rows
+        query_df = apply_edits(load_session_frame(key, columns=query_columns), edits)
+        rows = query_rows(query_df, params['sorters'], params['filters'])
+        total_rows = len(rows)
+        page_df = load_session_frame(key, rows=rows[start:start + size].tolist())
+    else:
+        total_rows = session_store.frame_length(session['session_id'], key)
+        page_df = load_session_frame(key, start=start, stop=start + size)
+    apply_edits(page_df, edits)
     
-    return file_path
+    return {'last_page': page_count(total_rows, size), 'data': page_records(page_df)}
 
-def load_session_data(key, default=None):
-    if 'session_id' not in session:
-        return default
+# Columns of the stored customer list that the confirm page may change
+CUSTOMER_FIELDS = ['name', 'included']
+# Columns the confirm page shows: proposed names for look-alike spellings and their group
+CUSTOMER_COLUMNS = ['customer'] + CUSTOMER_FIELDS + ['suggestion', 'group']
+
+def customer_aliases():
+    """The names customer spellings were confirmed as in earlier sessions (opened on first use)"""
+    global alias_store
+    if alias_store is None:
+        from customer_match import AliasStore
+        alias_store = AliasStore(app.config['CUSTOMER_ALIASES_DB'])
+    return alias_store
+
+def next_invoice_number():
+    """The first invoice number no earlier conversion used, to suggest on the invoice forms"""
+    from ledger import InvoiceLedger
+    try:
+        return InvoiceLedger(app.config['INVOICE_LEDGER_DB']).next_number()
+    except Exception as e:
+        logger.warning("Could not read the invoice ledger: %s", e)
+        return None
+
+def requested_start_number(form):
+    """The start number typed on an invoice form, or None to take the next free one"""
+    value = form.get('start_invoice_number', '').strip()
+    if not value:
+        return None
+    start_invoice_number = int(value)
+    if start_invoice_number < 1:
+        raise ValueError("The starting invoice number must be 1 or more")
+    return start_invoice_number
+
+def customer_frame(customers):
+    """
+    The customer list kept for the confirm page
     
-    session_id = session['session_id']
-    file_path = os.path.join(app.config['SESSION_DATA_FOLDER'], session_id, f"{key}.pickle")
+    Spellings confirmed in an earlier session get that name filled in, and
+    look-alike spellings of one customer get a common name proposed (see
+    customer_match.group_names).
     
-    if not os.path.exists(file_path):
-        return default
+    Returns:
+        pd.DataFrame: Original name, name to invoice under, whether to invoice,
+        proposed name ('' for none) and look-alike group (-1 for none)
+    """
+    import pandas as pd
+    from customer_match import group_names, normalize_name
     
+    names = [str(c) for c in customers]
     try:
-        with open(file_path, 'rb') as f:
-            return pickle.load(f)
+        aliases = customer_aliases().lookup(normalize_name(name) for name in names)
     except Exception as e:
-        logger.error(f"Error loading session data for {key}: {str(e)}")
-        return default
+        logger.warning("Could not read customer aliases: %s", e)
+        aliases = {}
+    matches = group_names(customers, aliases)
+    names = [aliases.get(key, name) for key, name in zip(matches['key'], names)]
+    suggestions = [suggestion if suggestion != name else '' for suggestion, name in zip(matches['suggestion'], names)]
+    return pd.DataFrame({'customer': customers, 'name': names, 'included': True,
+                         'suggestion': suggestions, 'group': matches['group'].to_numpy()})
+
+def confirmed_names():
+    """Original to confirmed name of every customer to invoice, from the stored customer list"""
+    customers = load_session_frame('customers', columns=['customer'] + CUSTOMER_FIELDS)
+    if customers is None:
+        raise ValueError("No confirmed customers. Please confirm customers first.")
+    included = customers[customers['included'].astype(bool)]
+    return dict(zip(included['customer'].tolist(), included['name'].tolist()))
 
 def clear_session_data():
     if 'session_id' in session:
-        session_id = session['session_id']
-        session_dir = os.path.join(app.config['SESSION_DATA_FOLDER'], session_id)
-        if os.path.exists(session_dir):
-            for file in os.listdir(session_dir):
-                file_path = os.path.join(session_dir, file)
-                try:
-                    if os.path.isfile(file_path):
-                        os.unlink(file_path)
-                except Exception as e:
-                    logger.error(f"Error removing file {file_path}: {str(e)}")
-            try:
-                os.rmdir(session_dir)
-            except Exception as e:
-                logger.error(f"Error removing directory {session_dir}: {str(e)}")
-        session.clear()
+        try:
+            session_store.delete_session(session['session_id'])
+            access_tracker.forget_session(session['session_id'])
+        except Exception as e:
+            logger.error("Error removing session data: %s", e)
+    session.clear()
 
 def allowed_file(filename):
     """Check if the file has an allowed extension"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+@app.before_request
+def ensure_initialized():
+    if not _initialized:
+        init_app()
+
+@app.before_request
+def touch_session():
+    """Keep the current session from expiring while it is in use"""
+    session_id = session.get('session_id')
+    if session_id and time.time() - session.get('last_touch', 0) > app.config['SESSION_TOUCH_INTERVAL']:
+        try:
+            access_tracker.touch_session(session_id)
+            session['last_touch'] = time.time()
+        except Exception as e:
+            logger.error("Error updating session access time: %s", e)
+
+@app.after_request
+def flush_metrics(response):
+    # Share this worker's stage timings with whichever worker serves /metrics
+    metrics.flush()
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Per-stage conversion timings of all workers, in the Prometheus text format"""
+    return app.response_class(metrics.render(metrics.collect()), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     # Clear session data when starting fresh
@@ -97,6 +344,10 @@ def index():
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    from readers import sniff_format
+    from streaming import csv_profile, stream_unique_customers
+    from transformer import get_unique_customers, validate_file
+    
     logger.debug("Upload endpoint called")
     # Check if a file was uploaded
     if 'file' not in request.files:
@@ -117,65 +368,76 @@ def upload_file():
         filename = secure_filename(file.filename)
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(file_path)
-        logger.debug(f"File saved to {file_path}")
+        logger.debug("File saved to %s", file_path)
         
         # Display success message for the file upload
         flash(f'File "{filename}" uploaded successfully!', 'success')
         
         try:
-            # For CSV files with xlsx/xls extension, try to fix the extension
-            if file_path.lower().endswith(('.xlsx', '.xls')):
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        first_line = f.readline()
-                        if ',' in first_line and first_line.count(',') > 3:
-                            logger.debug(f"File appears to be a CSV file with Excel extension. First line: {first_line}")
-                            # Rename to CSV
-                            csv_path = file_path.rsplit('.', 1)[0] + '.csv'
-                            os.rename(file_path, csv_path)
-                            file_path = csv_path
-                            logger.debug(f"Renamed file to {file_path}")
-                            flash(f"Detected CSV file format. Renamed to {os.path.basename(csv_path)}", 'success')
-                except Exception as e:
-                    logger.debug(f"Error checking for CSV: {str(e)}")
-            
-            # Validate the file
-            validate_file(file_path)
-            logger.debug("File validation passed")
+            # Detect the real format from the content: CSV exports are often
+            # saved with an Excel extension
+            file_format = sniff_format(file_path)
+            if file_format is None:
+                raise ValueError("File format not recognized. Please upload an Excel (.xlsx or .xls) or CSV file.")
+            if file_format == 'csv' and not file_path.lower().endswith('.csv'):
+                logger.debug("File appears to be a CSV file with Excel extension")
+                csv_path = file_path.rsplit('.', 1)[0] + '.csv'
+                os.replace(file_path, csv_path)
+                file_path = csv_path
+                logger.debug("Renamed file to %s", file_path)
+                flash(f"Detected CSV file format. Renamed to {os.path.basename(csv_path)}", 'success')
             
-            # Extract unique customers
-            logger.debug(f"Attempting to extract unique customers from {file_path}")
-            try:
-                df = pd.read_excel(file_path)
-                logger.debug(f"Excel file read successfully. Columns: {list(df.columns)}")
-                logger.debug(f"First few rows: {df.head().to_dict()}")
-            except Exception as e:
-                logger.error(f"Error reading Excel file directly: {str(e)}")
-                try:
-                    # Try reading as CSV if Excel reading failed
-                    df = pd.read_csv(file_path)
-                    logger.debug(f"CSV file read successfully. Columns: {list(df.columns)}")
-                except Exception as e2:
-                    logger.error(f"Error reading as CSV: {str(e2)}")
+            track_file(file_path, 'upload')
+            file_size = os.path.getsize(file_path)
+            is_csv = file_format == 'csv'
+            if not is_csv and file_size > app.config['MAX_EXCEL_SIZE']:
+                max_mb = app.config['MAX_EXCEL_SIZE'] // (1024 * 1024)
+                flash(f"Excel files larger than {max_mb}MB cannot be processed. Please export the report as CSV and upload it again.")
+                return redirect(url_for('index'))
+            streaming = is_csv and file_size > app.config['STREAMING_THRESHOLD']
             
-            unique_customers = get_unique_customers(file_path)
+            if streaming:
+                # Large CSVs are never loaded whole: check the header, then
+                # collect customers chunk by chunk
+                logger.debug("Streaming large CSV file (%s bytes)", file_size)
+                if not csv_profile(file_path)['price']:
+                    raise ValueError("No column found for price/amount information. This is required for invoicing.")
+                unique_customers = stream_unique_customers(file_path)
+            else:
+                # Validate the file
+                validate_file(file_path)
+                logger.debug("File validation passed")
+                
+                # Extract unique customers (reuses the frame parsed during validation)
+                logger.debug("Attempting to extract unique customers from %s", file_path)
+                unique_customers = get_unique_customers(file_path)
             
             if not unique_customers:
                 logger.warning("No customers found in the file")
                 flash("Warning: No customers were found in the file. Please check the file format and try again.", "warning")
                 return redirect(url_for('index'))
                 
-            logger.debug(f"Extracted {len(unique_customers)} unique customers: {unique_customers}")
+            logger.debug("Extracted %d unique customers", len(unique_customers))
             
             # Store file path and customers in session
             session['file_path'] = file_path
-            session['unique_customers'] = unique_customers
+            session['streaming'] = streaming
+            # The customer list can run to thousands of names, too many for the
+            # session cookie; the confirm page pages through the stored copy
+            customers = customer_frame(unique_customers)
+            save_session_data('customers', customers)
+            session.pop('customers_confirmed', None)
             
             flash(f"Found {len(unique_customers)} customers in the file. Proceed to confirm them.", 'success')
+            known = int((customers['name'] != customers['customer'].astype(str)).sum())
+            proposed = int((customers['suggestion'] != '').sum())
+            if known or proposed:
+                flash(f"{known} names were filled in from earlier confirmations and {proposed} look like "
+                      f"other spellings of a customer; check the Suggested Name column.", 'info')
             return redirect(url_for('confirm_customers'))
         except Exception as e:
             error_message = str(e)
-            logger.error(f"Error processing file: {error_message}")
+            logger.error("Error processing file: %s", error_message)
             
             # Provide more user-friendly error messages
             if "expected <class 'openpyxl.styles.fills.Fill'>" in error_message:
@@ -188,153 +450,353 @@ def upload_file():
             return redirect(url_for('index'))
     else:
         flash('File type not allowed. Please upload an Excel file (.xlsx or .xls)')
-        logger.error(f"Invalid file type: {file.filename}")
+        logger.error("Invalid file type: %s", file.filename)
         return redirect(url_for('index'))
 
 @app.route('/confirm_customers', methods=['GET', 'POST'])
 def confirm_customers():
+    from grid import parse_edits, apply_edits
+    
     logger.debug("Confirm customers endpoint called")
+    num_customers = session_store.frame_length(session['session_id'], 'customers') if 'session_id' in session else None
+    if not num_customers:
+        flash('No customers found. Please upload a file first.')
+        logger.error("No customers in session")
+        return redirect(url_for('index'))
+    
     if request.method == 'GET':
-        if 'unique_customers' not in session:
-            flash('No customers found. Please upload a file first.')
-            logger.error("No customers in session")
-            return redirect(url_for('index'))
-            
-        return render_template('confirm_customers.html', customers=session['unique_customers'])
+        # The grid fetches the customers page by page; coming back from a later
+        # step shows the names and choices made before
+        return render_template('confirm_customers.html', num_customers=num_customers)
     else:
-        # Process form submission
-        confirmed_customers = {}
-        for i, original_customer in enumerate(session['unique_customers']):
-            input_name = f'customer_{i}'
-            checkbox_name = f'confirm_{i}'
-            
-            if input_name in request.form and checkbox_name in request.form:
-                confirmed_customers[original_customer] = request.form[input_name]
-                
+        # Only the renamed, excluded and included again customers are posted
+        try:
+            edits = parse_edits(json.loads(request.form.get('edits') or '[]'), CUSTOMER_FIELDS, num_customers)
+        except ValueError as e:
+            flash(f'Error confirming customers: {str(e)}')
+            return redirect(url_for('confirm_customers'))
+        for edit in edits:
+            if edit['field'] == 'included':
+                edit['value'] = edit['value'] in (True, 1, 'true', 'on')
+        
+        customers = load_session_frame('customers')
+        apply_edits(customers, edits)
+        customers['included'] = customers['included'].astype(bool)
+        
+        if request.form.get('action') == 'apply_suggestions':
+            # Give every look-alike spelling its proposed name, then show the list again
+            proposed = customers['suggestion'] != ''
+            customers.loc[proposed, 'name'] = customers.loc[proposed, 'suggestion']
+            customers.loc[proposed, 'suggestion'] = ''
+            save_session_data('customers', customers)
+            flash(f"Used the suggested name for {int(proposed.sum())} customers.", 'success')
+            return redirect(url_for('confirm_customers'))
+        
         # Check if any customers are confirmed
-        if not confirmed_customers:
+        if not customers['included'].any():
             flash('Please confirm at least one customer')
             logger.error("No customers confirmed")
             return redirect(url_for('confirm_customers'))
-            
-        # Store confirmed customers in session
-        session['confirmed_customers'] = confirmed_customers
-        logger.debug(f"Confirmed {len(confirmed_customers)} customers")
+        
+        save_session_data('customers', customers)
+        session['customers_confirmed'] = True
+        logger.debug("Confirmed %s customers (%s changes)", int(customers['included'].sum()), len(edits))
+        
+        # Fill the same names in on later uploads
+        included = customers[customers['included']]
+        try:
+            customer_aliases().remember(included['customer'].tolist(), included['name'].tolist())
+        except Exception as e:
+            logger.warning("Could not save customer aliases: %s", e)
         
         return redirect(url_for('invoice_details'))
 
+@app.route('/customers/data')
+def customers_data():
+    """One page of the uploaded file's customers, sorted and filtered, for the confirm grid"""
+    if 'session_id' not in session or not session_store.frame_length(session['session_id'], 'customers'):
+        return jsonify({'error': 'No customers found. Please upload a file first.'}), 404
+    try:
+        return jsonify(grid_page('customers', CUSTOMER_COLUMNS))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/invoice_details', methods=['GET', 'POST'])
 def invoice_details():
     logger.debug("Invoice details endpoint called")
     if request.method == 'GET':
-        if 'confirmed_customers' not in session:
+        if not session.get('customers_confirmed'):
             flash('No confirmed customers. Please confirm customers first.')
             logger.error("No confirmed customers in session")
             return redirect(url_for('confirm_customers'))
         
-        # Pass the current date to the template
+        # Pass the current date to the template, and the conversion job to wait for if one was started
         current_date = datetime.now()
-        return render_template('invoice_details.html', now=current_date)
+        return render_template('invoice_details.html', now=current_date, job_id=request.args.get('job'),
+                               next_number=next_invoice_number())
     else:
         # Process form submission
         try:
-            start_invoice_number = int(request.form['start_invoice_number'])
+            # Left empty, the job takes the next free numbers from the ledger
+            start_invoice_number = requested_start_number(request.form)
             invoice_date_str = request.form['invoice_date']
             invoice_date = datetime.strptime(invoice_date_str, '%Y-%m-%d')
-            logger.debug(f"Invoice details: start={start_invoice_number}, date={invoice_date}")
+            logger.debug("Invoice details: start=%s, date=%s", start_invoice_number, invoice_date)
             
             # Store invoice details in session
             session['start_invoice_number'] = start_invoice_number
             session['invoice_date'] = invoice_date_str
             
-            # Transform the data
-            file_path = session['file_path']
-            transformed_df = transform_data(file_path, start_invoice_number, invoice_date)
-            logger.debug(f"Data transformed: {transformed_df.shape[0]} rows")
-            
-            # Replace customer names with confirmed names if any
-            if 'confirmed_customers' in session:
-                name_mapping = session['confirmed_customers']
-                transformed_df['*Customer'] = transformed_df['*Customer'].map(
-                    lambda x: name_mapping.get(x, x) if x else ''
-                )
-            
-            # Save transformed data to file instead of session cookie
-            save_session_data('transformed_df', transformed_df)
-            
-            return redirect(url_for('review'))
+            return redirect(url_for('invoice_details', job=submit_conversion(start_invoice_number, invoice_date)))
         except Exception as e:
             flash(f'Error processing invoice details: {str(e)}')
-            logger.error(f"Error processing invoice details: {str(e)}")
+            logger.error("Error processing invoice details: %s", e)
             return redirect(url_for('invoice_details'))
 
+def submit_conversion(start_invoice_number, invoice_date, skip_billed=False):
+    """
+    Convert the session's upload in a worker process; the invoice details page polls the job
+    
+    Large CSVs are converted straight to the download file; they are too big
+    to review in the browser.
+    
+    Returns:
+        str: Job id
+    """
+    session_id = get_session_id()
+    job_id = jobs.submit(
+        jobs.transform_job, session_store_config, session_id, session['file_path'],
+        start_invoice_number, invoice_date, confirmed_names(),
+        bool(session.get('streaming')), app.config['DOWNLOAD_FOLDER'],
+        app.config['INVOICE_LEDGER_DB'], skip_billed, session_id=session_id
+    )
+    track_file(jobs.status_path(job_id), 'job')
+    session['job_id'] = job_id
+    logger.debug("Started conversion job %s", job_id)
+    return job_id
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Progress of a conversion job, and where to go once it has finished"""
+    status = jobs.read_status(job_id)
+    if status is None or status.get('session_id') != session.get('session_id'):
+        return jsonify({'error': 'Unknown job'}), 404
+    
+    response = {key: status.get(key) for key in ('state', 'message', 'error')}
+    response['elapsed'] = round(status['updated'] - status['created'], 1)
+    if status['state'] == 'done':
+        result = status['result']
+        if result.get('start') is not None:
+            session['start_invoice_number'] = result['start']
+        if result.get('download_path'):
+            session['download_path'] = result['download_path']
+            session['download_filename'] = result['download_filename']
+            track_file(result['download_path'], 'download')
+            if session.pop('job_id', None) == job_id:
+                flash(result.get('message') or f"Large file converted directly: {result['invoices']} invoices, {result['lines']} lines. The review step was skipped.", 'success')
+                if result.get('billed'):
+                    flash(f"{result['billed']} lines bill orders that were already exported.", 'warning')
+            response['redirect'] = url_for('download')
+        else:
+            if session.get('job_id') == job_id and result.get('billed'):
+                flash(f"{result['billed']} lines bill orders that were already exported; they are highlighted below. "
+                      "Use \"Drop Already Billed Lines\" unless they should be billed again.", 'warning')
+            if session.pop('job_id', None) == job_id and 'renamed' in result:
+                flash(f"Only customer names changed: renamed {result['renamed']} invoices and kept your review edits.", 'success')
+            access_tracker.touch_session(session['session_id'], size=session_store.session_size(session['session_id']))
+            response['redirect'] = url_for('review')
+    return jsonify(response)
+
+@app.route('/batch', methods=['GET', 'POST'])
+def batch_convert():
+    """Convert many reports (or ZIP archives of them) in one go, without review"""
+    logger.debug("Batch endpoint called")
+    if request.method == 'GET':
+        return render_template('batch.html', now=datetime.now(), job_id=request.args.get('job'),
+                               next_number=next_invoice_number())
+    
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files:
+        flash('No selected file')
+        return redirect(url_for('batch_convert'))
+    for file in files:
+        if not (allowed_file(file.filename) or file.filename.lower().endswith('.zip')):
+            flash(f'File type not allowed: {file.filename}. Please upload Excel, CSV or ZIP files.')
+            return redirect(url_for('batch_convert'))
+    
+    try:
+        start_invoice_number = requested_start_number(request.form)
+        invoice_date = datetime.strptime(request.form['invoice_date'], '%Y-%m-%d')
+    except (KeyError, ValueError) as e:
+        flash(f'Error processing invoice details: {str(e)}')
+        return redirect(url_for('batch_convert'))
+    
+    # Each batch gets its own folder (removed by the job) so names never collide
+    batch_folder = os.path.join(app.config['UPLOAD_FOLDER'], f"batch_{uuid.uuid4().hex}")
+    os.makedirs(batch_folder)
+    file_paths = []
+    for file in files:
+        file_path = os.path.join(batch_folder, secure_filename(file.filename))
+        file.save(file_path)
+        track_file(file_path, 'upload')
+        file_paths.append(file_path)
+    logger.debug("Saved %s batch files to %s", len(file_paths), batch_folder)
+    
+    session_id = get_session_id()
+    job_id = jobs.submit(
+        jobs.batch_job, file_paths, start_invoice_number, invoice_date,
+        request.form.get('output') == 'per_file', app.config['DOWNLOAD_FOLDER'],
+        batch_folder, app.config['INVOICE_LEDGER_DB'], session_id=session_id
+    )
+    track_file(jobs.status_path(job_id), 'job')
+    session['job_id'] = job_id
+    return redirect(url_for('batch_convert', job=job_id))
+
 @app.route('/review', methods=['GET', 'POST'])
 def review():
+    from grid import parse_edits, merge_edits
+    from transformer import qbo_columns
+    
     logger.debug("Review endpoint called")
     if request.method == 'GET':
-        # Load transformed data from file
-        transformed_df = load_session_data('transformed_df')
-        if transformed_df is None:
+        # Only the header is read here; the grid fetches its rows page by page
+        header = load_session_frame('transformed_df', start=0, stop=0)
+        if header is None:
             flash('No transformed data. Please process invoice details first.')
             logger.error("No transformed data in session files")
             return redirect(url_for('invoice_details'))
-            
-        logger.debug(f"Review data loaded: {transformed_df.shape[0]} rows")
         
-        return render_template('review.html', 
-                              data=transformed_df.to_dict('records'),
-                              columns=transformed_df.columns.tolist())
+        return render_template('review.html', columns=qbo_columns(header),
+                               billed=bool(load_session_data('billed_version')))
     else:
         # Handle any edits from the review page
         try:
-            # Get edited data from form
-            edited_data = json.loads(request.form['edited_data'])
-            logger.debug(f"Received edited data with {len(edited_data)} rows")
+            # Only the cells changed since the last save are posted back
+            header = load_session_frame('transformed_df', start=0, stop=0)
+            if header is None:
+                raise ValueError("No transformed data. Please process invoice details first.")
+            num_rows = session_store.frame_length(session['session_id'], 'transformed_df')
+            edits = parse_edits(json.loads(request.form.get('edits') or '[]'), qbo_columns(header), num_rows)
+            edits = merge_edits(load_session_data('review_edits', []), edits)
+            save_session_data('review_edits', edits)
+            logger.debug("Saved %s cell edits for the download", len(edits))
             
-            # Convert to DataFrame
-            edited_df = pd.DataFrame(edited_data)
-            
-            # Save transformed data to CSV
+            # The CSV is written while it is downloaded (see get_file), from
+            # the stored frame and these edits
             timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            output_filename = f'quickbooks_import_{timestamp}.csv'
-            output_path = os.path.join(app.config['DOWNLOAD_FOLDER'], output_filename)
-            
-            save_to_csv(edited_df, output_path)
-            logger.debug(f"CSV saved to {output_path}")
-            
-            # Store download path in session
-            session['download_path'] = output_path
-            session['download_filename'] = output_filename
+            session.pop('download_path', None)
+            session['download_filename'] = f'quickbooks_import_{timestamp}.csv'
             
             return redirect(url_for('download'))
         except Exception as e:
             flash(f'Error processing review: {str(e)}')
-            logger.error(f"Error processing review: {str(e)}")
+            logger.error("Error processing review: %s", e)
             return redirect(url_for('review'))
 
+@app.route('/review/drop_billed', methods=['POST'])
+def review_drop_billed():
+    """Convert the upload again without the lines whose order was already exported"""
+    if 'file_path' not in session or 'invoice_date' not in session:
+        flash('No transformed data. Please process invoice details first.')
+        return redirect(url_for('invoice_details'))
+    # Same numbers and date; rows change, so review edits start over
+    invoice_date = datetime.strptime(session['invoice_date'], '%Y-%m-%d')
+    job_id = submit_conversion(session.get('start_invoice_number'), invoice_date, skip_billed=True)
+    return redirect(url_for('invoice_details', job=job_id))
+
+@app.route('/review/data')
+def review_data():
+    """One page of the transformed data, sorted and filtered, for the review grid"""
+    from transformer import qbo_columns, ORDER_ID
+    
+    header = load_session_frame('transformed_df', start=0, stop=0)
+    if header is None:
+        return jsonify({'error': 'No transformed data. Please process invoice details first.'}), 404
+    try:
+        # Saved edits are laid over the stored frame rather than written into it
+        page = grid_page('transformed_df', qbo_columns(header), load_session_data('review_edits', []))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Flag lines whose order had been exported when the file was converted
+    order_ids = [record.pop(ORDER_ID, '') for record in page['data']]
+    billed_version = load_session_data('billed_version')
+    history = order_history.get_history()
+    if billed_version and history is not None and order_ids:
+        for record, invoice in zip(page['data'], history.billed(order_ids, before=billed_version).tolist()):
+            if invoice >= 0:
+                record['_billed'] = invoice
+    return jsonify(page)
+
+@app.route('/review/edits', methods=['POST'])
+def review_edits():
+    """Save cell edits from the review grid as {row, field, value} patches"""
+    from grid import parse_edits, merge_edits
+    from transformer import qbo_columns
+    
+    header = load_session_frame('transformed_df', start=0, stop=0)
+    if header is None:
+        return jsonify({'error': 'No transformed data. Please process invoice details first.'}), 404
+    try:
+        payload = request.get_json(silent=True) or {}
+        num_rows = session_store.frame_length(session['session_id'], 'transformed_df')
+        edits = parse_edits(payload.get('edits', []), qbo_columns(header), num_rows)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    saved = merge_edits(load_session_data('review_edits', []), edits)
+    save_session_data('review_edits', saved)
+    logger.debug("Saved %s cell edits (%s in total)", len(edits), len(saved))
+    return jsonify({'saved': len(edits), 'total': len(saved)})
+
 @app.route('/download')
 def download():
     logger.debug("Download page endpoint called")
-    if 'download_path' not in session or 'download_filename' not in session:
+    if 'download_filename' not in session:
         flash('No file to download. Please complete the process first.')
-        logger.error("No download path in session")
+        logger.error("No download in session")
         return redirect(url_for('index'))
         
-    return render_template('download.html', filename=session['download_filename'])
+    return render_template('download.html', filename=session['download_filename'],
+                           is_zip=session['download_filename'].endswith('.zip'))
 
 @app.route('/get_file')
 def get_file():
+    """Send the converted file; ?compress=gzip or zip sends it compressed"""
+    from transformer import iter_csv
+    
     logger.debug("Get file endpoint called")
-    if 'download_path' not in session:
+    if 'download_filename' not in session:
         flash('No file to download. Please complete the process first.')
-        logger.error("No download path in session")
+        logger.error("No download in session")
         return redirect(url_for('index'))
-        
-    logger.debug(f"Sending file: {session['download_path']}")
-    return send_file(session['download_path'], 
-                    mimetype='text/csv',
-                    as_attachment=True, 
-                    download_name=session['download_filename'])
+    
+    filename = session['download_filename']
+    is_zip = filename.endswith('.zip')
+    compress = request.args.get('compress') or None
+    if compress not in delivery.COMPRESSIONS or is_zip:
+        compress = None
+    
+    path = session.get('download_path')
+    if path:
+        # Written by a background conversion; the front server can send it
+        if compress is None:
+            logger.debug("Sending file: %s", path)
+            return delivery.send_stored(path, filename, 'application/zip' if is_zip else 'text/csv',
+                                        accel_prefix=app.config['DOWNLOAD_ACCEL_PREFIX'])
+        return delivery.stream_response(delivery.read_file(path), filename, 'text/csv', compress)
+    
+    # A reviewed conversion: the CSV is written slice by slice as it is sent
+    session_id = session['session_id']
+    num_rows = session_store.frame_length(session_id, 'transformed_df')
+    if num_rows is None:
+        flash('No transformed data. Please process invoice details first.')
+        return redirect(url_for('invoice_details'))
+    slices = delivery.frame_slices(
+        lambda start, stop: session_store.load_frame(session_id, 'transformed_df', start=start, stop=stop),
+        num_rows, load_session_data('review_edits', []))
+    logger.debug("Streaming %d reviewed lines as %s", num_rows, filename)
+    return delivery.stream_response(iter_csv(slices), filename, 'text/csv', compress)
 
 # Make the app accessible for test scripts
 if __name__ == '__main__':
@@ -345,6 +807,7 @@ if __name__ == '__main__':
     print("Access the application at: http://localhost:5000")
     print("=" * 80)
     
+    configure_logging()
     logger.info("Starting QBO Invoice Converter application")
     
     try:
@@ -355,7 +818,7 @@ if __name__ == '__main__':
         
         app.run(debug=True, host='0.0.0.0', port=5000)
     except Exception as e:
-        logger.error(f"Error starting app: {str(e)}")
+        logger.error("Error starting app: %s", e)
         print(f"Error starting app: {str(e)}")
         # Write error to a file
         with open("app_error.txt", "w") as f:
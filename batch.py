@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import zipfile
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import metrics
+import order_history
+from transformer import load_prepared_lines, number_invoice_lines, number_customers, save_to_csv, qbo_columns
+
+logger = logging.getLogger(__name__)
+
+# Many per-branch reports are converted together: every file is read and
+# prepared in parallel, then numbered in a fixed order (sorted by file name),
+# each file from the number after the previous file's last invoice, so the
+# output is the same whatever order the workers finish in.
+ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'csv'}
+MAX_WORKERS = int(os.environ.get('QBO_BATCH_WORKERS', 0)) or os.cpu_count() or 1
+
+
+def _allowed(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def extract_zip(zip_path, target_dir):
+    """
+    Extract the Excel and CSV reports from a ZIP archive
+
+    Folder structure is dropped, and member names are never used as paths
+    outside target_dir.
+
+    Returns:
+        list: Paths of the extracted reports, in archive name order
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    paths = []
+    with zipfile.ZipFile(zip_path) as archive:
+        members = sorted(info.filename for info in archive.infolist() if not info.is_dir())
+        for i, name in enumerate(members):
+            filename = os.path.basename(name)
+            if name.startswith('__MACOSX/') or filename.startswith('.') or not _allowed(filename):
+                continue
+            # One folder per member keeps the original name even when several folders share it
+            member_dir = os.path.join(target_dir, f"{i:04d}")
+            os.makedirs(member_dir, exist_ok=True)
+            path = os.path.join(member_dir, filename)
+            with archive.open(name) as source, open(path, 'wb') as target:
+                while True:
+                    block = source.read(1024 * 1024)
+                    if not block:
+                        break
+                    target.write(block)
+            paths.append(path)
+    return paths
+
+
+def expand_inputs(paths, extract_dir):
+    """
+    Order the batch's input files, replacing ZIP archives by the reports they contain
+
+    Args:
+        paths (list): Excel, CSV or ZIP files
+        extract_dir (str): Where ZIP contents are extracted
+
+    Returns:
+        list: Report paths in the order their invoice ranges are assigned
+    """
+    reports = []
+    for path in sorted(paths, key=lambda p: (os.path.basename(p).lower(), p)):
+        if zipfile.is_zipfile(path) and not path.lower().endswith(('.xlsx', '.xls')):
+            stem = os.path.splitext(os.path.basename(path))[0]
+            reports.extend(extract_zip(path, os.path.join(extract_dir, stem)))
+        elif _allowed(path):
+            reports.append(path)
+        else:
+            raise ValueError(f"Unsupported file in batch: {os.path.basename(path)}")
+    if not reports:
+        raise ValueError("No Excel or CSV reports found in the batch")
+    return reports
+
+
+def _prepare_file(file_path):
+    """
+    Read one report and prepare its invoice lines (runs in a worker process)
+
+    Returns:
+        tuple: (prepared lines, see transformer.prepare_invoice_lines; stage
+        timings for metrics.merge)
+    """
+    try:
+        return load_prepared_lines(file_path), metrics.drain()
+    except Exception as e:
+        raise ValueError(f"{os.path.basename(file_path)}: {str(e)}")
+
+
+def prepare_batch(file_paths, max_workers=None, progress=None):
+    """
+    Read and prepare many reports in parallel
+
+    This is the slow part of a conversion; it does not depend on invoice
+    numbers, so numbering (number_batch) can wait until every file's
+    customers are known.
+
+    Args:
+        file_paths (list): Reports, in the order ranges are assigned (see expand_inputs)
+        max_workers (int): Worker processes; 1 prepares in this process
+        progress (callable): Called with the number of files prepared so far
+
+    Returns:
+        list: Prepared lines of every file, in input order
+    """
+    max_workers = min(max_workers or MAX_WORKERS, len(file_paths))
+    prepared = []
+    if max_workers <= 1:
+        for path in file_paths:
+            lines, timings = _prepare_file(path)
+            metrics.merge(timings)
+            prepared.append(lines)
+            if progress is not None:
+                progress(len(prepared))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_prepare_file, path) for path in file_paths]
+            for future in futures:
+                lines, timings = future.result()
+                metrics.merge(timings)
+                prepared.append(lines)
+                if progress is not None:
+                    progress(len(prepared))
+    return prepared
+
+
+def invoice_customers(prepared, name_mapping=None):
+    """
+    Customer name of every invoice of a prepared batch, in invoice number order
+
+    Args:
+        prepared (list): Prepared lines of every file (see prepare_batch)
+        name_mapping (dict): Optional original to confirmed customer names
+
+    Returns:
+        list: One name per invoice, as number_batch numbers them
+    """
+    names = []
+    for lines in prepared:
+        customers = number_customers(lines, 0, name_mapping)
+        customers = customers[customers['invoice_no'] >= 0].drop_duplicates('invoice_no')
+        names.extend(str(name) for name in customers['name'])
+    return names
+
+
+def number_batch(file_paths, prepared, start_invoice_number, invoice_date, name_mapping=None):
+    """
+    Number prepared reports with one contiguous invoice range per file
+
+    Each file is numbered from the number that follows the previous file's
+    last invoice, so its lines (the descriptions too, where the invoice
+    number stands in for a missing order ID) are what transform_data gives
+    with that start number.
+
+    Args:
+        file_paths (list): Reports the lines were prepared from
+        prepared (list): Prepared lines of every file (see prepare_batch)
+        start_invoice_number (int): First invoice number of the first file
+        invoice_date (datetime): Date for the invoices
+        name_mapping (dict): Optional original to confirmed customer names
+
+    Returns:
+        list: (file path, transformed DataFrame) pairs in input order
+    """
+    results = []
+    next_number = start_invoice_number
+    for path, lines in zip(file_paths, prepared):
+        try:
+            df = number_invoice_lines(lines, next_number, invoice_date, name_mapping)
+        except Exception as e:
+            raise ValueError(f"{os.path.basename(path)}: {str(e)}")
+        next_number += df['*InvoiceNo'].nunique()
+        results.append((path, df))
+    return results
+
+
+def convert_batch(file_paths, start_invoice_number, invoice_date, name_mapping=None,
+                  max_workers=None, progress=None):
+    """
+    Transform many reports in parallel with one contiguous invoice range per file
+
+    Each file gets the same result transform_data would give it with the
+    start number that follows the previous file's last invoice.
+
+    Args:
+        file_paths (list): Reports, in the order ranges are assigned (see expand_inputs)
+        start_invoice_number (int): First invoice number of the first file
+        invoice_date (datetime): Date for the invoices
+        name_mapping (dict): Optional original to confirmed customer names
+        max_workers (int): Worker processes; 1 converts in this process
+        progress (callable): Called with the number of files converted so far
+
+    Returns:
+        list: (file path, transformed DataFrame) pairs in input order
+    """
+    prepared = prepare_batch(file_paths, max_workers, progress)
+    return number_batch(file_paths, prepared, start_invoice_number, invoice_date, name_mapping)
+
+
+def _output_name(file_path, used):
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    name = f"{stem}_qbo.csv"
+    suffix = 2
+    while name in used:
+        name = f"{stem}_qbo_{suffix}.csv"
+        suffix += 1
+    used.add(name)
+    return name
+
+
+def write_merged(results, output_path):
+    """Write every file's invoice lines to one QBO CSV"""
+    save_to_csv(pd.concat([df for _, df in results], ignore_index=True), output_path)
+
+
+def write_per_file(results, output_dir):
+    """
+    Write one QBO CSV per input file
+
+    Returns:
+        list: Paths of the written files
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    used = set()
+    paths = []
+    for file_path, df in results:
+        path = os.path.join(output_dir, _output_name(file_path, used))
+        save_to_csv(df, path)
+        paths.append(path)
+    return paths
+
+
+def write_zip(results, zip_path):
+    """Write one QBO CSV per input file into a ZIP archive"""
+    used = set()
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for file_path, df in results:
+            # Same bytes as save_to_csv writes
+            with metrics.timed('serialize'):
+                data = df.to_csv(index=False, columns=qbo_columns(df)).encode('utf-8-sig')
+            archive.writestr(_output_name(file_path, used), data)
+            order_history.record_export(df)
+
+
+def summarize(results):
+    return {
+        'files': len(results),
+        'lines': sum(len(df) for _, df in results),
+        'invoices': sum(int(df['*InvoiceNo'].nunique()) for _, df in results),
+    }
+
+
+if __name__ == "__main__":
+    # Usage:
+    #   python batch.py reports/*.xlsx branches.zip --start 1001 --date 2024-04-01 -o merged.csv
+    #   python batch.py reports/*.csv --start 1001 --date 2024-04-01 --per-file -o out_dir/
+    parser = argparse.ArgumentParser(description="Convert many laundry reports to QBO invoices at once")
+    parser.add_argument('inputs', nargs='+', help="Excel, CSV or ZIP files")
+    parser.add_argument('--start', type=int, required=True, help="First invoice number")
+    parser.add_argument('--date', required=True, help="Invoice date (YYYY-MM-DD)")
+    parser.add_argument('--names', help="JSON file mapping original to confirmed customer names")
+    parser.add_argument('--per-file', action='store_true', help="Write one CSV per input file into --output")
+    parser.add_argument('-o', '--output', required=True, help="Output CSV (or directory with --per-file)")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help="Worker processes")
+    args = parser.parse_args()
+
+    invoice_date = datetime.strptime(args.date, '%Y-%m-%d')
+    name_mapping = None
+    if args.names:
+        with open(args.names, 'r', encoding='utf-8') as f:
+            name_mapping = json.load(f)
+
+    with tempfile.TemporaryDirectory() as extract_dir:
+        reports = expand_inputs(args.inputs, extract_dir)
+        results = convert_batch(reports, args.start, invoice_date, name_mapping, args.workers)
+    if args.per_file:
+        write_per_file(results, args.output)
+    else:
+        write_merged(results, args.output)
+
+    stats = summarize(results)
+    last = args.start + stats['invoices'] - 1
+    print(f"Converted {stats['files']} files: {stats['invoices']} invoices ({args.start}-{last}), "
+          f"{stats['lines']} lines", file=sys.stderr)
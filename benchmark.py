@@ -0,0 +1,502 @@
+"""
+Benchmarks for the conversion pipeline
+
+    python benchmark.py                     time the conversion functions and the web flow
+    python benchmark.py functions --rows 1000 50000 --formats csv
+    python benchmark.py flask --quick
+    python benchmark.py blanking            time the blanking pass as customers grow
+    python benchmark.py startup             check import times (exits 1 when over budget)
+
+Function and web-flow timings are appended to benchmark_history.json and
+compared with the last run of the same scenario, so a slowdown between
+commits shows up as REGRESSION (--check exits 1 when one is found).
+"""
+import os
+import sys
+import json
+import time
+import logging
+import warnings
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import dataset
+import metrics
+from transformer import (transform_frame, blank_repeated_invoice_fields, validate_file,
+                         get_unique_customers, transform_data, save_to_csv)
+
+LINES_PER_CUSTOMER = 20
+INVOICE_DATE = datetime(2024, 4, 1)
+
+# Scenarios run by default: every combination of size, dirty-data ratio and format
+DEFAULT_ROWS = (1000, 10000)
+DEFAULT_DIRTY_RATIOS = (0.0, 0.05)
+# 'xls' is CSV text in a Windows code page saved with an .xls extension, as
+# some laundry systems export it
+FORMATS = ('csv', 'xlsx', 'xls')
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_history.json')
+# A timing this many times slower than the previous run of the scenario is a regression
+REGRESSION_RATIO = 1.25
+# Timings below this are too noisy to compare
+MIN_COMPARABLE_SECONDS = 0.05
+
+# Import-time budgets in seconds (best of several fresh interpreters). app must
+# not import any of HEAVY_MODULES: they are loaded by the first request that
+# needs them, so a gunicorn worker boots in a fraction of a second.
+STARTUP_BUDGETS = {'app': 0.6, 'transformer': 1.5}
+HEAVY_MODULES = ('pandas', 'numpy', 'openpyxl', 'pyarrow')
+
+_IMPORT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'modules': sorted(m for m in sys.modules if '.' not in m)}}))
+"""
+
+def make_report(rows, customers, seed=0, dirty_ratio=0.0):
+    """
+    Build a synthetic laundry report with the dtypes read_excel produces
+
+    Args:
+        rows (int): Number of order rows
+        customers (int): Number of distinct customer names
+        seed (int): Random seed; the same arguments always give the same report
+        dirty_ratio (float): Share of rows given each kind of bad value seen in
+            real exports (blank names, text prices, unreadable dates, missing
+            IDs, cancelled orders, odd notes), chosen independently per kind
+
+    Returns:
+        pd.DataFrame: Name, Price, Date, ID, House, Note and Status columns
+    """
+    rng = np.random.default_rng(seed)
+    names = np.array([f"Customer {i}" for i in range(customers)], dtype=object)
+    df = pd.DataFrame({
+        'ID': np.arange(10000, 10000 + rows),
+        'Name': names[rng.integers(0, customers, rows)],
+        'House': rng.choice(np.array(['Casa Azul', 'Villa 12', np.nan], dtype=object), rows),
+        'Price': rng.choice([10.0, 12.5, 25.0, 40.75], rows),
+        'Date': pd.Timestamp('2024-03-01') + pd.to_timedelta(rng.integers(0, 28, rows), unit='D'),
+        'Note': rng.choice(np.array(['', 'urgent', 'extra sheets', np.nan], dtype=object), rows),
+        'Status': rng.choice(np.array(['Delivery', 'Production', 'Open'], dtype=object), rows),
+    })
+    if dirty_ratio:
+        _add_dirty_values(df, dirty_ratio, np.random.default_rng(seed + 1))
+    return df
+
+def _add_dirty_values(df, ratio, rng):
+    rows = len(df)
+
+    def pick():
+        return rng.random(rows) < ratio
+
+    dirty = {
+        'Name': (pick(), np.array(['', np.nan, 'Total'], dtype=object)),
+        'Price': (pick(), np.array(['R$ 12,50', 'n/a', '1,234.50', ''], dtype=object)),
+        'Date': (pick(), np.array(['not a date', '31/02/2024', ''], dtype=object)),
+        'ID': (pick(), np.array([np.nan, '', 'A-7'], dtype=object)),
+        'Status': (pick(), np.array(['Cancelled', 'Draft', np.nan], dtype=object)),
+        'Note': (pick(), np.array([1, 2.5, True], dtype=object)),
+    }
+    for col, (mask, values) in dirty.items():
+        if mask.any():
+            column = df[col].astype(object)
+            column[mask] = rng.choice(values, int(mask.sum()))
+            df[col] = column
+
+def write_report(df, path, file_format):
+    """
+    Save a synthetic report the way exports reach the app
+
+    Args:
+        df (pd.DataFrame): Report, as built by make_report
+        path (str): Output path, without extension
+        file_format (str): One of FORMATS
+
+    Returns:
+        str: Path of the written file
+    """
+    if file_format == 'xlsx':
+        path = f"{path}.xlsx"
+        df.to_excel(path, index=False, engine='openpyxl')
+    elif file_format == 'xls':
+        path = f"{path}.xls"
+        df.to_csv(path, index=False, encoding='latin-1')
+    elif file_format == 'csv':
+        path = f"{path}.csv"
+        df.to_csv(path, index=False, encoding='utf-8')
+    else:
+        raise ValueError(f"Unknown format: {file_format}")
+    return path
+
+def _scenario_key(kind, file_format, rows, customers, dirty_ratio):
+    return f"{kind}:{file_format}:rows={rows}:customers={customers}:dirty={dirty_ratio:g}"
+
+def _best_of(repeat, run):
+    """Call run() repeat times; return the smallest time of every step it reports"""
+    best = {}
+    for _ in range(repeat):
+        for step, seconds in run().items():
+            best[step] = min(best.get(step, seconds), seconds)
+    return best
+
+def bench_functions(path, repeat=3):
+    """
+    Time validate_file, get_unique_customers, transform_data and save_to_csv on one file
+
+    The steps run in the order of an upload, with an empty dataset cache at
+    the start of every repeat: validate_file parses the file and the other
+    steps reuse the parsed frame. transform_data_resubmit converts the file
+    again with other invoice details, as when the details form is resubmitted.
+
+    Returns:
+        dict: Best time of each step in seconds, plus the per-stage times of the
+        last repeat (see metrics) under 'stages' and the size in bytes of the
+        transformed frame under 'qbo_frame_bytes'
+    """
+    output_path = f"{path}.qbo.csv"
+
+    def run():
+        dataset.clear_cache()
+        metrics.drain()
+        timings = {}
+        start = time.perf_counter()
+        validate_file(path)
+        timings['validate_file'] = time.perf_counter() - start
+        start = time.perf_counter()
+        get_unique_customers(path)
+        timings['get_unique_customers'] = time.perf_counter() - start
+        start = time.perf_counter()
+        df = transform_data(path, 1001, INVOICE_DATE)
+        timings['transform_data'] = time.perf_counter() - start
+        start = time.perf_counter()
+        transform_data(path, 2001, INVOICE_DATE.replace(day=2))
+        timings['transform_data_resubmit'] = time.perf_counter() - start
+        start = time.perf_counter()
+        save_to_csv(df, output_path)
+        timings['save_to_csv'] = time.perf_counter() - start
+        return timings
+
+    best = _best_of(repeat, run)
+    stats = metrics.drain()
+    best['stages'] = {stage: round(stat['seconds'], 6) for stage, stat in stats.items() if stage != metrics.MEMORY}
+    best['qbo_frame_bytes'] = stats.get(metrics.MEMORY, {}).get('qbo_frame', {}).get('max', 0)
+    os.remove(output_path)
+    return best
+
+def _prepare_app(work_dir):
+    """Import the app with every folder inside work_dir and conversions run inline"""
+    import app as web
+    import jobs
+    import order_history
+
+    folders = {key: os.path.join(work_dir, name) for key, name in [
+        ('UPLOAD_FOLDER', 'uploads'), ('DOWNLOAD_FOLDER', 'downloads'), ('SESSION_DATA_FOLDER', 'session_data')
+    ]}
+    web.app.config.update(folders)
+    web.app.config.update(
+        ACCESS_DB_PATH=os.path.join(folders['SESSION_DATA_FOLDER'], 'access.sqlite3'),
+        CUSTOMER_ALIASES_DB=os.path.join(folders['SESSION_DATA_FOLDER'], 'customer_aliases.sqlite3'),
+        INVOICE_LEDGER_DB=os.path.join(folders['SESSION_DATA_FOLDER'], 'invoice_ledger.sqlite3'),
+        REAPER_INTERVAL=0,
+        LOG_FILE='',
+    )
+    web.session_store_config = ('feather', folders['SESSION_DATA_FOLDER'])
+    dataset.configure(cache_dir='')
+    jobs.configure(jobs_dir=os.path.join(folders['SESSION_DATA_FOLDER'], 'jobs'), max_workers=0)
+    metrics.configure(metrics_dir=None)
+    # Repeated runs export the same orders; keep them out of any history
+    order_history.configure(db_path=None)
+    return web
+
+def bench_flask(path, repeat=3, work_dir=None):
+    """
+    Time the web flow for one file with the Flask test client
+
+    Upload, confirm every customer, convert from the next free invoice
+    number (inline, without a job worker), open the review page and its
+    first grid page, generate the CSV and download it.
+
+    Returns:
+        dict: Best time of each request in seconds, of the whole flow under
+        'total', and the largest session cookie set, in bytes, under
+        'session_cookie_bytes' (browsers drop cookies over 4KB)
+    """
+    web = _prepare_app(work_dir or os.path.dirname(path))
+    cookie_bytes = 0
+
+    def run():
+        dataset.clear_cache()
+        client = web.app.test_client()
+        timings = {}
+
+        def step(name, method, url, **kwargs):
+            nonlocal cookie_bytes
+            start = time.perf_counter()
+            response = getattr(client, method)(url, **kwargs)
+            # Streamed downloads are produced while their body is read
+            response.get_data()
+            timings[name] = time.perf_counter() - start
+            if response.status_code >= 400:
+                raise RuntimeError(f"{method.upper()} {url} returned {response.status_code}")
+            for cookie in response.headers.getlist('Set-Cookie'):
+                if cookie.startswith('session='):
+                    cookie_bytes = max(cookie_bytes, len(cookie))
+            return response
+
+        client.get('/')
+        with open(path, 'rb') as f:
+            step('upload', 'post', '/upload', data={'file': (f, os.path.basename(path))},
+                 content_type='multipart/form-data')
+        step('confirm_page', 'get', '/confirm_customers')
+        step('customers_data', 'get', '/customers/data?page=1&size=25')
+        # Every customer is kept under its own name, so there are no changes to post
+        step('confirm', 'post', '/confirm_customers', data={'edits': '[]'})
+        response = step('convert', 'post', '/invoice_details',
+                        data={'start_invoice_number': '', 'invoice_date': '2024-04-01'})
+        job_id = response.headers['Location'].split('job=')[1]
+        step('job_status', 'get', f'/jobs/{job_id}')
+        step('review_page', 'get', '/review')
+        step('review_data', 'get', '/review/data?page=1&size=15')
+        step('generate_csv', 'post', '/review', data={'edits': '[]'})
+        step('download', 'get', '/get_file')
+        timings['total'] = sum(timings.values())
+        return timings
+
+    with warnings.catch_warnings():
+        # Reported once, as session_cookie_bytes, instead of on every request
+        warnings.filterwarnings('ignore', message="The 'session' cookie is too large")
+        best = _best_of(repeat, run)
+    best['session_cookie_bytes'] = cookie_bytes
+    return best
+
+def _git_commit():
+    """Return the current commit (with -dirty for uncommitted changes), or None outside git"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here,
+                                 capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if changes else commit
+
+def load_history(history_file=HISTORY_FILE):
+    try:
+        with open(history_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+def save_run(results, history_file=HISTORY_FILE):
+    """
+    Append a run's results to the JSON history
+
+    Returns:
+        dict: The recorded run
+    """
+    history = load_history(history_file)
+    run = dict({
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+    }, **_environment(), results=results)
+    history.append(run)
+    tmp_path = f"{history_file}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp_path, history_file)
+    return run
+
+def _environment():
+    return {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+def compare(results, history):
+    """
+    Compare timings with the last earlier run of each scenario in the same environment
+
+    Runs made with another Python or pandas version, or on another kind of
+    machine, are not compared.
+
+    Args:
+        results (dict): Scenario key to step timings
+        history (list): Earlier runs, oldest first
+
+    Returns:
+        list: (scenario, step, previous seconds, seconds, previous commit) for every regression
+    """
+    environment = _environment()
+    comparable = [run for run in history if all(run.get(k) == v for k, v in environment.items())]
+    regressions = []
+    for key, timings in results.items():
+        previous = next((run for run in reversed(comparable) if key in run['results']), None)
+        if previous is None:
+            continue
+        for step, seconds in timings.items():
+            before = previous['results'][key].get(step)
+            if not isinstance(before, float) or not isinstance(seconds, float):
+                continue
+            if max(before, seconds) < MIN_COMPARABLE_SECONDS:
+                continue
+            if seconds > before * REGRESSION_RATIO:
+                regressions.append((key, step, before, seconds, previous.get('commit')))
+    return regressions
+
+def run_suite(kinds, rows_list, dirty_ratios, formats, customers=None, repeat=3):
+    """
+    Generate every scenario's report and time it
+
+    Args:
+        kinds (list): 'functions' and/or 'flask'
+        rows_list (list): Row counts
+        dirty_ratios (list): Dirty-data ratios (see make_report)
+        formats (list): File formats (see FORMATS)
+        customers (int): Distinct customers; defaults to one per LINES_PER_CUSTOMER rows
+        repeat (int): Runs per scenario; the best time of each step is kept
+
+    Returns:
+        dict: Scenario key to step timings
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for rows in rows_list:
+            customer_count = customers or max(1, rows // LINES_PER_CUSTOMER)
+            for dirty_ratio in dirty_ratios:
+                df = make_report(rows, customer_count, dirty_ratio=dirty_ratio)
+                for file_format in formats:
+                    name = f"report_{rows}_{dirty_ratio:g}_{file_format}"
+                    path = write_report(df, os.path.join(work_dir, name), file_format)
+                    for kind in kinds:
+                        key = _scenario_key(kind, file_format, rows, customer_count, dirty_ratio)
+                        if kind == 'functions':
+                            timings = bench_functions(path, repeat)
+                        else:
+                            timings = bench_flask(path, repeat, work_dir)
+                        results[key] = timings
+                        steps = ', '.join(f"{step} {seconds:.4f}s" for step, seconds in timings.items()
+                                          if isinstance(seconds, float))
+                        print(f"{key}\n    {steps}")
+                        if timings.get('qbo_frame_bytes'):
+                            print(f"    transformed frame uses {timings['qbo_frame_bytes'] / 1024 / 1024:.1f}MB")
+                        if timings.get('session_cookie_bytes', 0) > 4093:
+                            print(f"    session cookie is {timings['session_cookie_bytes']} bytes, "
+                                  f"over the 4KB browsers accept")
+    return results
+
+def bench_blanking(customer_counts=(500, 1000, 2000, 5000, 10000), repeat=3):
+    """
+    Time the blanking of repeated invoice fields as the number of customers grows
+
+    Each customer has the same number of lines, so the row count grows with the
+    customer count; a linear-time pass shows a flat time per row.
+    """
+    print(f"{'customers':>10} {'rows':>8} {'seconds':>9} {'us/row':>8}")
+    results = []
+    for customers in customer_counts:
+        rows = customers * LINES_PER_CUSTOMER
+        qbo_df = transform_frame(make_report(rows, customers), 1001, INVOICE_DATE)
+        best = None
+        for _ in range(repeat):
+            frame = qbo_df.copy()
+            start = time.perf_counter()
+            blank_repeated_invoice_fields(frame)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((customers, rows, best))
+        print(f"{customers:>10} {rows:>8} {best:>9.4f} {best / rows * 1e6:>8.3f}")
+    return results
+
+def measure_import(module, repeat=5):
+    """
+    Time importing a module in fresh interpreters
+
+    Returns:
+        tuple: (best time in seconds, top-level modules loaded by the import)
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    modules = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', _IMPORT_PROBE.format(module=module)],
+            cwd=here, capture_output=True, text=True, check=True
+        ).stdout
+        probe = json.loads(output.strip().splitlines()[-1])
+        if best is None or probe['seconds'] < best:
+            best = probe['seconds']
+        modules = probe['modules']
+    return best, modules
+
+def bench_startup(budgets=STARTUP_BUDGETS, repeat=5):
+    """
+    Check import times against STARTUP_BUDGETS and that app imports nothing heavy
+
+    Returns:
+        list: Problems found; empty when everything is within budget
+    """
+    print(f"{'module':>12} {'seconds':>9} {'budget':>8}")
+    problems = []
+    for module, budget in budgets.items():
+        seconds, modules = measure_import(module, repeat)
+        print(f"{module:>12} {seconds:>9.3f} {budget:>8.2f}")
+        if seconds > budget:
+            problems.append(f"importing {module} took {seconds:.3f}s (budget {budget:.2f}s)")
+        if module == 'app':
+            loaded = [name for name in HEAVY_MODULES if name in modules]
+            if loaded:
+                problems.append(f"importing app loaded {', '.join(loaded)}")
+    for problem in problems:
+        print(f"OVER BUDGET: {problem}")
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the QBO invoice conversion")
+    parser.add_argument('suite', nargs='?', default='all',
+                        choices=['all', 'functions', 'flask', 'blanking', 'startup'])
+    parser.add_argument('--rows', type=int, nargs='+', default=list(DEFAULT_ROWS), help="Row counts")
+    parser.add_argument('--customers', type=int, help="Distinct customers (default: rows / 20)")
+    parser.add_argument('--dirty', type=float, nargs='+', default=list(DEFAULT_DIRTY_RATIOS),
+                        help="Dirty-data ratios")
+    parser.add_argument('--formats', nargs='+', default=list(FORMATS), choices=FORMATS)
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per scenario (best is kept)")
+    parser.add_argument('--quick', action='store_true', help="Only 1000 clean CSV rows, once")
+    parser.add_argument('--history', default=HISTORY_FILE, help="JSON history file")
+    parser.add_argument('--no-save', action='store_true', help="Compare with the history without recording")
+    parser.add_argument('--check', action='store_true', help="Exit 1 when a regression is found")
+    args = parser.parse_args(argv)
+
+    if args.suite == 'startup':
+        return 1 if bench_startup() else 0
+    if args.suite == 'blanking':
+        bench_blanking()
+        return 0
+    if args.quick:
+        args.rows, args.dirty, args.formats, args.repeat = [1000], [0.0], ['csv'], 1
+
+    # Keep the conversion's own logging out of the timings and the output
+    logging.basicConfig(level=logging.WARNING)
+    kinds = ['functions', 'flask'] if args.suite == 'all' else [args.suite]
+    results = run_suite(kinds, args.rows, args.dirty, args.formats, args.customers, args.repeat)
+
+    regressions = compare(results, load_history(args.history))
+    for key, step, before, seconds, commit in regressions:
+        print(f"REGRESSION: {key} {step}: {before:.4f}s -> {seconds:.4f}s (since {commit})")
+    if not args.no_save:
+        run = save_run(results, args.history)
+        print(f"Recorded {len(results)} scenarios for {run['commit']} in {args.history}")
+    return 1 if args.check and regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,431 @@
+import io
+import os
+import sys
+import time
+import tempfile
+import contextlib
+import warnings
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import dataset
+from transformer import transform_frame, transform_data, qbo_columns
+from benchmark import make_report
+from dataset import source_columns
+from schema import detect_columns
+from prefilter import filter_rows
+
+# Reference implementation: the original row-by-row transform. The vectorized
+# engine in transformer.transform_frame must produce byte-identical CSV output.
+
+def legacy_transform_frame(df, start_invoice_number, invoice_date):
+    """Row-by-row transform kept as the parity reference for transform_frame"""
+    # Add fallback columns if the CSV doesn't have all required columns
+    # These are the minimum required columns for QuickBooks Online import
+    required_qbo_columns = [
+        '*InvoiceNo', '*Customer', '*InvoiceDate', '*DueDate',
+        'Item(Product/Service)', 'ItemDescription', 'ItemQuantity', '*ItemAmount'
+    ]
+    
+    # Create a new DataFrame with the required structure
+    qbo_df = pd.DataFrame(columns=required_qbo_columns)
+    
+    # Try to identify needed columns from the input file
+    name_col = None
+    price_col = None
+    date_col = None
+    id_col = None
+    house_col = None
+    note_col = None
+    
+    # Look for customer name column
+    for possible_name in ['Name', 'Customer', 'Client', 'Account']:
+        if possible_name in df.columns:
+            name_col = possible_name
+            break
+            
+    if not name_col:
+        # Try case-insensitive search
+        for col in df.columns:
+            if 'name' in col.lower() or 'customer' in col.lower():
+                name_col = col
+                break
+                
+    if not name_col and len(df.columns) > 1:
+        # If still not found, use second column as fallback
+        name_col = df.columns[1]
+    
+    # Look for price/amount column
+    for possible_price in ['Price', 'Amount', 'Total', 'Value', 'Cost']:
+        if possible_price in df.columns:
+            price_col = possible_price
+            break
+            
+    if not price_col:
+        # Try case-insensitive search
+        for col in df.columns:
+            if 'price' in col.lower() or 'amount' in col.lower() or 'total' in col.lower() or 'value' in col.lower():
+                price_col = col
+                break
+    
+    # Look for date column
+    for possible_date in ['Date', 'Service Date', 'Cleaning Date', 'Invoice Date']:
+        if possible_date in df.columns:
+            date_col = possible_date
+            break
+            
+    if not date_col:
+        # Try case-insensitive search
+        for col in df.columns:
+            if 'date' in col.lower():
+                date_col = col
+                break
+    
+    # Look for ID column
+    for possible_id in ['ID', 'Id', 'Order', 'Order ID', 'Invoice', 'Ref']:
+        if possible_id in df.columns:
+            id_col = possible_id
+            break
+            
+    if not id_col:
+        # Try case-insensitive search
+        for col in df.columns:
+            if 'id' in col.lower() or 'order' in col.lower() or 'ref' in col.lower():
+                id_col = col
+                break
+                
+    if not id_col and len(df.columns) > 0:
+        # If still not found, use first column as fallback
+        id_col = df.columns[0]
+        
+    # Look for House/Address column
+    for possible_house in ['House', 'Address', 'Location', 'Property', 'Apartment']:
+        if possible_house in df.columns:
+            house_col = possible_house
+            break
+            
+    if not house_col:
+        # Try case-insensitive search
+        for col in df.columns:
+            if 'house' in col.lower() or 'address' in col.lower() or 'location' in col.lower() or 'property' in col.lower():
+                house_col = col
+                break
+    
+    # Look for Note column
+    for possible_note in ['Note', 'Notes', 'Comment', 'Comments', 'Description']:
+        if possible_note in df.columns:
+            note_col = possible_note
+            break
+            
+    if not note_col:
+        # Try case-insensitive search
+        for col in df.columns:
+            if 'note' in col.lower() or 'comment' in col.lower() or 'description' in col.lower():
+                note_col = col
+                break
+    
+    # Make sure we have the minimally required columns
+    if not name_col:
+        raise ValueError("Could not find customer name column in the file")
+    if not price_col:
+        raise ValueError("Could not find price/amount column in the file")
+    
+    print(f"Using {name_col} as customer name column")
+    print(f"Using {price_col} as price column")
+    if date_col:
+        print(f"Using {date_col} as date column")
+    if id_col:
+        print(f"Using {id_col} as ID column")
+    if house_col:
+        print(f"Using {house_col} as house/address column")
+    if note_col:
+        print(f"Using {note_col} as note column")
+    
+    # Create a basic transformation - copy needed columns to the QBO format
+    # Filter for valid rows - non-empty customer names
+    df = df.dropna(subset=[name_col])
+    df = df[df[name_col] != '']
+    
+    # Get unique customers
+    unique_customers = df[name_col].drop_duplicates().tolist()
+    
+    # Create invoice numbers sequence
+    invoice_mapping = {}
+    current_invoice = start_invoice_number
+    
+    for customer in unique_customers:
+        invoice_mapping[customer] = current_invoice
+        current_invoice += 1
+    
+    # Build the QBO dataframe row by row
+    rows = []
+    
+    for _, row in df.iterrows():
+        customer = row[name_col]
+        # Check if price can be converted to float
+        try:
+            price = float(row[price_col])
+        except:
+            # Try to extract numeric part
+            price_str = str(row[price_col])
+            price_str = ''.join(c for c in price_str if c.isdigit() or c == '.' or c == ',')
+            price_str = price_str.replace(',', '.')
+            try:
+                price = float(price_str)
+            except:
+                price = 0
+        
+        # Create a description with the requested format
+        description = ""
+        
+        # Add house/address if available
+        if house_col and house_col in row and pd.notna(row[house_col]) and row[house_col] != '':
+            description = f"{row[house_col]}, "
+        
+        # Add order ID
+        if id_col and id_col in row and pd.notna(row[id_col]) and row[id_col] != '':
+            order_id = row[id_col]
+        else:
+            order_id = invoice_mapping[customer]  # Use invoice number as fallback
+            
+        description += f"/ order id: {order_id}"
+        
+        # Add note if available
+        if note_col and note_col in row and pd.notna(row[note_col]) and row[note_col] != '':
+            description += f" / Notes: {row[note_col]}"
+        
+        # Add date if available
+        if date_col and date_col in row and pd.notna(row[date_col]):
+            try:
+                service_date = pd.to_datetime(row[date_col]).strftime('%d/%m/%Y')
+            except:
+                service_date = invoice_date.strftime('%d/%m/%Y')
+        else:
+            service_date = invoice_date.strftime('%d/%m/%Y')
+        
+        # Create a QBO row
+        qbo_row = {
+            '*InvoiceNo': invoice_mapping[customer],
+            '*Customer': customer,
+            '*InvoiceDate': invoice_date.strftime('%d/%m/%Y'),
+            '*DueDate': (invoice_date + timedelta(days=4)).strftime('%d/%m/%Y'),
+            'Item(Product/Service)': 'Linhas de Lavanderia:Services',
+            'ItemDescription': description,
+            'ItemQuantity': 1,
+            '*ItemAmount': price,
+            'Service Date': service_date
+        }
+        
+        rows.append(qbo_row)
+    
+    # Convert list of rows to DataFrame
+    if not rows:
+        raise ValueError("No valid invoice data found in the file after processing")
+        
+    qbo_df = pd.DataFrame(rows)
+    
+    # Set blank customer names for all but first occurrence of each invoice
+    for inv_num in qbo_df['*InvoiceNo'].unique():
+        mask = qbo_df['*InvoiceNo'] == inv_num
+        indices = qbo_df[mask].index
+        if len(indices) > 1:  # If there are multiple rows for this invoice
+            qbo_df.loc[indices[1:], '*Customer'] = ''  # Clear customer name for all but first row
+            qbo_df.loc[indices[1:], '*InvoiceDate'] = ''  # Clear invoice date for all but first row
+            qbo_df.loc[indices[1:], '*DueDate'] = ''  # Clear due date for all but first row
+            
+    print(f"Created {len(qbo_df)} invoice rows for QuickBooks Online import")
+    
+    return qbo_df
+
+def to_csv_bytes(df):
+    """Serialize a frame exactly the way save_to_csv does"""
+    buffer = io.BytesIO()
+    df.to_csv(buffer, index=False, encoding='utf-8-sig', columns=qbo_columns(df))
+    return buffer.getvalue()
+
+def parity_cases():
+    """Yield (name, frame) pairs covering the input shapes seen in real exports"""
+    yield 'clean excel report', make_report(500, 40)
+
+    dirty = make_report(12, 4, seed=1)
+    dirty['Price'] = pd.Series(['15,50', 'abc', '', None, np.nan, '1_000', ' 12 ',
+                                True, 7, 'R$ 10,00', '1,234.50', 3.25], dtype=object)
+    dirty['ID'] = pd.Series([1, '', None, 'A-7', 2.5, np.nan, 3, 4, 5, 6, 7, 8], dtype=object)
+    dirty['Note'] = pd.Series([1, 2.0, True, 'x', '', None] * 2, dtype=object)
+    yield 'dirty prices, ids and notes', dirty
+
+    csv_like = pd.DataFrame({
+        'Order ID': ['A1', 'A2', None, 'A4', 'A5', 'A6'],
+        'Customer': ['Ana', 'Bruno', 'Ana', '', None, 'Bruno'],
+        'Amount': ['10', '20.5', 'n/a', '0', '5', '7,25'],
+        'Service Date': ['2024-01-05', '05/01/2024', 'not a date', '', None, '2024-02-30'],
+        'Address': ['Rua 1', None, '', 'Rua 4', 'Rua 5', 'Rua 6'],
+        'Comments': [None, 'ok', '', 'late', None, 'n'],
+    })
+    yield 'csv style text columns', csv_like
+
+    yield 'no optional columns', pd.DataFrame({
+        'Client': ['A', 'B', 'A', 'C'],
+        'Total': [1.0, 2.0, 3.0, np.nan],
+    })
+
+    yield 'unreadable prices', pd.DataFrame({
+        'Name': ['A', 'B', 'A'],
+        'Price': ['x', 'y', 'free'],
+    })
+
+    numeric_names = make_report(50, 5, seed=2)
+    numeric_names['Name'] = numeric_names['ID'] % 7
+    yield 'numeric customer names', numeric_names
+
+    yield 'all numeric columns', pd.DataFrame({
+        'ID': [1, 2, 3, 4],
+        'Name': [7.0, 8.0, 7.0, 9.0],
+        'Price': [1.5, 2, 3, 4],
+    })
+
+def check_parity():
+    """Compare the vectorized and the reference transform on every case"""
+    invoice_date = datetime(2024, 4, 1)
+    failures = 0
+    for name, df in parity_cases():
+        with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+            # The reference blanks numeric name columns with .loc, which pandas warns about
+            warnings.simplefilter('ignore', FutureWarning)
+            # The row filter (prefilter) runs before the transform; the reference gets the same rows
+            kept = filter_rows(df, detect_columns(source_columns(df)))
+            expected = to_csv_bytes(legacy_transform_frame(kept.copy(), 1001, invoice_date))
+            actual = to_csv_bytes(transform_frame(df.copy(), 1001, invoice_date))
+        failures += report_case(name, expected, actual)
+    return failures
+
+def report_case(name, expected, actual):
+    """Print whether two CSVs match (with the first differing line); return 1 on a mismatch"""
+    if expected == actual:
+        print(f"PASS  {name}")
+        return 0
+    print(f"FAIL  {name}")
+    expected_lines = expected.decode('utf-8-sig').splitlines()
+    actual_lines = actual.decode('utf-8-sig').splitlines()
+    for expected_line, actual_line in zip(expected_lines, actual_lines):
+        if expected_line != actual_line:
+            print(f"  expected: {expected_line}")
+            print(f"  actual:   {actual_line}")
+            break
+    return 1
+
+def batch_reports(folder):
+    """Write per-branch CSV reports where some orders have no ID, so descriptions use the invoice number"""
+    paths = []
+    for i, (rows, customers) in enumerate([(40, 6), (25, 4), (60, 9)]):
+        df = make_report(rows, customers, seed=10 + i)
+        df['ID'] = df['ID'].astype(object)
+        df.loc[df.index % 3 == 0, 'ID'] = ''
+        path = os.path.join(folder, f"branch_{i}.csv")
+        df.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+def sequential_conversion(paths, start_invoice_number, invoice_date):
+    """Convert reports one after the other, each starting after the previous one's last invoice"""
+    frames = []
+    for path in paths:
+        df = transform_data(path, start_invoice_number, invoice_date)
+        start_invoice_number += df['*InvoiceNo'].nunique()
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+def check_batch_parity():
+    """A batch must give the lines of converting its reports one after the other"""
+    import batch
+    
+    invoice_date = datetime(2024, 4, 1)
+    failures = 0
+    # Parsed reports are not spilled next to the app while checking
+    dataset.configure(cache_dir='')
+    with tempfile.TemporaryDirectory() as folder:
+        paths = batch_reports(folder)
+        expected = to_csv_bytes(sequential_conversion(paths, 1001, invoice_date))
+        for workers in (1, 2):
+            results = batch.convert_batch(paths, 1001, invoice_date, max_workers=workers)
+            actual = to_csv_bytes(pd.concat([df for _, df in results], ignore_index=True))
+            failures += report_case(f"batch with missing order ids ({workers} workers)", expected, actual)
+    return failures
+
+def check_streaming_parity():
+    """A CSV converted chunk by chunk must give the lines transform_data gives for the whole file"""
+    from streaming import stream_transform_csv
+    
+    invoice_date = datetime(2024, 4, 1)
+    dataset.configure(cache_dir='')
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'report.csv')
+        # Numeric IDs with blanks make the whole file's ID column float, which
+        # every chunk must follow (chunks without a blank would read integers)
+        df = make_report(300, 12, seed=3, dirty_ratio=0.1)
+        df['ID'] = pd.Series(np.arange(10000, 10300), dtype=object).where(df.index % 40 != 7, '')
+        df.to_csv(path, index=False)
+        expected = to_csv_bytes(transform_data(path, 1001, invoice_date))
+        output_path = os.path.join(folder, 'streamed.csv')
+        with contextlib.redirect_stdout(io.StringIO()):
+            stream_transform_csv(path, output_path, 1001, invoice_date, chunksize=17)
+        with open(output_path, 'rb') as f:
+            actual = f.read()
+    return report_case("streamed csv with blank order ids", expected, actual)
+
+def check_review_edits():
+    """Quantities typed in the review grid must reach the CSV as typed, whatever the column's dtype"""
+    from grid import apply_edits
+    
+    df = transform_frame(make_report(20, 4), 1001, datetime(2024, 4, 1))
+    expected_df = df.copy()
+    expected_df['ItemQuantity'] = expected_df['ItemQuantity'].astype('int64')
+    expected_df.loc[[2, 5], 'ItemQuantity'] = [300, 70000]
+    with warnings.catch_warnings():
+        # Setting a value the column cannot hold only warns in this pandas
+        warnings.simplefilter('error', FutureWarning)
+        apply_edits(df, [{'row': 2, 'field': 'ItemQuantity', 'value': '300'},
+                         {'row': 5, 'field': 'ItemQuantity', 'value': '70000'}])
+    return report_case("review edit of a quantity above 127", to_csv_bytes(expected_df), to_csv_bytes(df))
+
+def check_batch_ledger():
+    """A batch numbered by the invoice ledger must carry the issued numbers in its descriptions too"""
+    from jobs import batch_job
+    from ledger import InvoiceLedger
+    
+    invoice_date = datetime(2024, 4, 1)
+    dataset.configure(cache_dir='')
+    with tempfile.TemporaryDirectory() as folder:
+        paths = batch_reports(folder)
+        ledger_path = os.path.join(folder, 'ledger.sqlite3')
+        ledger = InvoiceLedger(ledger_path)
+        ledger.allocate('earlier-conversion', ['Someone else'] * 5)
+        start = ledger.next_number()
+        expected = to_csv_bytes(sequential_conversion(paths, start, invoice_date))
+        result = batch_job(lambda message: None, paths, None, invoice_date, False, folder,
+                           ledger_path=ledger_path)
+        with open(result['download_path'], 'rb') as f:
+            actual = f.read()
+    return report_case("batch numbered by the ledger (descriptions)", expected, actual)
+
+def benchmark(rows=100000, customers=2000):
+    """Time both implementations on a large synthetic report"""
+    df = make_report(rows, customers)
+    invoice_date = datetime(2024, 4, 1)
+    timings = {}
+    for label, func in [('reference', legacy_transform_frame), ('vectorized', transform_frame)]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func(df, 1001, invoice_date)
+            timings[label] = time.perf_counter() - start
+        print(f"{label:>10}: {timings[label]:.3f}s for {rows} rows")
+    print(f"   speedup: {timings['reference'] / timings['vectorized']:.1f}x")
+
+if __name__ == "__main__":
+    failures = check_parity() + check_batch_parity() + check_batch_ledger() + check_review_edits()
+    failures += check_streaming_parity()
+    if '--bench' in sys.argv:
+        benchmark()
+    sys.exit(1 if failures else 0)
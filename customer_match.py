@@ -0,0 +1,237 @@
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Exports spell the same customer in different ways ('Casa Azul', 'casa azul ',
+# 'Casa  Azul'). Names are compared in a normalized form (no accents, case,
+# punctuation or repeated spaces), and names that still differ are compared
+# by the Jaccard similarity of their character trigrams. Instead of comparing
+# every pair, candidates come from an inverted trigram index holding only the
+# rarest trigrams of each name (prefix filtering): two names at least
+# SIMILARITY alike always share one of those, so no match is missed while
+# the index stays small. Names with different numbers ('Casa 1', 'Casa 2')
+# are never matched.
+SIMILARITY = float(os.environ.get('QBO_NAME_SIMILARITY', 0.7))
+
+_PUNCTUATION = re.compile(r'[^\w]+')
+_DIGITS = re.compile(r'\d+')
+
+
+def normalize_name(name):
+    """
+    The form customer names are compared in: 'Café  Azul.' -> 'cafe azul'
+
+    Returns:
+        str: Name without accents, case, punctuation or repeated spaces
+    """
+    text = unicodedata.normalize('NFKD', str(name))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(_PUNCTUATION.sub(' ', text.casefold()).split())
+
+
+def _trigrams(key):
+    padded = f" {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similar_pairs(keys, threshold=SIMILARITY):
+    """
+    Find the pairs of distinct normalized names whose trigram similarity reaches threshold
+
+    Args:
+        keys (list): Distinct normalized names
+        threshold (float): Minimum Jaccard similarity of the trigram sets
+
+    Returns:
+        list: (i, j, similarity) with i < j positions in keys
+    """
+    grams = [_trigrams(key) for key in keys]
+    lengths = np.fromiter((len(g) for g in grams), dtype='int64', count=len(grams))
+    rows = pd.DataFrame({
+        'key': np.repeat(np.arange(len(keys)), lengths),
+        'gram': [gram for key_grams in grams for gram in key_grams],
+    })
+    if rows.empty:
+        return []
+
+    # Rarest trigrams first; a name's prefix is the trigrams it cannot do without
+    gram_codes, _ = pd.factorize(rows['gram'])
+    frequency = np.bincount(gram_codes)
+    rows['gram'] = gram_codes
+    rows['rank'] = frequency[gram_codes].astype('int64') * (gram_codes.max() + 1) + gram_codes
+    rows = rows.sort_values(['key', 'rank'], kind='mergesort')
+    position = rows.groupby('key').cumcount().to_numpy()
+    size = lengths[rows['key'].to_numpy()]
+    prefix = size - np.ceil(threshold * size).astype('int64') + 1
+    index = rows.loc[position < prefix, ['key', 'gram']]
+
+    candidates = index.merge(index, on='gram', suffixes=('_a', '_b'))
+    candidates = candidates[candidates['key_a'] < candidates['key_b']]
+    candidates = candidates[['key_a', 'key_b']].drop_duplicates()
+    # Sets of very different sizes cannot be alike enough
+    size_a = lengths[candidates['key_a'].to_numpy()]
+    size_b = lengths[candidates['key_b'].to_numpy()]
+    candidates = candidates[np.minimum(size_a, size_b) >= threshold * np.maximum(size_a, size_b)]
+
+    digits = [_DIGITS.findall(key) for key in keys]
+    pairs = []
+    for a, b in zip(candidates['key_a'].tolist(), candidates['key_b'].tolist()):
+        if digits[a] != digits[b]:
+            continue
+        shared = len(grams[a] & grams[b])
+        similarity = shared / (len(grams[a]) + len(grams[b]) - shared)
+        if similarity >= threshold:
+            pairs.append((a, b, similarity))
+    return pairs
+
+
+def _union_find(size, pairs):
+    """Component label (the smallest member) of every item, joining each pair"""
+    parent = list(range(size))
+
+    def find(item):
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    for a, b in pairs:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    return np.array([find(item) for item in range(size)], dtype='int64')
+
+
+def group_names(customers, aliases=None, threshold=SIMILARITY):
+    """
+    Propose which customers are spellings of the same customer
+
+    Args:
+        customers (list): Distinct customer names, in first-seen order
+        aliases (dict): Normalized name to the name it was confirmed as before
+            (see AliasStore); those names are proposed first
+        threshold (float): Minimum trigram similarity (see similar_pairs)
+
+    Returns:
+        pd.DataFrame: One row per customer with its normalized name (key), its
+        group (-1 when it has no look-alike) and the proposed name for it
+        ('' when there is nothing to propose)
+    """
+    started = time.perf_counter()
+    aliases = aliases or {}
+    keys = [normalize_name(customer) for customer in customers]
+    key_codes, distinct_keys = pd.factorize(pd.Series(keys, dtype=object))
+    groups = _union_find(len(distinct_keys), [(a, b) for a, b, _ in similar_pairs(list(distinct_keys), threshold)])
+    groups = groups[key_codes]
+    sizes = np.bincount(groups, minlength=len(distinct_keys))[groups] if len(groups) else groups
+
+    names = [str(customer) for customer in customers]
+    proposals = {}
+    for group in np.unique(groups[sizes > 1]):
+        members = np.flatnonzero(groups == group)
+        known = [aliases[keys[m]] for m in members if keys[m] in aliases]
+        if known:
+            proposals[group] = known[0]
+        else:
+            # The first spelling seen, without stray spaces
+            proposals[group] = ' '.join(names[members[0]].split())
+
+    suggestions = []
+    for i, name in enumerate(names):
+        if sizes[i] > 1:
+            suggestion = proposals[groups[i]]
+        else:
+            suggestion = aliases.get(keys[i], '')
+        suggestions.append('' if suggestion == name else suggestion)
+    logger.info("Grouped %d customer names in %.2fs: %d look-alike groups",
+                len(customers), time.perf_counter() - started, len(proposals))
+    return pd.DataFrame({
+        'key': keys,
+        'group': np.where(sizes > 1, groups, -1),
+        'suggestion': suggestions,
+    })
+
+
+class AliasStore:
+    """
+    Remembers the name each spelling of a customer was confirmed as
+
+    Spellings are stored in normalized form, so a later upload that spells a
+    customer in any of the ways seen before gets the confirmed name proposed
+    (and filled in) automatically.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS aliases (
+                key TEXT PRIMARY KEY, name TEXT NOT NULL, updated REAL NOT NULL)""")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections must not be shared with forked worker processes
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def lookup(self, keys):
+        """
+        Confirmed names of the given normalized names
+
+        Returns:
+            dict: Normalized name to confirmed name, for the known ones
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        conn = self._connect()
+        # Stay under SQLite's limit on query parameters
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ', '.join('?' * len(batch))
+            found.update(conn.execute(f"SELECT key, name FROM aliases WHERE key IN ({placeholders})", batch))
+        return found
+
+    def remember(self, customers, names, now=None):
+        """
+        Record the names customers were confirmed as
+
+        A customer kept under its own name forgets any earlier alias, so a
+        proposal the user turned down is not filled in again.
+
+        Args:
+            customers (list): Original customer names
+            names (list): The name each was confirmed as
+        """
+        now = now or time.time()
+        renamed, kept = [], []
+        for customer, name in zip(customers, names):
+            key = normalize_name(customer)
+            if not key:
+                continue
+            if ' '.join(str(name).split()) != ' '.join(str(customer).split()):
+                renamed.append((key, str(name), now))
+            else:
+                kept.append(key)
+        # A spelling renamed elsewhere in the list wins over one kept as it is
+        kept = [(key,) for key in set(kept) - {row[0] for row in renamed}]
+        conn = self._connect()
+        with conn:
+            conn.executemany("DELETE FROM aliases WHERE key = ?", kept)
+            conn.executemany("""INSERT INTO aliases (key, name, updated) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET name = excluded.name, updated = excluded.updated""", renamed)
+        logger.debug("Remembered %d customer aliases", len(renamed))
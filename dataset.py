@@ -0,0 +1,270 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import metrics
+from schema import detect_columns
+
+logger = logging.getLogger(__name__)
+
+# Parsed frames are shared by every step of the upload flow (validation,
+# customer extraction and transformation), so each workbook is only parsed
+# once. Frames handed out by load_dataset() must be treated as read-only.
+# The readers (and pandas) are imported on first use, so configuring the cache
+# stays cheap for importers that never load a file.
+CACHE_DIR = os.environ.get(
+    'QBO_DATASET_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataset_cache')
+)
+MAX_ENTRIES = int(os.environ.get('QBO_DATASET_CACHE_ENTRIES', 8))
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+# Called with the path of each new spill file (the app registers them for expiry)
+_on_spill = None
+
+_cache = OrderedDict()
+_headers = OrderedDict()
+_hashes = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def configure(cache_dir=None, max_entries=None, on_spill=None):
+    """
+    Change where parsed frames are spilled to disk and how many are kept in memory
+
+    Args:
+        cache_dir (str): Directory for the on-disk columnar spill, '' to disable it, or None to keep the current one
+        max_entries (int): Maximum number of frames kept in the in-memory LRU
+        on_spill (callable): Called with the path of every file written to the spill
+    """
+    global CACHE_DIR, MAX_ENTRIES, _on_spill
+    if on_spill is not None:
+        _on_spill = on_spill
+    if cache_dir is not None:
+        CACHE_DIR = cache_dir
+    if max_entries is not None:
+        MAX_ENTRIES = max_entries
+        with _cache_lock:
+            while len(_cache) > MAX_ENTRIES:
+                _cache.popitem(last=False)
+
+
+def file_hash(file_path):
+    """
+    Compute the SHA-256 hash of a file's contents
+
+    The digest is remembered for as long as the file's size and modification
+    time do not change, so repeated lookups of an upload do not re-read it.
+
+    Args:
+        file_path (str): Path to the file
+
+    Returns:
+        str: Hex digest of the file contents
+    """
+    stat = os.stat(file_path)
+    stamp = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _cache_lock:
+        digest = _hashes.get(stamp)
+    if digest is not None:
+        return digest
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    with _cache_lock:
+        _hashes[stamp] = digest
+        while len(_hashes) > MAX_ENTRIES * 4:
+            _hashes.popitem(last=False)
+    return digest
+
+
+def source_columns(df):
+    """
+    Return the full header of the file a dataset was read from
+
+    Datasets only hold the columns that have a role, so column detection must
+    run on the original header to give the same answer as it did on upload.
+    """
+    return df.attrs.get('source_columns', df.columns.tolist())
+
+
+def _header(key, file_path):
+    with _cache_lock:
+        columns = _headers.get(key)
+    if columns is None:
+        from readers import read_header
+        columns = read_header(file_path)
+        with _cache_lock:
+            _headers[key] = columns
+            while len(_headers) > MAX_ENTRIES * 4:
+                _headers.popitem(last=False)
+    return columns
+
+
+def _spill_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.feather")
+
+
+def _spill(key, df):
+    """Write a parsed frame to the on-disk cache so other workers can reuse it"""
+    if not CACHE_DIR:
+        return
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return
+    path = _spill_path(key)
+    if os.path.exists(path):
+        return
+    # Write to a temporary name first so readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.reset_index(drop=True).to_feather(tmp_path)
+        os.replace(tmp_path, path)
+        if _on_spill is not None:
+            _on_spill(path)
+    except Exception as e:
+        # Mixed-type object columns and non-string headers cannot be stored
+        # as Arrow; the in-memory cache still works for them
+        logger.debug("Could not spill dataset %s to disk: %s", key, e)
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+def _load_spilled(key):
+    if not CACHE_DIR:
+        return None
+    path = _spill_path(key)
+    if not os.path.exists(path):
+        return None
+    import numpy as np
+    import pandas as pd
+    try:
+        df = pd.read_feather(path)
+    except Exception as e:
+        logger.debug("Could not load spilled dataset %s: %s", key, e)
+        return None
+    # Arrow returns None for missing strings; the readers produce NaN
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
+
+
+def _remember(key, df):
+    with _cache_lock:
+        _cache[key] = df
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)
+
+
+def _dataset_key(file_path):
+    """Return the cache key, header, loaded columns and column profile of a file"""
+    content_hash = file_hash(file_path)
+    columns = _header(content_hash, file_path)
+    profile = detect_columns(columns)
+    wanted = {col for col in profile.values() if col is not None}
+    usecols = [col for col in columns if col in wanted]
+
+    # A different column selection (e.g. a newly pinned mapping) is a different dataset
+    selection = hashlib.sha256(repr(usecols).encode('utf-8')).hexdigest()[:16]
+    return f"{content_hash}-{selection}", columns, usecols, profile
+
+
+def result_key(file_path, name):
+    """
+    Return the cache key of a result derived from a file's contents
+
+    The key covers the file's content hash and its column profile, so a
+    result is recomputed when either changes (e.g. after a mapping is pinned).
+
+    Args:
+        file_path (str): Path to the Excel or CSV file
+        name (str): Name and version of the result, e.g. 'invoice-lines-v1'
+
+    Returns:
+        str: Key for cached_frame
+    """
+    key, _, _, profile = _dataset_key(file_path)
+    roles = hashlib.sha256(repr(sorted(profile.items())).encode('utf-8')).hexdigest()[:16]
+    return f"{key}-{name}-{roles}"
+
+
+def cached_frame(key, build):
+    """
+    Return the frame cached under key, building and caching it on a miss
+
+    Uses the same in-memory LRU and on-disk spill as load_dataset.
+
+    Args:
+        key (str): Cache key, see result_key
+        build (callable): Called with no arguments to compute the frame
+
+    Returns:
+        pd.DataFrame: The cached frame (shared, do not modify in place)
+    """
+    with _cache_lock:
+        df = _cache.get(key)
+        if df is not None:
+            _cache.move_to_end(key)
+            logger.debug("Result cache hit for %s", key)
+            return df
+
+    df = _load_spilled(key)
+    if df is None:
+        df = build()
+        _spill(key, df)
+    _remember(key, df)
+    return df
+
+
+def load_dataset(file_path):
+    """
+    Return the parsed contents of a file, parsing it at most once per content hash
+
+    Only the columns that have a role (see schema.detect_columns) are loaded.
+    Frames are looked up in the in-memory LRU first, then in the on-disk spill,
+    and only parsed when neither has them.
+
+    Args:
+        file_path (str): Path to the Excel or CSV file
+
+    Returns:
+        pd.DataFrame: Parsed file contents (shared, do not modify in place)
+    """
+    key, columns, usecols, _ = _dataset_key(file_path)
+
+    with _cache_lock:
+        df = _cache.get(key)
+        if df is not None:
+            _cache.move_to_end(key)
+            logger.debug("Dataset cache hit for %s", file_path)
+            return df
+
+    with metrics.timed('read'):
+        df = _load_spilled(key)
+        if df is not None:
+            logger.debug("Loaded %s from dataset spill", file_path)
+        else:
+            from readers import read_file
+            df = read_file(file_path, usecols=usecols)
+            _spill(key, df)
+    df.attrs['source_columns'] = columns
+    _remember(key, df)
+    return df
+
+
+def clear_cache():
+    """Drop every frame from the in-memory cache"""
+    with _cache_lock:
+        _cache.clear()
+        _headers.clear()
+        _hashes.clear()
@@ -0,0 +1,163 @@
+import os
+import zlib
+import logging
+import zipfile
+
+from flask import Response, send_file
+
+logger = logging.getLogger(__name__)
+
+# Downloads are sent while they are produced instead of being written out
+# first: a reviewed conversion is read back from the session a slice of
+# rows at a time and turned into CSV text slice by slice (see
+# transformer.iter_csv), so the first bytes leave at once and memory stays
+# at one slice however many lines there are. A gzip or ZIP copy is
+# compressed on the way out the same way.
+#
+# Files already written by a background conversion (streamed conversions,
+# batches) are handed to the front server when one is configured: nginx with
+# an internal location and accel_prefix (X-Accel-Redirect), or any server
+# that understands X-Sendfile through Flask's USE_X_SENDFILE. Either way no
+# gunicorn worker is held for the length of the download.
+CHUNK_ROWS = int(os.environ.get('QBO_DOWNLOAD_CHUNK_ROWS', 20000))
+FILE_BLOCK_SIZE = 1 << 20
+
+# Compressed variants: file name suffix and mimetype
+COMPRESSIONS = {
+    'gzip': ('.gz', 'application/gzip'),
+    'zip': ('.zip', 'application/zip'),
+}
+
+
+def frame_slices(load_slice, num_rows, edits=(), chunk_rows=CHUNK_ROWS):
+    """
+    Read a stored frame a slice of rows at a time, with cell edits laid over each slice
+
+    Args:
+        load_slice (callable): Takes start and stop rows, returns that slice
+            indexed by row number (as session stores' load_frame does)
+        num_rows (int): Rows in the stored frame
+        edits (list): {row, field, value} edits (see grid.apply_edits)
+        chunk_rows (int): Rows per slice
+
+    Yields:
+        pd.DataFrame: Consecutive slices (a single empty one for an empty frame)
+    """
+    from grid import apply_edits
+
+    # Each slice only goes through its own edits
+    slice_edits = {}
+    for edit in edits:
+        slice_edits.setdefault(edit['row'] // chunk_rows, []).append(edit)
+    for start in range(0, max(num_rows, 1), chunk_rows):
+        yield apply_edits(load_slice(start, start + chunk_rows), slice_edits.get(start // chunk_rows, []))
+
+
+def read_file(path, block_size=FILE_BLOCK_SIZE):
+    """Yield a file's bytes a block at a time"""
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return
+            yield block
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress a stream of bytes into a gzip file as it goes"""
+    # wbits 31: deflate with a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _Pipe:
+    """Write end of a ZIP archive being streamed; what ZipFile writes waits here until it is sent"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def zip_chunks(chunks, member_name):
+    """
+    Put a stream of bytes into a ZIP archive as its only file, as it goes
+
+    The pipe cannot seek, so ZipFile writes the member's sizes and CRC after
+    its data (a data descriptor), which every unzip tool reads.
+    """
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        # The size is not known up front; allow members over 4GB
+        with archive.open(member_name, 'w', force_zip64=True) as member:
+            for chunk in chunks:
+                member.write(chunk)
+                data = pipe.take()
+                if data:
+                    yield data
+    yield pipe.take()
+
+
+def stream_response(chunks, filename, mimetype, compress=None):
+    """
+    Send bytes as an attachment while they are produced
+
+    Args:
+        chunks (iterable): The file's bytes, piece by piece
+        filename (str): Download name of the uncompressed file
+        mimetype (str): Mimetype of the uncompressed file
+        compress (str): None, or a key of COMPRESSIONS
+
+    Returns:
+        Response: Streamed response, without a Content-Length
+    """
+    if compress == 'gzip':
+        chunks = gzip_chunks(chunks)
+    elif compress == 'zip':
+        chunks = zip_chunks(chunks, filename)
+    if compress:
+        suffix, mimetype = COMPRESSIONS[compress]
+        filename += suffix
+    response = Response(chunks, mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    # Let nginx pass each piece on instead of buffering the whole response
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def send_stored(path, filename, mimetype, accel_prefix=None):
+    """
+    Send a file from the download folder, through the front server when it can
+
+    Args:
+        path (str): The file
+        filename (str): Download name
+        mimetype (str): Mimetype of the file
+        accel_prefix (str): Internal nginx location serving the download
+            folder, to answer with an X-Accel-Redirect to it; None to send
+            the file from here (or with X-Sendfile when USE_X_SENDFILE is set)
+
+    Returns:
+        Response: The file, or the redirect for nginx to serve it
+    """
+    if not accel_prefix:
+        return send_file(path, mimetype=mimetype, as_attachment=True, download_name=filename)
+    response = Response(mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + os.path.basename(path)
+    logger.debug("Handing %s to the front server", path)
+    return response
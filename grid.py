@@ -0,0 +1,231 @@
+import re
+import math
+
+import numpy as np
+import pandas as pd
+
+# Server side of the review grid: Tabulator's remote pagination sends the page,
+# page size, sorters and header filters as query parameters, e.g.
+#   ?page=2&size=15&sort[0][field]=*Customer&sort[0][dir]=asc
+#    &filter[0][field]=ItemDescription&filter[0][type]=like&filter[0][value]=villa
+# and expects {"last_page": N, "data": [...]} back.
+
+ROW_ID = '_row'
+DEFAULT_PAGE_SIZE = 15
+MAX_PAGE_SIZE = 500
+
+_PARAM_PATTERN = re.compile(r'^(sort|filter)\[(\d+)\]\[(\w+)\]$')
+
+
+def parse_grid_params(args):
+    """
+    Read Tabulator's remote pagination parameters from a request's query string
+
+    Args:
+        args (MultiDict): Query parameters (request.args)
+
+    Returns:
+        dict: page (1-based), size, sorters [{field, dir}] and filters [{field, type, value}]
+    """
+    grouped = {'sort': {}, 'filter': {}}
+    for name, value in args.items():
+        match = _PARAM_PATTERN.match(name)
+        if match:
+            kind, position, attribute = match.groups()
+            grouped[kind].setdefault(int(position), {})[attribute] = value
+
+    try:
+        page = max(int(args.get('page', 1)), 1)
+        size = min(max(int(args.get('size', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        raise ValueError("Page and size must be whole numbers")
+    return {
+        'page': page,
+        'size': size,
+        'sorters': [grouped['sort'][i] for i in sorted(grouped['sort'])],
+        'filters': [grouped['filter'][i] for i in sorted(grouped['filter'])],
+    }
+
+
+def _as_text(series):
+    return series.astype(object).where(series.notna(), '').astype(str)
+
+
+def _filter_mask(series, filter_type, value):
+    if filter_type in ('<', '<=', '>', '>='):
+        numbers = pd.to_numeric(series, errors='coerce')
+        try:
+            value = float(value)
+        except ValueError:
+            return pd.Series(False, index=series.index)
+        return {'<': numbers < value, '<=': numbers <= value,
+                '>': numbers > value, '>=': numbers >= value}[filter_type]
+
+    text = _as_text(series)
+    value = '' if value is None else str(value)
+    if filter_type == '=':
+        return text == value
+    if filter_type == '!=':
+        return text != value
+    lowered, value = text.str.lower(), value.lower()
+    if filter_type == 'starts':
+        return lowered.str.startswith(value)
+    if filter_type == 'ends':
+        return lowered.str.endswith(value)
+    # 'like', the header filter default: case-insensitive substring
+    return lowered.str.contains(value, regex=False)
+
+
+def query_rows(df, sorters=(), filters=()):
+    """
+    Apply header filters and sorters to a frame
+
+    Args:
+        df (pd.DataFrame): The sort and filter columns of the stored frame
+        sorters (list): [{field, dir}] in priority order
+        filters (list): [{field, type, value}]
+
+    Returns:
+        np.ndarray: Row numbers of the matching rows, in display order
+    """
+    mask = np.ones(len(df), dtype=bool)
+    for f in filters:
+        if f.get('field') in df.columns and f.get('value') not in (None, ''):
+            mask &= _filter_mask(df[f['field']], f.get('type', 'like'), f['value']).to_numpy(dtype=bool)
+    matching = df[mask]
+
+    sorters = [s for s in sorters if s.get('field') in df.columns]
+    if sorters:
+        keys = matching[[s['field'] for s in sorters]]
+        # Categorical columns sort in category (first-seen) order; the grid sorts by value
+        categorical = [col for col in keys.columns if isinstance(keys[col].dtype, pd.CategoricalDtype)]
+        if categorical:
+            keys = keys.astype({col: object for col in categorical})
+        matching = keys.sort_values(
+            by=list(keys.columns),
+            ascending=[s.get('dir', 'asc') != 'desc' for s in sorters],
+            kind='mergesort', na_position='last'
+        )
+    return matching.index.to_numpy()
+
+
+def page_count(total_rows, size):
+    return max(math.ceil(total_rows / size), 1)
+
+
+def page_records(page_df):
+    """Convert a page of the frame to JSON-safe records carrying their row id"""
+    page_df = page_df.astype(object).where(page_df.notna(), None)
+    records = page_df.to_dict('records')
+    for row, record in zip(page_df.index.tolist(), records):
+        record[ROW_ID] = row
+    return records
+
+
+def parse_edits(edits, columns, num_rows):
+    """
+    Validate the cell edits sent by the grid
+
+    Args:
+        edits (list): [{row, field, value}] as posted by the review page
+        columns (list): Columns of the stored frame
+        num_rows (int): Number of rows in the stored frame
+
+    Returns:
+        list: The edits, with row numbers as ints
+    """
+    if not isinstance(edits, list):
+        raise ValueError("Edits must be a list of {row, field, value} objects")
+    parsed = []
+    for edit in edits:
+        try:
+            row, field, value = int(edit['row']), edit['field'], edit.get('value')
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Invalid edit: {edit!r}")
+        if not 0 <= row < num_rows:
+            raise ValueError(f"Edited row {row} does not exist")
+        if field not in columns:
+            raise ValueError(f"Edited column '{field}' does not exist")
+        parsed.append({'row': row, 'field': field, 'value': value})
+    return parsed
+
+
+def merge_edits(saved, new):
+    """Combine two lists of edits; a later edit to the same cell replaces the earlier one"""
+    merged = {(edit['row'], edit['field']): edit for edit in saved}
+    for edit in new:
+        merged[(edit['row'], edit['field'])] = edit
+    return list(merged.values())
+
+
+def relabel_edits(invoice_numbers, names, field='*Customer'):
+    """
+    Edits that give renamed invoices their new customer name
+
+    Only the first line of an invoice carries the customer (the others are
+    blank), so there is one edit per renamed invoice and no other row is touched.
+
+    Args:
+        invoice_numbers (pd.Series): The *InvoiceNo column of the stored frame
+        names (dict): Invoice number to new customer name
+
+    Returns:
+        list: [{row, field, value}]
+    """
+    numbers = invoice_numbers.to_numpy()
+    first_lines = ~invoice_numbers.duplicated().to_numpy() & np.isin(numbers, list(names))
+    return [{'row': int(row), 'field': field, 'value': names[numbers[row]]}
+            for row in np.flatnonzero(first_lines)]
+
+
+def _fits(value, dtype):
+    limits = np.iinfo(dtype)
+    return limits.min <= value <= limits.max
+
+
+def _set_cell(df, row, field, value):
+    column = df[field]
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # New values must become categories before they can be assigned
+        if value is not None and value not in column.cat.categories:
+            try:
+                df[field] = column.cat.add_categories([value])
+            except (TypeError, ValueError):
+                df[field] = column.astype(object)
+    elif pd.api.types.is_numeric_dtype(column.dtype) and not pd.api.types.is_bool_dtype(column.dtype):
+        # Grid editors return text; keep numeric columns numeric when the value allows it
+        empty = value is None or value == ''
+        number = np.nan if empty else pd.to_numeric(value, errors='coerce')
+        if pd.notna(number) or empty:
+            value = number
+            if pd.api.types.is_integer_dtype(column.dtype) and (pd.isna(number) or number != int(number)):
+                # Leave the other rows' whole numbers as they are written
+                df[field] = column.astype(object)
+            elif pd.api.types.is_integer_dtype(column.dtype):
+                value = int(number)
+                if isinstance(column.dtype, np.dtype) and not _fits(value, column.dtype):
+                    # Small integer columns (quantities are int8) are widened, not overflowed
+                    df[field] = column.astype('int64') if _fits(value, np.dtype('int64')) else column.astype(object)
+        else:
+            df[field] = column.astype(object)
+    df.at[row, field] = np.nan if value is None else value
+
+
+def apply_edits(df, edits):
+    """
+    Apply cell edits to a frame (or a slice of it indexed by row number), in place
+
+    Edits for rows or columns the frame does not hold are skipped, so the same
+    list can be laid over a single page or the whole frame.
+
+    Args:
+        df (pd.DataFrame): Frame indexed by stored row number
+        edits (list): [{row, field, value}]
+
+    Returns:
+        pd.DataFrame: The same frame
+    """
+    for edit in edits:
+        if edit['field'] in df.columns and edit['row'] in df.index:
+            _set_cell(df, edit['row'], edit['field'], edit['value'])
+    return df
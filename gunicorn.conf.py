@@ -0,0 +1,27 @@
+import os
+
+# Gunicorn settings for the QBO Invoice Converter:
+#   gunicorn -c gunicorn.conf.py app:app
+bind = os.environ.get('QBO_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('QBO_WORKERS', 3))
+
+# Conversions run in background job processes, so requests are short; the
+# timeout only has to cover uploads and page loads
+timeout = int(os.environ.get('QBO_WORKER_TIMEOUT', 120))
+
+# With QBO_PRELOAD=1 the master imports the app and pandas once and the
+# workers share those pages instead of each importing them on first use.
+# The app opens no files or threads at import, so this is safe to fork.
+preload_app = os.environ.get('QBO_PRELOAD', '0') == '1'
+
+
+def on_starting(server):
+    if preload_app:
+        import app
+        app.preload_modules()
+
+
+def post_worker_init(worker):
+    # Set up logging, folders and the background reaper before the first request
+    import app
+    app.init_app()
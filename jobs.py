@@ -0,0 +1,359 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+import order_history
+
+logger = logging.getLogger(__name__)
+
+# Long-running conversions run in a pool of worker processes so they never
+# hold a web worker for the whole run. Job status is kept in one small JSON
+# file per job, so whichever web worker receives a poll can answer it.
+# The conversion modules are imported by the job functions, in the worker.
+JOBS_DIR = os.environ.get(
+    'QBO_JOBS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'session_data', 'jobs')
+)
+# 0 runs jobs inline in the submitting request (useful for debugging and tests)
+MAX_WORKERS = int(os.environ.get('QBO_JOB_WORKERS', 2))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def configure(jobs_dir=None, max_workers=None):
+    """
+    Change where job status is kept and how many worker processes run jobs
+
+    Args:
+        jobs_dir (str): Directory for job status files
+        max_workers (int): Size of the process pool, or 0 to run jobs inline
+    """
+    global JOBS_DIR, MAX_WORKERS
+    if jobs_dir is not None:
+        JOBS_DIR = jobs_dir
+    if max_workers is not None:
+        MAX_WORKERS = max_workers
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=MAX_WORKERS)
+        return _executor
+
+
+def status_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def _write_status(job_id, status):
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    path = status_path(job_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+
+
+def read_status(job_id):
+    """
+    Return the status of a job
+
+    Returns:
+        dict: state ('queued', 'running', 'done' or 'failed'), message, session_id,
+        and result or error once finished; None for an unknown job id
+    """
+    try:
+        with open(status_path(job_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _run(jobs_dir, metrics_dir, history_db, job_id, status, func, args):
+    """Run a job in the worker process, recording its progress and outcome"""
+    configure(jobs_dir=jobs_dir)
+    metrics.configure(metrics_dir=metrics_dir)
+    order_history.configure(db_path=history_db)
+
+    def report(message):
+        status.update(state='running', message=message, updated=time.time())
+        _write_status(job_id, status)
+
+    report("Starting")
+    try:
+        status.update(state='done', message="Finished", result=func(report, *args))
+    except Exception as e:
+        logger.error("Job %s failed: %s", job_id, e)
+        status.update(state='failed', message="Failed", error=str(e))
+    status['updated'] = time.time()
+    _write_status(job_id, status)
+    # Make this job's stage timings visible to the /metrics endpoint
+    metrics.flush(force=True)
+
+
+def submit(func, *args, session_id=None):
+    """
+    Queue a job and return its id at once
+
+    Args:
+        func (callable): Module-level function called as func(report, *args);
+            report(message) publishes progress, the return value (JSON-safe) is the result
+        session_id (str): Session the job belongs to; only it may read the status
+
+    Returns:
+        str: Job id
+    """
+    job_id = uuid.uuid4().hex
+    status = {'state': 'queued', 'message': "Waiting for a worker", 'session_id': session_id,
+              'created': time.time(), 'updated': time.time()}
+    _write_status(job_id, status)
+    if MAX_WORKERS == 0:
+        _run(JOBS_DIR, metrics.METRICS_DIR, order_history.HISTORY_DB, job_id, status, func, args)
+    else:
+        future = _get_executor().submit(_run, JOBS_DIR, metrics.METRICS_DIR, order_history.HISTORY_DB,
+                                        job_id, status, func, args)
+        future.add_done_callback(lambda f: _check_crashed(f, job_id, status))
+    return job_id
+
+
+def _check_crashed(future, job_id, status):
+    """Mark a job failed if its worker process died before it could say so"""
+    global _executor
+    error = future.exception()
+    if error is None:
+        return
+    logger.error("Job %s worker crashed: %s", job_id, error)
+    status.update(state='failed', message="Failed", error=f"The conversion worker stopped unexpectedly: {error}",
+                  updated=time.time())
+    _write_status(job_id, status)
+    # A broken pool refuses new work; start a fresh one on the next submit
+    with _executor_lock:
+        _executor = None
+
+
+def transform_job(report, store_config, session_id, file_path, start_invoice_number, invoice_date,
+                  name_mapping=None, streaming=False, download_folder=None, ledger_path=None,
+                  skip_billed=False):
+    """
+    Convert an upload to QBO format in a worker process
+
+    Regular uploads are saved to the session store for review; large CSVs are
+    streamed straight to a file in download_folder. Only the confirmed
+    customers (the keys of name_mapping) are converted.
+
+    When the same file was already converted with the same start number and
+    date and the same customers are confirmed, only the names changed: those
+    invoices are renamed with review edits on their first lines instead of
+    converting again, and earlier review edits are kept.
+
+    Lines whose order was exported before are counted (see order_history),
+    and the review page flags them; with skip_billed they are left out of
+    regular uploads before invoices are numbered.
+
+    With a ledger (see ledger.InvoiceLedger) the session's invoice numbers are
+    taken as one block first: from start_invoice_number, or from the next
+    free number when it is None.
+
+    Args:
+        report (callable): Progress callback supplied by the job runner
+        store_config (tuple): (backend, location) of the session store
+        session_id (str): Session to save the transformed frame to
+        file_path (str): Path to the uploaded file
+        start_invoice_number (int): Starting invoice number, None for the ledger's next free one
+        invoice_date (datetime): Date for the invoices
+        name_mapping (dict): Original to confirmed customer names
+        streaming (bool): Stream the conversion straight to a download file
+        download_folder (str): Where streamed conversions are written
+        ledger_path (str): Invoice number ledger database, None to not record the numbers
+        skip_billed (bool): Leave out the lines whose order was exported before
+
+    Returns:
+        dict: Line, invoice and already billed line counts and the start number,
+        plus the download file for streamed conversions (or the number of renamed invoices)
+    """
+    from transformer import (load_prepared_lines, drop_billed_lines, number_customers, number_invoice_lines,
+                             prepared_key, ORDER_ID)
+    from streaming import stream_transform_csv
+    from session_store import create_store
+
+    prepared = None
+    if not streaming:
+        report("Reading and converting file")
+        try:
+            prepared = load_prepared_lines(file_path)
+            if skip_billed:
+                prepared = drop_billed_lines(prepared)
+        except Exception as e:
+            raise ValueError(f"Error transforming data: {str(e)}")
+
+    if ledger_path:
+        from ledger import InvoiceLedger
+
+        # Customers confirmed under the same name share an invoice, numbered
+        # in the order the customers were first seen in the file
+        if prepared is not None:
+            customers = number_customers(prepared, 0, name_mapping, confirmed_only=True)
+            names = customers.loc[customers['invoice_no'] >= 0, 'name']
+        else:
+            names = (name_mapping or {}).values()
+        invoice_customers = list(dict.fromkeys(str(name) for name in names))
+        start_invoice_number = InvoiceLedger(ledger_path).allocate(session_id, invoice_customers,
+                                                                   start_invoice_number)
+        report(f"Invoice numbers {start_invoice_number}-{start_invoice_number + len(invoice_customers) - 1}")
+
+    if streaming:
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        output_filename = f'quickbooks_import_{timestamp}.csv'
+        output_path = os.path.join(download_folder, output_filename)
+        report("Converting large file")
+        stats = stream_transform_csv(file_path, output_path, start_invoice_number, invoice_date,
+                                     name_mapping=name_mapping, confirmed_only=True,
+                                     progress=lambda lines: report(f"Converted {lines} invoice lines"))
+        return dict(stats, start=start_invoice_number, download_path=output_path,
+                    download_filename=output_filename)
+
+    try:
+        # Kept so the next conversion can tell whether only names changed. The
+        # customers are in first-seen order, so the lists line up while the
+        # file (its cache key) stays the same
+        customers = number_customers(prepared, start_invoice_number, name_mapping, confirmed_only=True)
+    except Exception as e:
+        raise ValueError(f"Error transforming data: {str(e)}")
+    numbering = {
+        # Lines left out as billed make a different frame from the same file
+        'file': prepared_key(file_path) + ('-unbilled' if skip_billed else ''),
+        'start': start_invoice_number,
+        'date': invoice_date.strftime('%Y-%m-%d'),
+        'invoice_no': customers['invoice_no'].tolist(),
+        'names': [str(name) for name in customers['name']],
+    }
+    store = create_store(*store_config)
+    previous = store.load_value(session_id, 'invoice_customers')
+    if previous is not None and store.frame_length(session_id, 'transformed_df') is None:
+        previous = None
+    invoices = int(customers['invoice_no'][customers['invoice_no'] >= 0].nunique())
+
+    if invoices and previous is not None and all(previous.get(key) == numbering[key]
+                                                 for key in ('file', 'start', 'date', 'invoice_no')):
+        from grid import relabel_edits, merge_edits
+
+        renamed = {number: name for number, name, old_name
+                   in zip(numbering['invoice_no'], numbering['names'], previous['names'])
+                   if number >= 0 and name != old_name}
+        if renamed:
+            report(f"Renaming {len(renamed)} invoices")
+            invoice_numbers = store.load_frame(session_id, 'transformed_df', columns=['*InvoiceNo'])['*InvoiceNo']
+            edits = merge_edits(store.load_value(session_id, 'review_edits', []),
+                                relabel_edits(invoice_numbers, renamed))
+            store.save_value(session_id, 'review_edits', edits)
+            store.save_value(session_id, 'invoice_customers', numbering)
+        logger.info("Renamed %d invoices without converting again", len(renamed))
+        billed = _check_billed(store, session_id, store.load_frame(session_id, 'transformed_df', columns=[ORDER_ID]))
+        return {'lines': store.frame_length(session_id, 'transformed_df'), 'invoices': invoices,
+                'start': start_invoice_number, 'renamed': len(renamed), 'billed': billed}
+
+    try:
+        transformed_df = number_invoice_lines(prepared, start_invoice_number, invoice_date, name_mapping,
+                                              confirmed_only=True)
+    except Exception as e:
+        raise ValueError(f"Error transforming data: {str(e)}")
+    report(f"Saving {len(transformed_df)} invoice lines")
+    store.save_frame(session_id, 'transformed_df', transformed_df)
+    store.save_value(session_id, 'review_edits', [])
+    store.save_value(session_id, 'invoice_customers', numbering)
+    billed = _check_billed(store, session_id, transformed_df)
+    return {'lines': len(transformed_df), 'invoices': int(transformed_df['*InvoiceNo'].nunique()),
+            'start': start_invoice_number, 'billed': billed}
+
+
+def _check_billed(store, session_id, lines):
+    """
+    Count the lines whose order was exported before
+
+    The history's version is kept in the session (as 'billed_version'), so
+    the review page flags these lines and not the ones exported later from
+    this same review.
+    """
+    from transformer import ORDER_ID
+
+    history = order_history.get_history()
+    if history is None or lines is None or ORDER_ID not in lines.columns:
+        return 0
+    version = history.version()
+    billed = int((history.billed(lines[ORDER_ID], before=version) >= 0).sum())
+    store.save_value(session_id, 'billed_version', version if billed else None)
+    if billed:
+        logger.warning("%d lines bill orders that were exported before", billed)
+    return billed
+
+
+def batch_job(report, file_paths, start_invoice_number, invoice_date, per_file, download_folder,
+              cleanup_folder=None, ledger_path=None):
+    """
+    Convert a batch of uploads (or ZIP archives of them) in a worker process
+
+    Args:
+        report (callable): Progress callback supplied by the job runner
+        file_paths (list): Uploaded Excel, CSV or ZIP files
+        start_invoice_number (int): First invoice number of the batch, None for the ledger's next free one
+        invoice_date (datetime): Date for the invoices
+        per_file (bool): Produce a ZIP with one CSV per report instead of one merged CSV
+        download_folder (str): Where the result is written
+        cleanup_folder (str): Folder holding the uploads, removed once the batch has been read
+        ledger_path (str): Invoice number ledger database, None to not record the numbers
+
+    Returns:
+        dict: File, line and invoice counts, and the download file
+    """
+    import batch
+
+    try:
+        with tempfile.TemporaryDirectory(dir=download_folder) as extract_dir:
+            reports = batch.expand_inputs(file_paths, extract_dir)
+            report(f"Converting {len(reports)} files")
+            prepared = batch.prepare_batch(
+                reports, progress=lambda done: report(f"Converted {done} of {len(reports)} files")
+            )
+    finally:
+        if cleanup_folder:
+            shutil.rmtree(cleanup_folder, ignore_errors=True)
+
+    if ledger_path:
+        from ledger import InvoiceLedger
+
+        # The number of invoices is only known once the files are read; the
+        # block is taken before numbering, so descriptions that fall back to
+        # the invoice number use the issued numbers
+        start_invoice_number = InvoiceLedger(ledger_path).allocate(
+            f"batch-{uuid.uuid4().hex}", batch.invoice_customers(prepared), start_invoice_number)
+    elif start_invoice_number is None:
+        start_invoice_number = 0
+    results = batch.number_batch(reports, prepared, start_invoice_number, invoice_date)
+
+    report("Writing output")
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    if per_file:
+        output_filename = f'quickbooks_import_{timestamp}.zip'
+        output_path = os.path.join(download_folder, output_filename)
+        batch.write_zip(results, output_path)
+    else:
+        output_filename = f'quickbooks_import_{timestamp}.csv'
+        output_path = os.path.join(download_folder, output_filename)
+        batch.write_merged(results, output_path)
+
+    stats = batch.summarize(results)
+    last_number = start_invoice_number + stats['invoices'] - 1
+    message = (f"Converted {stats['files']} files: {stats['invoices']} invoices "
+               f"({start_invoice_number}-{last_number}), {stats['lines']} lines.")
+    return dict(stats, download_path=output_path, download_filename=output_filename, message=message)
@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Invoice numbers issued by earlier conversions. Every conversion takes one
+# block of consecutive numbers in a single write transaction, so two workers
+# converting at the same time never get overlapping blocks, and a start
+# number typed by hand is checked against every block issued before.
+# Blocks never overlap, so ordered by their last number they are also
+# ordered by their first; both the next free number and the overlap check
+# are one index lookup however long the history grows.
+DEFAULT_START = int(os.environ.get('QBO_FIRST_INVOICE_NUMBER', 1001))
+
+
+class InvoiceLedger:
+    """
+    Records the blocks of invoice numbers conversions used, and the customer of each invoice
+
+    A block belongs to a source (a session, a batch); converting the same
+    source again gives its earlier block back before taking a new one, so
+    going back to change the date or the customers does not use up numbers.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS blocks (
+            id INTEGER PRIMARY KEY, source TEXT NOT NULL UNIQUE,
+            first INTEGER NOT NULL, last INTEGER NOT NULL, created REAL NOT NULL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS blocks_last ON blocks (last)")
+        conn.execute("""CREATE TABLE IF NOT EXISTS invoices (
+            invoice_no INTEGER PRIMARY KEY, customer TEXT NOT NULL, block INTEGER NOT NULL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS invoices_customer ON invoices (customer, invoice_no)")
+        conn.execute("CREATE INDEX IF NOT EXISTS invoices_block ON invoices (block)")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections must not be shared with forked worker processes
+        if conn is None or self._local.pid != os.getpid():
+            # Transactions are begun explicitly (see allocate)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _next_free(conn, default):
+        last = conn.execute("SELECT MAX(last) FROM blocks").fetchone()[0]
+        return default if last is None else max(default, last + 1)
+
+    def next_number(self, default=DEFAULT_START):
+        """The first invoice number no conversion has used yet"""
+        return self._next_free(self._connect(), default)
+
+    def allocate(self, source, customers, start=None, now=None):
+        """
+        Take a block of invoice numbers, one per customer, in one transaction
+
+        Args:
+            source (str): What the block is for (a session or batch id); its
+                earlier block, if any, is given back first
+            customers (list): Customer name of each invoice, in invoice order
+            start (int): First number of the block, or None for the next free number
+
+        Returns:
+            int: First number of the block
+
+        Raises:
+            ValueError: If the block would overlap one issued before
+        """
+        now = now or time.time()
+        conn = self._connect()
+        # Taking the write lock up front keeps the read of the free numbers
+        # and the insert of the block together across processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            previous = conn.execute("SELECT id FROM blocks WHERE source = ?", (source,)).fetchone()
+            if previous is not None:
+                conn.execute("DELETE FROM invoices WHERE block = ?", previous)
+                conn.execute("DELETE FROM blocks WHERE id = ?", previous)
+            if start is None:
+                start = self._next_free(conn, DEFAULT_START)
+            last = start + len(customers) - 1
+            if customers:
+                clash = conn.execute("SELECT first, last, created FROM blocks WHERE last >= ? ORDER BY last LIMIT 1",
+                                     (start,)).fetchone()
+                if clash is not None and clash[0] <= last:
+                    issued = datetime.fromtimestamp(clash[2]).strftime('%Y-%m-%d')
+                    raise ValueError(
+                        f"Invoice numbers {start}-{last} overlap invoices {clash[0]}-{clash[1]} issued on "
+                        f"{issued}. The next free invoice number is {self._next_free(conn, DEFAULT_START)}."
+                    )
+                block = conn.execute("INSERT INTO blocks (source, first, last, created) VALUES (?, ?, ?, ?)",
+                                     (source, start, last, now)).lastrowid
+                conn.executemany("INSERT INTO invoices (invoice_no, customer, block) VALUES (?, ?, ?)",
+                                 ((start + i, str(customer), block) for i, customer in enumerate(customers)))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        logger.info("Allocated invoice numbers %d-%d to %s", start, last, source)
+        return start
+
+    def customer_invoices(self, customer, limit=None):
+        """
+        Invoice numbers issued to a customer, newest first
+
+        Returns:
+            list: Invoice numbers
+        """
+        query = "SELECT invoice_no FROM invoices WHERE customer = ? ORDER BY invoice_no DESC"
+        params = (str(customer),)
+        if limit is not None:
+            query += " LIMIT ?"
+            params += (int(limit),)
+        return [row[0] for row in self._connect().execute(query, params)]
+
+    def invoice(self, invoice_no):
+        """
+        The customer and block of an issued invoice number
+
+        Returns:
+            dict: customer, source, first, last and created of its block, or None if it was not issued
+        """
+        row = self._connect().execute(
+            """SELECT invoices.customer, blocks.source, blocks.first, blocks.last, blocks.created
+               FROM invoices JOIN blocks ON blocks.id = invoices.block WHERE invoices.invoice_no = ?""",
+            (int(invoice_no),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('customer', 'source', 'first', 'last', 'created'), row))
+
+    def blocks(self, limit=20):
+        """The most recent blocks, newest first: (source, first, last, created)"""
+        return self._connect().execute(
+            "SELECT source, first, last, created FROM blocks ORDER BY last DESC LIMIT ?", (limit,)).fetchall()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show the invoice numbers issued by earlier conversions")
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'invoice_ledger.sqlite3'),
+                        help="Ledger database (default: invoice_ledger.sqlite3 next to this script)")
+    parser.add_argument('--invoice', type=int, help="Show who an invoice number was issued to")
+    parser.add_argument('--customer', help="List the invoice numbers issued to a customer")
+    args = parser.parse_args(argv)
+
+    ledger = InvoiceLedger(args.db)
+    if args.invoice is not None:
+        found = ledger.invoice(args.invoice)
+        if found is None:
+            print(f"Invoice {args.invoice} was not issued")
+            return 1
+        issued = datetime.fromtimestamp(found['created']).strftime('%Y-%m-%d %H:%M')
+        print(f"Invoice {args.invoice}: {found['customer']} (block {found['first']}-{found['last']}, {issued})")
+    elif args.customer is not None:
+        for number in ledger.customer_invoices(args.customer):
+            print(number)
+    else:
+        for source, first, last, created in ledger.blocks():
+            print(f"{first}-{last}  {datetime.fromtimestamp(created):%Y-%m-%d %H:%M}  {source}")
+        print(f"Next free invoice number: {ledger.next_number()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
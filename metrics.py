@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Per-stage timings of the conversion hot path (read, detect, filter,
+# transform, number, blank, serialize; 'filter' and 'transform' are skipped
+# when a file's prepared lines come from the result cache). Every process
+# keeps its own totals; conversions run in job worker processes, so each
+# process also writes its totals to a small JSON file in METRICS_DIR and the
+# /metrics endpoint adds them all up.
+STAGES = ('read', 'detect', 'filter', 'transform', 'number', 'blank', 'serialize')
+# Totals also hold, under this key, the memory used by the frames a
+# conversion builds: frame kind -> {'count', 'bytes', 'max'} (see observe_memory)
+MEMORY = 'memory'
+METRICS_DIR = None
+# Minimum seconds between writes of this process's totals
+FLUSH_INTERVAL = 5
+
+_lock = threading.Lock()
+_stats = {}
+_pid = None
+_token = None
+_last_flush = 0.0
+
+
+def configure(metrics_dir=None):
+    """
+    Keep per-process totals in metrics_dir so they can be added up across processes
+
+    Args:
+        metrics_dir (str): Directory for the totals files, or None to keep them in memory only
+    """
+    global METRICS_DIR
+    METRICS_DIR = metrics_dir
+
+
+def _check_fork():
+    # A forked worker starts with a copy of its parent's totals; count from zero instead
+    global _stats, _pid, _token, _last_flush
+    if _pid != os.getpid():
+        _stats = {}
+        _pid = os.getpid()
+        _token = f"{_pid}-{uuid.uuid4().hex[:8]}"
+        _last_flush = 0.0
+
+
+def observe(stage, seconds):
+    """Record one run of a stage that took the given number of seconds"""
+    with _lock:
+        _check_fork()
+        stat = _stats.get(stage)
+        if stat is None:
+            stat = _stats[stage] = {'count': 0, 'seconds': 0.0, 'max': 0.0}
+        stat['count'] += 1
+        stat['seconds'] += seconds
+        stat['max'] = max(stat['max'], seconds)
+    logger.debug("stage=%s seconds=%.4f", stage, seconds)
+
+
+def observe_memory(frame, nbytes):
+    """Record the in-memory size of one frame of the given kind (e.g. 'qbo_frame')"""
+    with _lock:
+        _check_fork()
+        _add_memory(_stats.setdefault(MEMORY, {}), {frame: {'count': 1, 'bytes': nbytes, 'max': nbytes}})
+    logger.debug("frame=%s bytes=%d", frame, nbytes)
+
+
+@contextmanager
+def timed(stage):
+    """
+    Time the enclosed block as a run of stage
+
+        with metrics.timed('serialize'):
+            df.to_csv(path)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def snapshot():
+    """
+    Return this process's totals
+
+    Returns:
+        dict: stage -> {'count', 'seconds', 'max'}, and MEMORY -> frame -> {'count', 'bytes', 'max'}
+    """
+    with _lock:
+        _check_fork()
+        return _copy(_stats)
+
+
+def drain():
+    """
+    Return this process's totals and start again from zero
+
+    Worker processes that only live for one task use this to hand their
+    timings back to the parent (see merge) instead of writing a file.
+    """
+    global _stats
+    with _lock:
+        _check_fork()
+        stats, _stats = _stats, {}
+        return stats
+
+
+def merge(stats):
+    """Add totals from another process (as returned by drain) to this process's"""
+    with _lock:
+        _check_fork()
+        _add(_stats, stats)
+
+
+def _copy(stats):
+    copied = {stage: dict(stat) for stage, stat in stats.items() if stage != MEMORY}
+    if MEMORY in stats:
+        copied[MEMORY] = {frame: dict(stat) for frame, stat in stats[MEMORY].items()}
+    return copied
+
+
+def _add_memory(totals, stats):
+    for frame, stat in stats.items():
+        total = totals.setdefault(frame, {'count': 0, 'bytes': 0, 'max': 0})
+        total['count'] += stat['count']
+        total['bytes'] += stat['bytes']
+        total['max'] = max(total['max'], stat['max'])
+
+
+def _add(totals, stats):
+    for stage, stat in stats.items():
+        if stage == MEMORY:
+            _add_memory(totals.setdefault(MEMORY, {}), stat)
+            continue
+        total = totals.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+        total['count'] += stat['count']
+        total['seconds'] += stat['seconds']
+        total['max'] = max(total['max'], stat['max'])
+
+
+def flush(force=False):
+    """Write this process's totals to METRICS_DIR (at most every FLUSH_INTERVAL seconds)"""
+    global _last_flush
+    if not METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < FLUSH_INTERVAL:
+        return
+    stats = snapshot()
+    if not stats:
+        return
+    _last_flush = now
+    path = os.path.join(METRICS_DIR, f"{_token}.json")
+    tmp_path = f"{path}.tmp"
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(stats, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.debug("Could not write metrics to %s: %s", path, e)
+
+
+def collect():
+    """
+    Add up the totals of this process and every process that wrote to METRICS_DIR
+
+    Returns:
+        dict: stage -> {'count', 'seconds', 'max'}
+    """
+    totals = snapshot()
+    own_file = f"{_token}.json"
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        for filename in os.listdir(METRICS_DIR):
+            if not filename.endswith('.json') or filename == own_file:
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, filename), 'r', encoding='utf-8') as f:
+                    stats = json.load(f)
+            except (OSError, ValueError):
+                continue
+            _add(totals, stats)
+    return totals
+
+
+def render(stats):
+    """Format stage totals in the Prometheus text format"""
+    lines = [
+        "# HELP qbo_stage_seconds Time spent in each conversion stage",
+        "# TYPE qbo_stage_seconds summary",
+    ]
+    stages = list(STAGES) + sorted(set(stats) - set(STAGES) - {MEMORY})
+    for stage in stages:
+        stat = stats.get(stage, {'count': 0, 'seconds': 0.0})
+        lines.append(f'qbo_stage_seconds_count{{stage="{stage}"}} {stat["count"]}')
+        lines.append(f'qbo_stage_seconds_sum{{stage="{stage}"}} {stat["seconds"]:.6f}')
+    lines.append("# HELP qbo_stage_seconds_max Longest single run of each conversion stage")
+    lines.append("# TYPE qbo_stage_seconds_max gauge")
+    for stage in stages:
+        lines.append(f'qbo_stage_seconds_max{{stage="{stage}"}} {stats.get(stage, {}).get("max", 0.0):.6f}')
+    memory = stats.get(MEMORY, {})
+    lines.append("# HELP qbo_frame_bytes Memory used by the frames conversions build")
+    lines.append("# TYPE qbo_frame_bytes summary")
+    for frame in sorted(memory):
+        lines.append(f'qbo_frame_bytes_count{{frame="{frame}"}} {memory[frame]["count"]}')
+        lines.append(f'qbo_frame_bytes_sum{{frame="{frame}"}} {memory[frame]["bytes"]}')
+    lines.append("# HELP qbo_frame_bytes_max Largest frame of each kind")
+    lines.append("# TYPE qbo_frame_bytes_max gauge")
+    for frame in sorted(memory):
+        lines.append(f'qbo_frame_bytes_max{{frame="{frame}"}} {memory[frame]["max"]}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,275 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Order IDs of every invoice line already exported, so an order is not billed
+# twice (e.g. in consecutive months). The IDs live in SQLite; each process
+# also keeps a sorted array of their 64-bit hashes (with the invoice each was
+# billed on), brought up to date with just the rows recorded since it last
+# looked. A file's IDs are checked against it with one vectorized
+# searchsorted, an anti-join that stays well under a second against
+# millions of exported orders.
+#
+# Exports are recorded wherever the QBO CSV is written (save_to_csv, the
+# streamed conversion and per-file ZIPs) once configure() was given a
+# database. Already billed lines are flagged on the review page, which can
+# convert the file again without them (transformer.drop_billed_lines); with
+# the skip_billed_orders filter rule (see prefilter) they are always dropped.
+# pandas is imported on first use, so configuring the history stays cheap.
+HISTORY_DB = None
+
+_histories = {}
+_histories_lock = threading.Lock()
+_FLOAT_ID = re.compile(r'^(\d+)\.0+$')
+
+
+def configure(db_path=None):
+    """
+    Record exports in, and check order IDs against, the history in db_path
+
+    Args:
+        db_path (str): History database, or None to not keep a history
+    """
+    global HISTORY_DB
+    HISTORY_DB = db_path
+
+
+def get_history():
+    """The configured OrderHistory (one per process), or None when there is none"""
+    if not HISTORY_DB:
+        return None
+    with _histories_lock:
+        history = _histories.get(HISTORY_DB)
+        if history is None or history.pid != os.getpid():
+            history = _histories[HISTORY_DB] = OrderHistory(HISTORY_DB)
+        return history
+
+
+def normalize_ids(order_ids):
+    """
+    The form order IDs are compared in: text without surrounding spaces, '1000.0' read as '1000'
+
+    Returns:
+        np.ndarray: Object array of strings ('' where there is no order ID)
+    """
+    import numpy as np
+    import pandas as pd
+
+    values = pd.Series(order_ids, dtype=object).fillna('').astype(str).str.strip()
+    # Only IDs with a dot can be numbers read as floats
+    dotted = values.str.contains('.', regex=False).to_numpy()
+    if dotted.any():
+        values[dotted] = values[dotted].str.replace(_FLOAT_ID, r'\1', regex=True)
+    return np.asarray(values, dtype=object)
+
+
+def _hashes(ids):
+    import numpy as np
+    import pandas as pd
+
+    return pd.util.hash_array(np.asarray(ids, dtype=object), categorize=False)
+
+
+class OrderHistory:
+    """
+    Every exported order ID with the invoice it was billed on
+
+    Rows are numbered in the order they were recorded (seq), which lets a
+    check be limited to what was exported up to some point (see billed).
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.pid = os.getpid()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Hash index: sorted hashes, with the invoice and seq of each
+        self._index = None
+        self._seen = 0
+        conn = self._connect()
+        with conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS orders (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, order_id TEXT NOT NULL UNIQUE,
+                hash INTEGER NOT NULL, invoice_no INTEGER, exported REAL NOT NULL)""")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections must not be shared with forked worker processes
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def version(self):
+        """Sequence number of the last recorded order (0 for an empty history)"""
+        return self._connect().execute("SELECT COALESCE(MAX(seq), 0) FROM orders").fetchone()[0]
+
+    def count(self):
+        """Number of orders in the history"""
+        return self._connect().execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    def _refresh(self):
+        """Add the orders recorded since the last look to the in-memory hash index"""
+        import numpy as np
+
+        with self._lock:
+            if self._index is None:
+                self._index = tuple(np.empty(0, dtype=dtype) for dtype in ('uint64', 'int64', 'int64'))
+                self._seen = 0
+            rows = self._connect().execute(
+                "SELECT hash, COALESCE(invoice_no, -1), seq FROM orders WHERE seq > ? ORDER BY seq",
+                (self._seen,)).fetchall()
+            if rows:
+                added = np.array(rows, dtype='int64')
+                self._seen = int(added[-1, 2])
+                added_hashes = added[:, 0].view('uint64')
+                added = added[np.argsort(added_hashes, kind='stable')]
+                added_hashes = added[:, 0].view('uint64')
+                hashes, invoices, seqs = self._index
+                # Both are sorted; inserting keeps the index sorted without a full sort
+                positions = np.searchsorted(hashes, added_hashes)
+                self._index = (np.insert(hashes, positions, added_hashes),
+                               np.insert(invoices, positions, added[:, 1]),
+                               np.insert(seqs, positions, added[:, 2]))
+            return self._index
+
+    def billed(self, order_ids, before=None):
+        """
+        Find the order IDs that were already exported
+
+        The check is a searchsorted of the IDs' 64-bit hashes in the index,
+        without a query per ID; two different IDs sharing a hash is
+        vanishingly unlikely (about one in 10^7 for a million-line file
+        against ten million exported orders).
+
+        Args:
+            order_ids (array-like): Order IDs of some invoice lines ('' or NaN where missing)
+            before (int): Only count orders recorded up to this version
+
+        Returns:
+            np.ndarray: Invoice number each line's order was billed on, -1 where it was not
+        """
+        import numpy as np
+        import pandas as pd
+
+        codes, uniques = pd.factorize(normalize_ids(order_ids))
+        invoices = np.full(len(uniques), -1, dtype='int64')
+        present = np.flatnonzero(uniques != '')
+        hashes, billed_on, seqs = self._refresh()
+        if len(present) and len(hashes):
+            wanted = _hashes(uniques[present])
+            positions = np.minimum(np.searchsorted(hashes, wanted), len(hashes) - 1)
+            found = hashes[positions] == wanted
+            if before is not None:
+                found &= seqs[positions] <= before
+            invoices[present[found]] = billed_on[positions[found]]
+        return invoices[codes] if len(codes) else invoices
+
+    def record(self, order_ids, invoice_numbers, now=None):
+        """
+        Record exported invoice lines; an order already recorded keeps its first invoice
+
+        Returns:
+            int: Number of orders new to the history
+        """
+        import numpy as np
+        import pandas as pd
+
+        ids = normalize_ids(order_ids)
+        numbers = np.asarray(invoice_numbers)
+        keep = ids != ''
+        if not keep.any():
+            return 0
+        lines = pd.DataFrame({'order_id': ids[keep], 'invoice_no': numbers[keep]}).drop_duplicates('order_id')
+        hashes = _hashes(lines['order_id'].to_numpy()).view('int64')
+        now = now or time.time()
+        conn = self._connect()
+        with conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO orders (order_id, hash, invoice_no, exported) VALUES (?, ?, ?, ?)",
+                zip(lines['order_id'].tolist(), hashes.tolist(), lines['invoice_no'].astype('int64').tolist(),
+                    [now] * len(lines)))
+            added = conn.total_changes - before
+        logger.info("Recorded %d exported orders (%d already billed)", added, len(lines) - added)
+        return added
+
+    def order(self, order_id):
+        """
+        When an order was exported
+
+        Returns:
+            dict: invoice_no and exported (timestamp), or None if it was not exported
+        """
+        row = self._connect().execute("SELECT invoice_no, exported FROM orders WHERE order_id = ?",
+                                      (normalize_ids([order_id])[0],)).fetchone()
+        return None if row is None else {'invoice_no': row[0], 'exported': row[1]}
+
+    def forget(self, order_ids):
+        """Remove orders from the history (e.g. an export that was never imported)"""
+        ids = [(order_id,) for order_id in normalize_ids(order_ids) if order_id]
+        conn = self._connect()
+        with conn:
+            conn.executemany("DELETE FROM orders WHERE order_id = ?", ids)
+        with self._lock:
+            # Rebuild the index on the next check
+            self._index = None
+
+
+def record_export(qbo_df):
+    """
+    Record the order IDs of invoice lines being exported, when a history is configured
+
+    Args:
+        qbo_df (pd.DataFrame): QBO lines with their ORDER_ID column (see transformer)
+    """
+    from transformer import ORDER_ID
+
+    history = get_history()
+    if history is None or ORDER_ID not in qbo_df.columns:
+        return
+    try:
+        history.record(qbo_df[ORDER_ID], qbo_df['*InvoiceNo'].to_numpy())
+    except sqlite3.Error as e:
+        logger.warning("Could not record exported orders: %s", e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Look up or forget exported order IDs")
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'order_history.sqlite3'),
+                        help="History database (default: order_history.sqlite3 next to this script)")
+    parser.add_argument('--forget', action='store_true', help="Remove the given orders from the history")
+    parser.add_argument('orders', nargs='*', help="Order IDs")
+    args = parser.parse_args(argv)
+
+    history = OrderHistory(args.db)
+    if args.forget:
+        history.forget(args.orders)
+        print(f"Forgot {len(args.orders)} orders")
+        return 0
+    if not args.orders:
+        print(f"{history.count()} orders recorded")
+        return 0
+    for order_id in args.orders:
+        found = history.order(order_id)
+        if found is None:
+            print(f"{order_id}: not exported")
+        else:
+            exported = datetime.fromtimestamp(found['exported']).strftime('%Y-%m-%d %H:%M')
+            print(f"{order_id}: invoice {found['invoice_no']}, exported {exported}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+import os
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+import metrics
+import order_history
+
+logger = logging.getLogger(__name__)
+
+# Rows of a report that may become invoice lines. The same rules decide which
+# customers the confirm page lists and which rows are converted, so the two
+# always agree. Rules are compiled against a file's column profile into a
+# function returning a boolean mask, and applied once per file (the prepared
+# lines are cached, see transformer.load_prepared_lines).
+#
+#   statuses          Status values to keep (None keeps every status); reports
+#                     without a Status column are not filtered
+#   skip_zero_prices  Drop rows whose price is 0 or could not be read
+#   date_from/date_to Keep rows dated in this window (inclusive, YYYY-MM-DD);
+#                     rows without a readable date are kept
+#   skip_billed_orders
+#                     Drop rows whose order ID was exported before (needs an
+#                     order history, see order_history; otherwise they are
+#                     only flagged on the review page)
+#
+# Rows without a customer name are always dropped.
+
+# Orders with any other status are not invoiced
+VALID_STATUSES = ['Delivery', 'Production', 'Open']
+
+
+def _env_statuses():
+    value = os.environ.get('QBO_STATUSES')
+    if value is None:
+        return list(VALID_STATUSES)
+    if value.strip().lower() in ('', 'all', '*'):
+        return None
+    return [status.strip() for status in value.split(',') if status.strip()]
+
+
+RULES = {
+    'statuses': _env_statuses(),
+    'skip_zero_prices': os.environ.get('QBO_SKIP_ZERO_PRICES', '0') == '1',
+    'date_from': os.environ.get('QBO_DATE_FROM') or None,
+    'date_to': os.environ.get('QBO_DATE_TO') or None,
+    'skip_billed_orders': os.environ.get('QBO_SKIP_BILLED_ORDERS', '0') == '1',
+}
+
+
+def configure(**rules):
+    """
+    Change the filter rules (see RULES), e.g. configure(statuses=None, skip_zero_prices=True)
+
+    Rules left out keep their current value.
+    """
+    unknown = set(rules) - set(RULES)
+    if unknown:
+        raise ValueError(f"Unknown filter rules: {', '.join(sorted(unknown))}")
+    for name in ('date_from', 'date_to'):
+        if rules.get(name) is not None:
+            rules[name] = _as_day(rules[name]).strftime('%Y-%m-%d')
+    RULES.update(rules)
+
+
+def rules_key(rules=None):
+    """Short fingerprint of the rules, part of the cache key of filtered results"""
+    rules = RULES if rules is None else rules
+    text = repr(sorted((name, rules.get(name)) for name in RULES))
+    history = order_history.get_history() if rules.get('skip_billed_orders') else None
+    if history is not None:
+        # Every export changes which rows are left
+        text += f"-billed-{history.version()}"
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+
+
+def _as_day(value):
+    day = pd.Timestamp(value)
+    if pd.isna(day):
+        raise ValueError(f"Invalid date: {value!r}")
+    return day.normalize()
+
+
+def _parsed_dates(values):
+    """Parse a date column once per distinct value; NaT where a value is not a date"""
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return pd.DatetimeIndex(values)
+    codes, uniques = pd.factorize(values)
+
+    def parse(value):
+        try:
+            day = pd.Timestamp(pd.to_datetime(value))
+            return day.tz_localize(None) if day.tzinfo is not None else day
+        except Exception:
+            return pd.NaT
+
+    parsed = pd.DatetimeIndex([parse(value) for value in uniques])
+    return parsed.take(codes, allow_fill=True, fill_value=pd.NaT)
+
+
+def filter_roles(profile, rules=None):
+    """
+    The part of a column profile the rules read (for reading just those columns)
+
+    Returns:
+        dict: Role to column name, None for roles the rules do not need
+    """
+    rules = RULES if rules is None else rules
+    needed = {
+        'name': True,
+        'status': rules.get('statuses') is not None,
+        'price': bool(rules.get('skip_zero_prices')),
+        'date': bool(rules.get('date_from') or rules.get('date_to')),
+        'id': bool(rules.get('skip_billed_orders')),
+    }
+    return {role: col if needed.get(role) else None for role, col in profile.items()}
+
+
+def compile_rules(profile, rules=None):
+    """
+    Turn the rules into a mask function for files with the given column profile
+
+    Args:
+        profile (dict): Column roles, as returned by detect_columns
+        rules (dict): Rules to compile, RULES by default
+
+    Returns:
+        callable: mask(df) -> np.ndarray of the rows to keep
+    """
+    from transformer import _coerce_prices
+
+    rules = RULES if rules is None else rules
+    name_col = profile['name']
+    if not name_col:
+        raise ValueError("Could not find customer name column in the file")
+
+    predicates = [('name', lambda df: (df[name_col].notna() & (df[name_col] != '')).to_numpy())]
+    if rules.get('statuses') is not None and profile.get('status'):
+        status_col, statuses = profile['status'], list(rules['statuses'])
+        predicates.append(('status', lambda df: df[status_col].isin(statuses).to_numpy()))
+    if rules.get('skip_zero_prices') and profile.get('price'):
+        price_col = profile['price']
+        predicates.append(('price', lambda df: _coerce_prices(df[price_col]) != 0))
+    if (rules.get('date_from') or rules.get('date_to')) and profile.get('date'):
+        date_col = profile['date']
+        date_from = _as_day(rules['date_from']) if rules.get('date_from') else None
+        date_to = _as_day(rules['date_to']) if rules.get('date_to') else None
+
+        def in_window(df):
+            days = _parsed_dates(df[date_col]).normalize()
+            keep = np.asarray(days.isna(), dtype=bool)
+            inside = np.ones(len(days), dtype=bool)
+            if date_from is not None:
+                inside &= np.asarray(days >= date_from, dtype=bool)
+            if date_to is not None:
+                inside &= np.asarray(days <= date_to, dtype=bool)
+            return keep | inside
+
+        predicates.append(('date', in_window))
+    history = order_history.get_history() if rules.get('skip_billed_orders') and profile.get('id') else None
+    if history is not None:
+        id_col = profile['id']
+        predicates.append(('billed', lambda df: history.billed(df[id_col]) < 0))
+
+    def mask(df):
+        keep = np.ones(len(df), dtype=bool)
+        for name, predicate in predicates:
+            matches = predicate(df)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Filter %s drops %d rows", name, int((keep & ~matches).sum()))
+            keep &= matches
+        return keep
+
+    return mask
+
+
+def filter_rows(df, profile, rules=None):
+    """
+    Keep the rows of a report that may become invoice lines
+
+    Args:
+        df (pd.DataFrame): Report (or a chunk of one)
+        profile (dict): Column roles of the report
+        rules (dict): Rules to apply, RULES by default
+
+    Returns:
+        pd.DataFrame: The kept rows (df itself when every row is kept)
+    """
+    with metrics.timed('filter'):
+        keep = compile_rules(profile, rules)(df)
+        return df if keep.all() else df[keep]
@@ -0,0 +1,168 @@
+"""
+Convert laundry reports to a QuickBooks Online invoice CSV from the command line
+
+    python -m qbo_convert report.xlsx --start 1001 --date 2024-04-01 > import.csv
+    python -m qbo_convert north.xlsx south.csv --start 1001 --date 2024-04-01 \\
+        --names names.json -o import.csv
+
+Several reports are written to one CSV, each continuing the invoice numbers
+of the previous one. Only rows with a Delivery, Production or Open status are
+converted unless --status says otherwise (see also --skip-zero, --from and
+--to). Only the conversion modules are imported (no Flask, and no log files,
+folders or cached copies are created), and progress messages are logged to
+stderr so the CSV can be piped.
+"""
+import io
+import os
+import sys
+import csv
+import json
+import logging
+import argparse
+from datetime import datetime
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m qbo_convert',
+        description="Convert laundry reports (Excel or CSV) to a QuickBooks Online invoice CSV"
+    )
+    parser.add_argument('inputs', nargs='+', help="Excel or CSV reports, converted in the order given")
+    parser.add_argument('-s', '--start', type=int, required=True, help="First invoice number")
+    parser.add_argument('-d', '--date', required=True, help="Invoice date (YYYY-MM-DD)")
+    parser.add_argument('-n', '--names', help="Customer renames: a JSON object or a two-column CSV (original,new)")
+    parser.add_argument('-o', '--output', default='-', help="Output CSV file (default: stdout)")
+    parser.add_argument('--status', help="Comma-separated Status values to convert, or 'all' "
+                                         "(default: Delivery,Production,Open)")
+    parser.add_argument('--skip-zero', action='store_true', help="Leave out rows with a zero or unreadable price")
+    parser.add_argument('--from', dest='date_from', help="Leave out rows dated before this day (YYYY-MM-DD)")
+    parser.add_argument('--to', dest='date_to', help="Leave out rows dated after this day (YYYY-MM-DD)")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Do not print progress to stderr")
+    args = parser.parse_args(argv)
+    try:
+        args.date = datetime.strptime(args.date, '%Y-%m-%d')
+    except ValueError:
+        parser.error(f"invalid date '{args.date}', expected YYYY-MM-DD")
+    for name in ('date_from', 'date_to'):
+        value = getattr(args, name)
+        if value is not None:
+            try:
+                datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                parser.error(f"invalid date '{value}', expected YYYY-MM-DD")
+    return args
+
+
+def filter_rules(args):
+    """Row filter rules (see prefilter) set by the command line options"""
+    rules = {}
+    if args.status is not None:
+        if args.status.strip().lower() in ('', 'all'):
+            rules['statuses'] = None
+        else:
+            rules['statuses'] = [status.strip() for status in args.status.split(',') if status.strip()]
+    if args.skip_zero:
+        rules['skip_zero_prices'] = True
+    if args.date_from:
+        rules['date_from'] = args.date_from
+    if args.date_to:
+        rules['date_to'] = args.date_to
+    return rules
+
+
+def load_name_mapping(path):
+    """
+    Read customer renames from a JSON object or a two-column CSV file
+
+    Returns:
+        dict: Original to new customer names
+    """
+    if path.lower().endswith('.json'):
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            mapping = json.load(f)
+        if not isinstance(mapping, dict):
+            raise ValueError(f"{path} must contain a JSON object of original to new names")
+        return mapping
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        return {row[0]: row[1] for row in csv.reader(f) if len(row) >= 2 and row[0]}
+
+
+def open_output(path):
+    """Open the output as text that starts with a UTF-8 BOM, like save_to_csv writes"""
+    if path == '-':
+        return io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8-sig', newline='')
+    return open(path, 'w', encoding='utf-8-sig', newline='')
+
+
+def convert(inputs, output, start_invoice_number, invoice_date, name_mapping=None):
+    """
+    Convert reports one after another, appending their invoice lines to output
+
+    Args:
+        inputs (list): Paths of the reports
+        output (file): Open text file to write the QBO CSV to
+        start_invoice_number (int): First invoice number of the first report
+        invoice_date (datetime): Date for the invoices
+        name_mapping (dict): Optional original to new customer names
+
+    Returns:
+        dict: Number of lines and invoices written
+    """
+    import dataset
+    from transformer import transform_data, save_to_csv
+
+    # Each file is read once per run; do not leave spilled copies behind
+    dataset.configure(cache_dir='')
+    next_number = start_invoice_number
+    lines = 0
+    for i, file_path in enumerate(inputs):
+        df = transform_data(file_path, next_number, invoice_date, name_mapping)
+        save_to_csv(df, output, header=(i == 0))
+        output.flush()
+        next_number += df['*InvoiceNo'].nunique()
+        lines += len(df)
+    return {'lines': lines, 'invoices': next_number - start_invoice_number}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    for path in args.inputs:
+        if not os.path.isfile(path):
+            print(f"qbo_convert: error: no such file: {path}", file=sys.stderr)
+            return 2
+
+    # Progress is logged to stderr; stdout is kept for the CSV
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING if args.quiet else logging.INFO,
+                        format='%(message)s')
+    output = None
+    try:
+        import prefilter
+        prefilter.configure(**filter_rules(args))
+        name_mapping = load_name_mapping(args.names) if args.names else None
+        output = open_output(args.output)
+        stats = convert(args.inputs, output, args.start, args.date, name_mapping)
+    except Exception as e:
+        if isinstance(e, BrokenPipeError) or isinstance(e.__context__, BrokenPipeError):
+            # The reader (e.g. head) went away; that is not an error in a pipeline
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return 0
+        print(f"qbo_convert: error: {str(e)}", file=sys.stderr)
+        return 1
+    finally:
+        if output is not None:
+            if args.output == '-':
+                try:
+                    output.detach()
+                except (BrokenPipeError, ValueError):
+                    pass
+            else:
+                output.close()
+
+    if not args.quiet:
+        last = args.start + stats['invoices'] - 1
+        print(f"Wrote {stats['lines']} lines, invoices {args.start}-{last}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
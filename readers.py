@@ -0,0 +1,123 @@
+import codecs
+import logging
+import importlib.util
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Magic bytes at the start of each supported container
+XLSX_SIGNATURE = b'PK\x03\x04'  # ZIP archive (Office Open XML)
+XLS_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'  # OLE2 compound document
+
+_SNIFF_SIZE = 64 * 1024
+
+
+def _calamine_available():
+    """The Rust calamine engine is used when installed and supported by pandas (2.2+)"""
+    if importlib.util.find_spec('python_calamine') is None:
+        return False
+    major, minor = (int(part) for part in pd.__version__.split('.')[:2])
+    return (major, minor) >= (2, 2)
+
+
+def _text_encoding(sample):
+    """Return the encoding a sample of a text file decodes with, or None for binary data"""
+    if b'\x00' in sample:
+        return None
+    try:
+        # Incremental decoding tolerates a character cut off at the end of the sample
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        # Older Windows exports use a single-byte code page
+        return 'latin-1'
+
+
+def sniff_format(file_path):
+    """
+    Identify a file's real format from its content, whatever its extension says
+
+    Args:
+        file_path (str): Path to the file
+
+    Returns:
+        str: 'xlsx', 'xls' or 'csv', or None if the format is not recognized
+    """
+    with open(file_path, 'rb') as f:
+        sample = f.read(_SNIFF_SIZE)
+    if sample.startswith(XLSX_SIGNATURE):
+        return 'xlsx'
+    if sample.startswith(XLS_SIGNATURE):
+        return 'xls'
+    if sample and _text_encoding(sample):
+        return 'csv'
+    return None
+
+
+def csv_encoding(file_path):
+    """Return the encoding to read a CSV file with"""
+    with open(file_path, 'rb') as f:
+        return _text_encoding(f.read(_SNIFF_SIZE)) or 'utf-8'
+
+
+def _excel_engine(file_format):
+    if _calamine_available():
+        return 'calamine'
+    if file_format == 'xls':
+        if importlib.util.find_spec('xlrd') is None:
+            raise ValueError("Reading .xls files requires the xlrd package. Please save the file as .xlsx or CSV.")
+        return 'xlrd'
+    # pandas opens workbooks with openpyxl in read-only streaming mode
+    return 'openpyxl'
+
+
+def _detect_format(file_path):
+    file_format = sniff_format(file_path)
+    if file_format is None:
+        raise ValueError("File format not recognized. Please upload an Excel (.xlsx or .xls) or CSV file.")
+    return file_format
+
+
+def read_header(file_path):
+    """
+    Read only the column names of an Excel or CSV file
+
+    Returns:
+        list: Column names, as read_file would return them
+    """
+    file_format = _detect_format(file_path)
+    if file_format == 'csv':
+        df = pd.read_csv(file_path, nrows=0, encoding=csv_encoding(file_path))
+    else:
+        df = pd.read_excel(file_path, nrows=0, engine=_excel_engine(file_format))
+    return df.columns.tolist()
+
+
+def read_file(file_path, usecols=None):
+    """
+    Parse an Excel or CSV file with the fastest engine available for its format
+
+    The format is detected from the file content, so a CSV saved with an
+    Excel extension is read as CSV without a failed Excel attempt first.
+
+    Args:
+        file_path (str): Path to the Excel or CSV file
+        usecols (list): Optional column names to load; others are skipped
+
+    Returns:
+        pd.DataFrame: Parsed file contents
+    """
+    file_format = _detect_format(file_path)
+    try:
+        if file_format == 'csv':
+            encoding = csv_encoding(file_path)
+            logger.debug("Reading %s as CSV (%s)", file_path, encoding)
+            return pd.read_csv(file_path, usecols=usecols, encoding=encoding)
+        engine = _excel_engine(file_format)
+        logger.debug("Reading %s as %s with %s", file_path, file_format, engine)
+        return pd.read_excel(file_path, usecols=usecols, engine=engine)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"Could not read {file_format} file: {str(e)}")
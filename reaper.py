@@ -0,0 +1,234 @@
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Defaults shared by the app and the command line
+MAX_AGE_SECONDS = float(os.environ.get('QBO_REAPER_MAX_AGE_HOURS', 24)) * 3600
+MAX_BYTES = int(float(os.environ.get('QBO_REAPER_MAX_MB', 2048)) * 1024 * 1024)
+INTERVAL_SECONDS = float(os.environ.get('QBO_REAPER_INTERVAL', 600))
+
+
+class AccessTracker:
+    """
+    Records when each session, upload, download and cached dataset was last used
+
+    Entries are indexed by access time, so finding what to remove only reads
+    the expired entries instead of walking every directory.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, kind TEXT NOT NULL, session_id TEXT,
+                size INTEGER NOT NULL DEFAULT 0, accessed REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_session ON entries (session_id)")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections must not be shared with forked worker processes
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def touch_session(self, session_id, size=None, now=None):
+        """Mark a session (and every file registered to it) as used now"""
+        now = now or time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("""INSERT INTO entries (key, kind, session_id, size, accessed)
+                VALUES (?, 'session', ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET accessed = excluded.accessed,
+                    size = COALESCE(?, entries.size)""",
+                         (f"session:{session_id}", session_id, size or 0, now, size))
+            conn.execute("UPDATE entries SET accessed = ? WHERE session_id = ?", (now, session_id))
+
+    def track_file(self, path, kind, session_id=None, now=None):
+        """Register a file to be removed once it (or its session) expires"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                         (os.path.abspath(path), kind, session_id, size, now or time.time()))
+
+    def forget_session(self, session_id):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM entries WHERE kind = 'session' AND session_id = ?", (session_id,))
+
+    def expired(self, cutoff):
+        """Entries last used before cutoff, oldest first"""
+        return self._connect().execute(
+            "SELECT key, kind, session_id, size FROM entries WHERE accessed < ? ORDER BY accessed",
+            (cutoff,)).fetchall()
+
+    def oldest(self, limit):
+        return self._connect().execute(
+            "SELECT key, kind, session_id, size FROM entries ORDER BY accessed LIMIT ?", (limit,)).fetchall()
+
+    def total_size(self):
+        return self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def remove(self, key):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+
+def _delete_entry(tracker, entry, delete_session):
+    """Delete an entry's data and stop tracking it; False (still tracked) when that failed"""
+    key, kind, session_id, size = entry
+    try:
+        if kind == 'session':
+            delete_session(session_id)
+        elif os.path.exists(key):
+            os.unlink(key)
+    except Exception as e:
+        logger.error("Error removing %s %s: %s", kind, key, e)
+        return False
+    tracker.remove(key)
+    return True
+
+
+def reap(tracker, delete_session, max_age=MAX_AGE_SECONDS, max_bytes=MAX_BYTES, now=None):
+    """
+    Remove expired sessions and files, then the oldest ones while over the size quota
+
+    Args:
+        tracker (AccessTracker): Access index
+        delete_session (callable): Removes a session's stored data, given its id
+        max_age (float): Seconds since last use after which an entry is removed
+        max_bytes (int): Total size of tracked data to stay under, or None
+        now (float): Current time, for testing
+
+    Entries that could not be removed stay tracked, so the next run tries again.
+
+    Returns:
+        dict: Number of entries and bytes removed
+    """
+    now = now or time.time()
+    removed = freed = 0
+    failed = set()
+    for entry in tracker.expired(now - max_age):
+        if _delete_entry(tracker, entry, delete_session):
+            freed += entry[3]
+            removed += 1
+        else:
+            failed.add(entry[0])
+
+    if max_bytes is not None:
+        total = tracker.total_size()
+        while total > max_bytes:
+            # Entries that failed are still the oldest; look past them
+            batch = [entry for entry in tracker.oldest(len(failed) + 100) if entry[0] not in failed]
+            if not batch:
+                break
+            for entry in batch:
+                if total <= max_bytes:
+                    break
+                if _delete_entry(tracker, entry, delete_session):
+                    total -= entry[3]
+                    freed += entry[3]
+                    removed += 1
+                else:
+                    failed.add(entry[0])
+
+    if removed:
+        logger.info("Reaper removed %d entries (%d bytes)", removed, freed)
+    if failed:
+        logger.warning("Reaper could not remove %d entries; they are kept for the next run", len(failed))
+    return {'removed': removed, 'bytes': freed}
+
+
+def scan(tracker, folders):
+    """
+    Register files that are not tracked yet (e.g. left over from older versions),
+    using their modification time as the last access
+    """
+    conn = tracker._connect()
+    registered = 0
+    for kind, folder in folders.items():
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            path = os.path.abspath(os.path.join(folder, name))
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            known = conn.execute("SELECT 1 FROM entries WHERE key = ?", (path,)).fetchone()
+            if not known:
+                tracker.track_file(path, kind, now=os.path.getmtime(path))
+                registered += 1
+    return registered
+
+
+def start_background_reaper(tracker, delete_session, interval=INTERVAL_SECONDS,
+                            max_age=MAX_AGE_SECONDS, max_bytes=MAX_BYTES):
+    """
+    Run reap() every interval seconds in a daemon thread
+
+    Returns:
+        threading.Thread: The started thread
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                reap(tracker, delete_session, max_age, max_bytes)
+            except Exception as e:
+                logger.error("Error in background reaper: %s", e)
+
+    thread = threading.Thread(target=run, name='qbo-reaper', daemon=True)
+    thread.start()
+    return thread
+
+
+def main(argv=None):
+    """Command-line entry point, suitable for a cron job"""
+    from session_store import create_store
+
+    parser = argparse.ArgumentParser(description="Remove expired QBO converter sessions, uploads and downloads")
+    parser.add_argument('--max-age-hours', type=float, default=MAX_AGE_SECONDS / 3600)
+    parser.add_argument('--max-size-mb', type=float, default=MAX_BYTES / (1024 * 1024))
+    parser.add_argument('--scan', action='store_true',
+                        help="Also register untracked files in uploads/, downloads/ and dataset_cache/")
+    args = parser.parse_args(argv)
+
+    session_folder = os.path.join(BASE_DIR, 'session_data')
+    backend = os.environ.get('QBO_SESSION_BACKEND', 'feather')
+    store = create_store(backend, os.path.join(session_folder, 'sessions.sqlite3') if backend == 'sqlite' else session_folder)
+    tracker = AccessTracker(os.path.join(session_folder, 'access.sqlite3'))
+
+    if args.scan:
+        registered = scan(tracker, {
+            'upload': os.path.join(BASE_DIR, 'uploads'),
+            'download': os.path.join(BASE_DIR, 'downloads'),
+            'dataset': os.path.join(BASE_DIR, 'dataset_cache'),
+        })
+        print(f"Registered {registered} untracked files")
+
+    stats = reap(tracker, store.delete_session, args.max_age_hours * 3600, int(args.max_size_mb * 1024 * 1024))
+    print(f"Removed {stats['removed']} entries, freed {stats['bytes'] / (1024 * 1024):.1f}MB")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import logging
+import threading
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Column roles used by the transformer, with the exact header names tried
+# first and the substrings searched for (case-insensitively) after that
+ROLE_RULES = {
+    'name': (['Name', 'Customer', 'Client', 'Account'], ['name', 'customer']),
+    'price': (['Price', 'Amount', 'Total', 'Value', 'Cost'], ['price', 'amount', 'total', 'value']),
+    'date': (['Date', 'Service Date', 'Cleaning Date', 'Invoice Date'], ['date']),
+    'id': (['ID', 'Id', 'Order', 'Order ID', 'Invoice', 'Ref'], ['id', 'order', 'ref']),
+    'house': (['House', 'Address', 'Location', 'Property', 'Apartment'], ['house', 'address', 'location', 'property']),
+    'note': (['Note', 'Notes', 'Comment', 'Comments', 'Description'], ['note', 'comment', 'description']),
+    'status': (['Status'], []),
+}
+ROLES = list(ROLE_RULES)
+
+# Pinned mappings let a known export layout skip detection entirely
+MAPPINGS_FILE = os.environ.get(
+    'QBO_COLUMN_MAPPINGS',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'column_mappings.json')
+)
+
+_pinned = {}
+_pinned_mtime = None
+_pinned_lock = threading.Lock()
+
+
+def configure(mappings_file=None):
+    """
+    Change where pinned column mappings are stored
+
+    Args:
+        mappings_file (str): Path to the JSON file holding pinned mappings
+    """
+    global MAPPINGS_FILE, _pinned_mtime
+    if mappings_file is not None:
+        with _pinned_lock:
+            MAPPINGS_FILE = mappings_file
+            _pinned.clear()
+            _pinned_mtime = None
+
+
+def header_signature(columns):
+    """Return the hashable signature identifying a source layout"""
+    return tuple(str(col) for col in columns)
+
+
+@lru_cache(maxsize=256)
+def _detect(signature):
+    columns = list(signature)
+    profile = {}
+    for role, (exact_names, keywords) in ROLE_RULES.items():
+        found = None
+        for possible in exact_names:
+            if possible in columns:
+                found = possible
+                break
+        if not found:
+            # Try case-insensitive search
+            for col in columns:
+                if any(keyword in col.lower() for keyword in keywords):
+                    found = col
+                    break
+        profile[role] = found
+
+    # Fall back to the usual positions of the name and order ID columns
+    if not profile['name'] and len(columns) > 1:
+        profile['name'] = columns[1]
+    if not profile['id'] and len(columns) > 0:
+        profile['id'] = columns[0]
+    return profile
+
+
+def _load_pinned():
+    """Reload the pinned mappings when the file changed (possibly in another worker)"""
+    global _pinned_mtime
+    try:
+        mtime = os.path.getmtime(MAPPINGS_FILE)
+    except OSError:
+        _pinned.clear()
+        _pinned_mtime = None
+        return _pinned
+    if mtime != _pinned_mtime:
+        try:
+            with open(MAPPINGS_FILE, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except Exception as e:
+            logger.error("Error loading column mappings from %s: %s", MAPPINGS_FILE, e)
+            entries = []
+        _pinned.clear()
+        for entry in entries:
+            _pinned[header_signature(entry['columns'])] = entry['roles']
+        _pinned_mtime = mtime
+    return _pinned
+
+
+def detect_columns(columns):
+    """
+    Work out which input column plays each role (name, price, date, id, house, note, status)
+
+    Detection only looks at the header, so the result is cached per header
+    signature, and a pinned mapping for the layout takes precedence over it.
+
+    Args:
+        columns (list): Column names of the input file
+
+    Returns:
+        dict: Role to column name, with None for roles that were not found
+    """
+    signature = header_signature(columns)
+    with _pinned_lock:
+        pinned = _load_pinned().get(signature)
+    if pinned is not None:
+        profile = dict.fromkeys(ROLES)
+        profile.update(pinned)
+    else:
+        profile = dict(_detect(signature))
+
+    # Hand back the original column labels (they are not always strings)
+    labels = {str(col): col for col in columns}
+    return {role: labels.get(col, col) if col is not None else None
+            for role, col in profile.items()}
+
+
+def pin_mapping(columns, roles):
+    """
+    Save the role mapping to use for every file with this exact header
+
+    Args:
+        columns (list): Column names of the source layout
+        roles (dict): Role to column name; roles left out are treated as absent
+
+    Returns:
+        dict: The complete profile that was pinned
+    """
+    signature = header_signature(columns)
+    unknown_roles = set(roles) - set(ROLES)
+    if unknown_roles:
+        raise ValueError(f"Unknown column roles: {', '.join(sorted(unknown_roles))}")
+    missing = [col for col in roles.values() if col is not None and str(col) not in signature]
+    if missing:
+        raise ValueError(f"Columns not in the file header: {', '.join(map(str, missing))}")
+
+    profile = dict.fromkeys(ROLES)
+    profile.update({role: str(col) if col is not None else None for role, col in roles.items()})
+    with _pinned_lock:
+        pinned = dict(_load_pinned())
+        pinned[signature] = profile
+        _write_pinned(pinned)
+    return profile
+
+
+def unpin_mapping(columns):
+    """
+    Remove the pinned mapping for a layout so its columns are detected again
+
+    Returns:
+        bool: True if a mapping was removed
+    """
+    signature = header_signature(columns)
+    with _pinned_lock:
+        pinned = dict(_load_pinned())
+        if signature not in pinned:
+            return False
+        del pinned[signature]
+        _write_pinned(pinned)
+    return True
+
+
+def _write_pinned(pinned):
+    entries = [{'columns': list(signature), 'roles': roles} for signature, roles in pinned.items()]
+    tmp_path = f"{MAPPINGS_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, MAPPINGS_FILE)
+    # Force a reload so the in-process copy matches the file
+    global _pinned_mtime
+    _pinned_mtime = None
+
+
+if __name__ == "__main__":
+    # Usage:
+    #   python schema.py show <file>
+    #   python schema.py pin <file> role=column [role=column ...]
+    #   python schema.py unpin <file>
+    from readers import read_header
+
+    if len(sys.argv) < 3 or sys.argv[1] not in ('show', 'pin', 'unpin'):
+        print("Usage: python schema.py show|pin|unpin <file> [role=column ...]")
+        sys.exit(2)
+
+    command, file_path = sys.argv[1], sys.argv[2]
+    columns = read_header(file_path)
+    if command == 'pin':
+        roles = {role: column or None for role, column in (arg.split('=', 1) for arg in sys.argv[3:])}
+        profile = pin_mapping(columns, roles)
+        print(f"Pinned mapping for {len(columns)}-column layout:")
+    elif command == 'unpin':
+        print("Mapping removed" if unpin_mapping(columns) else "No mapping was pinned for this layout")
+        profile = detect_columns(columns)
+    else:
+        profile = detect_columns(columns)
+    for role in ROLES:
+        print(f"  {role:>6}: {profile.get(role)}")
@@ -0,0 +1,274 @@
+import os
+import json
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Large per-session data (the transformed invoice frame, etc.) is kept out of
+# the session cookie. Frames are stored in a columnar format so a page can read
+# just the columns and rows it shows; other values are stored as JSON.
+# pandas and pyarrow are only imported by the methods that handle frames, so
+# values and cleanup work without loading them.
+
+
+def _arrow_safe(df):
+    """
+    Make object columns storable as Arrow
+
+    Columns mixing text with numbers (e.g. numeric customer names blanked with '')
+    are stored as text; the CSV output is the same. The same goes for the
+    categories of categorical columns, which Arrow stores as dictionaries.
+    """
+    import pandas as pd
+
+    def as_text(value):
+        return value if isinstance(value, str) or pd.isna(value) else str(value)
+
+    df = df.reset_index(drop=True)
+    for col in df.columns[df.dtypes == object]:
+        kind = pd.api.types.infer_dtype(df[col], skipna=True)
+        if kind not in ('string', 'empty'):
+            df[col] = df[col].map(as_text)
+    for col in df.columns[df.dtypes == 'category']:
+        categories = df[col].cat.categories
+        if categories.dtype == object and pd.api.types.infer_dtype(categories) not in ('string', 'empty'):
+            # Text forms of different values can clash (1 and '1'), so build the categories again
+            df[col] = pd.Categorical(df[col].astype(object).map(as_text))
+    return df
+
+
+class FeatherSessionStore:
+    """Stores each frame as an Arrow/Feather file under <root>/<session_id>/"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _session_dir(self, session_id):
+        return os.path.join(self.root, session_id)
+
+    def _path(self, session_id, key, extension):
+        return os.path.join(self._session_dir(session_id), f"{key}.{extension}")
+
+    def _write(self, path, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+
+    def save_frame(self, session_id, key, df):
+        from pyarrow import feather
+        df = _arrow_safe(df)
+        self._write(self._path(session_id, key, 'feather'),
+                    lambda path: feather.write_feather(df, path, compression='lz4'))
+
+    def load_frame(self, session_id, key, columns=None, start=None, stop=None, rows=None):
+        import pandas as pd
+        from pyarrow import feather
+        path = self._path(session_id, key, 'feather')
+        if not os.path.exists(path):
+            return None
+        table = feather.read_table(path, columns=columns, memory_map=True)
+        if rows is not None:
+            df = table.take(list(rows)).to_pandas()
+            df.index = pd.Index(rows)
+            return df
+        start = start or 0
+        stop = table.num_rows if stop is None else min(stop, table.num_rows)
+        df = table.slice(start, max(stop - start, 0)).to_pandas()
+        # Keep the row numbers of the full frame so slices can be edited in place
+        df.index = pd.RangeIndex(start, start + len(df))
+        return df
+
+    def frame_length(self, session_id, key):
+        from pyarrow import feather
+        path = self._path(session_id, key, 'feather')
+        if not os.path.exists(path):
+            return None
+        return feather.read_table(path, columns=[], memory_map=True).num_rows
+
+    def save_value(self, session_id, key, value):
+        def write(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(value, f)
+        self._write(self._path(session_id, key, 'json'), write)
+
+    def load_value(self, session_id, key, default=None):
+        path = self._path(session_id, key, 'json')
+        if not os.path.exists(path):
+            return default
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def delete(self, session_id, key):
+        for extension in ('feather', 'json'):
+            path = self._path(session_id, key, extension)
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def session_size(self, session_id):
+        """Bytes stored for a session"""
+        session_dir = self._session_dir(session_id)
+        if not os.path.isdir(session_dir):
+            return 0
+        return sum(entry.stat().st_size for entry in os.scandir(session_dir) if entry.is_file())
+
+    def delete_session(self, session_id):
+        session_dir = self._session_dir(session_id)
+        if os.path.exists(session_dir):
+            shutil.rmtree(session_dir, ignore_errors=True)
+
+
+class SQLiteSessionStore:
+    """
+    Stores frames as tables in one SQLite database, for deployments where
+    several gunicorn workers (or hosts sharing a volume) serve the same session
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS frames (
+                session_id TEXT NOT NULL, key TEXT NOT NULL, table_name TEXT NOT NULL,
+                columns TEXT NOT NULL, dtypes TEXT NOT NULL, num_rows INTEGER NOT NULL,
+                PRIMARY KEY (session_id, key))""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS session_values (
+                session_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+                PRIMARY KEY (session_id, key))""")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _table_name(session_id, key):
+        return 'frame_' + hashlib.sha1(f"{session_id}/{key}".encode('utf-8')).hexdigest()[:20]
+
+    def save_frame(self, session_id, key, df):
+        df = df.reset_index(drop=True)
+        table_name = self._table_name(session_id, key)
+        dtypes = {str(col): str(dtype) for col, dtype in df.dtypes.items()}
+        stored = df.copy()
+        for col in stored.columns[stored.dtypes == 'category']:
+            stored[col] = stored[col].astype(object)
+        stored.index.name = '_row'
+        conn = self._connect()
+        with conn:
+            stored.to_sql(table_name, conn, if_exists='replace', index=True)
+            conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{table_name}_row" ON "{table_name}" (_row)')
+            conn.execute("INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?, ?)",
+                         (session_id, key, table_name, json.dumps([str(c) for c in df.columns]),
+                          json.dumps(dtypes), len(df)))
+
+    def _frame_meta(self, session_id, key):
+        return self._connect().execute(
+            "SELECT table_name, columns, dtypes, num_rows FROM frames WHERE session_id = ? AND key = ?",
+            (session_id, key)).fetchone()
+
+    def load_frame(self, session_id, key, columns=None, start=None, stop=None, rows=None):
+        import pandas as pd
+        meta = self._frame_meta(session_id, key)
+        if meta is None:
+            return None
+        table_name, all_columns, dtypes, num_rows = meta
+        all_columns, dtypes = json.loads(all_columns), json.loads(dtypes)
+        columns = all_columns if columns is None else list(columns)
+        select = ', '.join(['_row'] + [f'"{col}"' for col in columns])
+        if rows is not None:
+            rows = [int(row) for row in rows]
+            placeholders = ', '.join('?' * len(rows))
+            df = pd.read_sql_query(f'SELECT {select} FROM "{table_name}" WHERE _row IN ({placeholders})',
+                                   self._connect(), params=rows, index_col='_row')
+            df = df.reindex(rows)
+        else:
+            start = start or 0
+            stop = num_rows if stop is None else min(stop, num_rows)
+            df = pd.read_sql_query(
+                f'SELECT {select} FROM "{table_name}" WHERE _row >= ? AND _row < ? ORDER BY _row',
+                self._connect(), params=(start, stop), index_col='_row')
+        df.index.name = None
+        for col in columns:
+            dtype = dtypes[col]
+            if dtype != 'object' and str(df[col].dtype) != dtype:
+                df[col] = df[col].astype(dtype)
+        return df
+
+    def frame_length(self, session_id, key):
+        meta = self._frame_meta(session_id, key)
+        return None if meta is None else meta[3]
+
+    def save_value(self, session_id, key, value):
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO session_values VALUES (?, ?, ?)",
+                         (session_id, key, json.dumps(value)))
+
+    def load_value(self, session_id, key, default=None):
+        row = self._connect().execute(
+            "SELECT value FROM session_values WHERE session_id = ? AND key = ?", (session_id, key)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def delete(self, session_id, key):
+        conn = self._connect()
+        with conn:
+            meta = self._frame_meta(session_id, key)
+            if meta is not None:
+                conn.execute(f'DROP TABLE IF EXISTS "{meta[0]}"')
+            conn.execute("DELETE FROM frames WHERE session_id = ? AND key = ?", (session_id, key))
+            conn.execute("DELETE FROM session_values WHERE session_id = ? AND key = ?", (session_id, key))
+
+    def session_size(self, session_id):
+        """Bytes stored for a session's frames, or None if SQLite cannot report page usage"""
+        conn = self._connect()
+        tables = [row[0] for row in conn.execute(
+            "SELECT table_name FROM frames WHERE session_id = ?", (session_id,)).fetchall()]
+        if not tables:
+            return 0
+        try:
+            placeholders = ', '.join('?' * len(tables))
+            return conn.execute(f"SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name IN ({placeholders})",
+                                tables).fetchone()[0]
+        except sqlite3.OperationalError:
+            # Built without the dbstat virtual table
+            return None
+
+    def delete_session(self, session_id):
+        conn = self._connect()
+        with conn:
+            for (table_name,) in conn.execute("SELECT table_name FROM frames WHERE session_id = ?",
+                                              (session_id,)).fetchall():
+                conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            conn.execute("DELETE FROM frames WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM session_values WHERE session_id = ?", (session_id,))
+
+
+BACKENDS = {
+    'feather': FeatherSessionStore,
+    'sqlite': SQLiteSessionStore,
+}
+
+
+def create_store(backend, location):
+    """
+    Create the session data store configured for the app
+
+    Args:
+        backend (str): 'feather' (default) or 'sqlite'
+        location (str): Root directory for feather, database file for sqlite
+
+    Returns:
+        FeatherSessionStore or SQLiteSessionStore
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown session backend '{backend}'. Choose one of: {', '.join(BACKENDS)}")
+    return BACKENDS[backend](location)
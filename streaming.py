@@ -0,0 +1,226 @@
+import time
+import logging
+
+import numpy as np
+import pandas as pd
+
+import metrics
+import prefilter
+from readers import read_header, csv_encoding
+from schema import detect_columns
+import order_history
+from transformer import build_invoice_lines, blank_repeated_invoice_fields, confirmed_names, qbo_columns, ORDER_ID
+
+logger = logging.getLogger(__name__)
+
+# CSV exports too large to hold in memory are processed this many rows at a
+# time, so peak memory depends on the chunk size rather than the file size
+CHUNK_SIZE = 50000
+
+
+def csv_profile(file_path):
+    """
+    Detect the column roles of a CSV file from its header alone
+
+    Returns:
+        dict: Role to column name, as returned by detect_columns
+    """
+    return detect_columns(read_header(file_path))
+
+
+def csv_dtypes(file_path, columns, chunksize=CHUNK_SIZE):
+    """
+    The types read_csv infers for some columns when it reads the whole file at once
+
+    Chunks are combined the way read_csv combines its own internal chunks:
+    integers and floats give floats, and any text (or a mix with booleans)
+    gives object.
+
+    Args:
+        file_path (str): Path to the CSV file
+        columns (iterable): Columns to look at (None entries are skipped)
+
+    Returns:
+        dict: Column to numpy dtype
+    """
+    wanted = {col for col in columns if col is not None}
+    if not wanted:
+        return {}
+    found = {}
+    reader = pd.read_csv(file_path, usecols=lambda col: col in wanted, chunksize=chunksize,
+                         encoding=csv_encoding(file_path))
+    with reader:
+        for chunk in reader:
+            for col, dtype in chunk.dtypes.items():
+                known = found.get(col, dtype)
+                if known == object or dtype == object or (known == bool) != (dtype == bool):
+                    found[col] = np.dtype(object)
+                else:
+                    found[col] = np.result_type(known, dtype)
+    return found
+
+
+def _as_dtypes(chunk, dtypes):
+    """Convert text columns of a chunk to the types the whole file gives them (see csv_dtypes)"""
+    for col, dtype in dtypes.items():
+        if col not in chunk.columns or dtype == object:
+            continue
+        if dtype == bool:
+            chunk[col] = chunk[col].str.lower() == 'true'
+        else:
+            chunk[col] = pd.to_numeric(chunk[col]).astype(dtype)
+    return chunk
+
+
+def iter_csv_chunks(file_path, profile, chunksize=CHUNK_SIZE, dtypes=None):
+    """
+    Read a CSV file in chunks, keeping only the columns that have a role
+
+    Values are read as text so every chunk has the same column types, whatever
+    rows it happens to contain; columns in dtypes are then given those types.
+
+    Args:
+        dtypes (dict): Column to dtype, e.g. the whole file's (see csv_dtypes)
+
+    Yields:
+        pd.DataFrame: The next chunk of rows
+    """
+    wanted = {col for col in profile.values() if col is not None}
+    reader = pd.read_csv(file_path, usecols=lambda col: col in wanted, dtype=str, chunksize=chunksize,
+                         encoding=csv_encoding(file_path))
+    with reader:
+        while True:
+            start = time.perf_counter()
+            chunk = next(reader, None)
+            if chunk is None:
+                return
+            metrics.observe('read', time.perf_counter() - start)
+            yield _as_dtypes(chunk, dtypes) if dtypes else chunk
+
+
+def stream_unique_customers(file_path, chunksize=CHUNK_SIZE):
+    """
+    Extract unique customer names from a CSV file without loading it whole
+
+    Applies the same filter rules as get_unique_customers (see prefilter).
+
+    Returns:
+        list: Unique customer names in order of first appearance
+    """
+    profile = csv_profile(file_path)
+    if not profile['name']:
+        raise ValueError("Could not identify a suitable customer name column")
+
+    customers = {}
+    for chunk in iter_csv_chunks(file_path, prefilter.filter_roles(profile), chunksize):
+        chunk = prefilter.filter_rows(chunk, profile)
+        customers.update(dict.fromkeys(chunk[profile['name']].unique()))
+    return list(customers)
+
+
+def stream_transform_csv(file_path, output, start_invoice_number, invoice_date,
+                         name_mapping=None, chunksize=CHUNK_SIZE, progress=None, confirmed_only=False):
+    """
+    Transform a CSV laundry report to QBO format chunk by chunk, writing lines as it goes
+
+    Invoice numbers are assigned incrementally in the order customers are first
+    seen, and the columns shown in descriptions are given the types reading
+    the whole file gives them (see csv_dtypes), so the output matches
+    transform_data for the same rows.
+
+    Args:
+        file_path (str): Path to the CSV file
+        output (str or file): Path or open text file to write the QBO CSV to
+        start_invoice_number (int): Starting invoice number
+        invoice_date (datetime): Date for the invoice
+        name_mapping (dict): Optional original to confirmed customer names
+        chunksize (int): Number of input rows processed at a time
+        progress (callable): Called with the number of lines written after each chunk
+        confirmed_only (bool): Leave out customers missing from name_mapping
+
+    Returns:
+        dict: Number of lines and invoices written, and of lines whose order
+        was exported before (see order_history)
+    """
+    with metrics.timed('detect'):
+        profile = csv_profile(file_path)
+    name_col = profile['name']
+    if not name_col:
+        raise ValueError("Could not find customer name column in the file")
+    if not profile['price']:
+        raise ValueError("Could not find price/amount column in the file")
+
+    if isinstance(output, str):
+        with open(output, 'w', encoding='utf-8-sig', newline='') as f:
+            return stream_transform_csv(file_path, f, start_invoice_number, invoice_date,
+                                        name_mapping, chunksize, progress, confirmed_only)
+
+    invoice_numbers = {}
+    lines_written = 0
+    billed = 0
+    history = order_history.get_history()
+    # Descriptions show these columns' values as the whole file's types
+    # format them (an ID column with blanks is read as floats: "10000.0")
+    with metrics.timed('detect'):
+        dtypes = csv_dtypes(file_path, [profile['id'], profile['house'], profile['note']])
+    for chunk in iter_csv_chunks(file_path, profile, chunksize, dtypes):
+        chunk = prefilter.filter_rows(chunk, profile)
+        if confirmed_only:
+            # Customers the user did not confirm get no invoice
+            chunk = chunk[~pd.isna(confirmed_names(chunk[name_col], name_mapping or {}))]
+        if chunk.empty:
+            continue
+
+        with metrics.timed('transform'):
+            codes, customers = pd.factorize(chunk[name_col])
+            names = customers.to_numpy(dtype=object)
+            renamed = np.zeros(len(customers), dtype=bool)
+            if name_mapping:
+                # Look names up once per customer and spread them through the codes
+                new_names = confirmed_names(customers, name_mapping)
+                renamed = ~pd.isna(new_names)
+                names = np.where(renamed, new_names, names)
+
+            # Give names new to this chunk the next invoice numbers; customers
+            # confirmed under the same name share an invoice
+            numbers = np.empty(len(customers), dtype='int64')
+            seen_before = np.zeros(len(customers), dtype=bool)
+            for i, name in enumerate(names):
+                number = invoice_numbers.get(name)
+                if number is None:
+                    number = invoice_numbers[name] = start_invoice_number + len(invoice_numbers)
+                else:
+                    seen_before[i] = True
+                numbers[i] = number
+            row_numbers = numbers[codes]
+
+            lines = build_invoice_lines(chunk, profile, row_numbers, invoice_date)
+            # Keep amounts formatted the same way in every chunk
+            lines['*ItemAmount'] = lines['*ItemAmount'].astype('float64')
+
+            if renamed.any():
+                row_names = lines['*Customer'].to_numpy(dtype=object, copy=True)
+                row_renamed = renamed[codes]
+                row_names[row_renamed] = names[codes][row_renamed]
+                lines['*Customer'] = row_names
+
+        # Lines of invoices started in an earlier chunk are never first lines
+        with metrics.timed('blank'):
+            repeated = lines['*InvoiceNo'].duplicated().to_numpy() | seen_before[codes]
+            blank_repeated_invoice_fields(lines, repeated)
+
+        if history is not None:
+            # Checked before the chunk is recorded as exported itself
+            billed += int((history.billed(lines[ORDER_ID]) >= 0).sum())
+        with metrics.timed('serialize'):
+            lines.to_csv(output, header=(lines_written == 0), index=False, columns=qbo_columns(lines))
+        order_history.record_export(lines)
+        lines_written += len(lines)
+        logger.debug("Streamed %d invoice lines from %s", lines_written, file_path)
+        if progress is not None:
+            progress(lines_written)
+
+    if not lines_written:
+        raise ValueError("No valid invoice data found in the file after processing")
+
+    return {'lines': lines_written, 'invoices': len(invoice_numbers), 'billed': billed}
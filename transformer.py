@@ -1,300 +1,601 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 import os
 import re
+import logging
+import metrics
+from dataset import load_dataset, source_columns, result_key, cached_frame
+from schema import detect_columns
+import prefilter
+import order_history
 
-def transform_data(file_path, start_invoice_number, invoice_date):
+logger = logging.getLogger(__name__)
+
+# Cache name of prepare_invoice_lines results; change the version whenever
+# the prepared columns change so stale spills are not reused
+PREPARED_LINES = 'invoice-lines-v3'
+# Order ID of every line ('' where the report has none), kept beside the QBO
+# columns so exports can be recorded and checked for orders billed before
+# (see order_history); it is never written to the CSV
+ORDER_ID = '_order_id'
+
+def transform_data(file_path, start_invoice_number, invoice_date, name_mapping=None, confirmed_only=False):
     """
     Transform the laundry service report to QuickBooks Online format
     
+    The part of the transform that does not depend on the start number, the
+    date or the customer names is cached by file content and column profile,
+    so converting the same file again with other invoice details or other
+    confirmed names only renumbers and relabels the lines.
+    
     Args:
         file_path (str): Path to the Excel or CSV file
         start_invoice_number (int): Starting invoice number
         invoice_date (datetime): Date for the invoice
+        name_mapping (dict): Optional original to new customer names
+        confirmed_only (bool): Leave out customers missing from name_mapping
+            (the customers the user did not confirm)
         
     Returns:
         pd.DataFrame: Transformed dataframe ready for QBO import
     """
     try:
-        # Determine file type based on extension
-        file_extension = file_path.lower().split('.')[-1] if '.' in file_path else ''
-        
-        # Read the file based on its extension
-        if file_extension == 'csv':
-            print("Reading CSV file for transformation...")
-            df = pd.read_csv(file_path)
-        else:
-            # Try multiple Excel reading engines if it's an Excel file
-            try:
-                print("Attempting to read Excel file with default engine for transformation...")
-                df = pd.read_excel(file_path)
-            except Exception as e1:
-                print(f"Error with default engine: {str(e1)}")
-                try:
-                    print("Trying with engine='openpyxl'...")
-                    df = pd.read_excel(file_path, engine='openpyxl')
-                except Exception as e2:
-                    print(f"Error with openpyxl engine: {str(e2)}")
-                    try:
-                        print("Trying with engine='xlrd'...")
-                        df = pd.read_excel(file_path, engine='xlrd')
-                    except Exception as e3:
-                        print(f"Error with xlrd engine: {str(e3)}")
-                        # If Excel reading fails completely, try CSV as last resort
-                        try:
-                            print("Trying to read as CSV...")
-                            df = pd.read_csv(file_path)
-                        except Exception as e4:
-                            print(f"Error reading as CSV: {str(e4)}")
-                            raise ValueError(f"Could not read file with any available method. Last error: {str(e3)}")
-        
-        print(f"File contents loaded. Columns: {df.columns.tolist()}")
-        print(f"First few rows: {df.head(2).to_dict()}")
-        
-        # Add fallback columns if the CSV doesn't have all required columns
-        # These are the minimum required columns for QuickBooks Online import
-        required_qbo_columns = [
-            '*InvoiceNo', '*Customer', '*InvoiceDate', '*DueDate',
-            'Item(Product/Service)', 'ItemDescription', 'ItemQuantity', '*ItemAmount'
-        ]
-        
-        # Create a new DataFrame with the required structure
-        qbo_df = pd.DataFrame(columns=required_qbo_columns)
-        
-        # Try to identify needed columns from the input file
-        name_col = None
-        price_col = None
-        date_col = None
-        id_col = None
-        house_col = None
-        note_col = None
-        
-        # Look for customer name column
-        for possible_name in ['Name', 'Customer', 'Client', 'Account']:
-            if possible_name in df.columns:
-                name_col = possible_name
-                break
-                
-        if not name_col:
-            # Try case-insensitive search
-            for col in df.columns:
-                if 'name' in col.lower() or 'customer' in col.lower():
-                    name_col = col
-                    break
-                    
-        if not name_col and len(df.columns) > 1:
-            # If still not found, use second column as fallback
-            name_col = df.columns[1]
-        
-        # Look for price/amount column
-        for possible_price in ['Price', 'Amount', 'Total', 'Value', 'Cost']:
-            if possible_price in df.columns:
-                price_col = possible_price
-                break
-                
-        if not price_col:
-            # Try case-insensitive search
-            for col in df.columns:
-                if 'price' in col.lower() or 'amount' in col.lower() or 'total' in col.lower() or 'value' in col.lower():
-                    price_col = col
-                    break
-        
-        # Look for date column
-        for possible_date in ['Date', 'Service Date', 'Cleaning Date', 'Invoice Date']:
-            if possible_date in df.columns:
-                date_col = possible_date
-                break
-                
-        if not date_col:
-            # Try case-insensitive search
-            for col in df.columns:
-                if 'date' in col.lower():
-                    date_col = col
-                    break
-        
-        # Look for ID column
-        for possible_id in ['ID', 'Id', 'Order', 'Order ID', 'Invoice', 'Ref']:
-            if possible_id in df.columns:
-                id_col = possible_id
-                break
-                
-        if not id_col:
-            # Try case-insensitive search
-            for col in df.columns:
-                if 'id' in col.lower() or 'order' in col.lower() or 'ref' in col.lower():
-                    id_col = col
-                    break
-                    
-        if not id_col and len(df.columns) > 0:
-            # If still not found, use first column as fallback
-            id_col = df.columns[0]
-            
-        # Look for House/Address column
-        for possible_house in ['House', 'Address', 'Location', 'Property', 'Apartment']:
-            if possible_house in df.columns:
-                house_col = possible_house
-                break
-                
-        if not house_col:
-            # Try case-insensitive search
-            for col in df.columns:
-                if 'house' in col.lower() or 'address' in col.lower() or 'location' in col.lower() or 'property' in col.lower():
-                    house_col = col
-                    break
-        
-        # Look for Note column
-        for possible_note in ['Note', 'Notes', 'Comment', 'Comments', 'Description']:
-            if possible_note in df.columns:
-                note_col = possible_note
-                break
-                
-        if not note_col:
-            # Try case-insensitive search
-            for col in df.columns:
-                if 'note' in col.lower() or 'comment' in col.lower() or 'description' in col.lower():
-                    note_col = col
-                    break
-        
-        # Make sure we have the minimally required columns
-        if not name_col:
-            raise ValueError("Could not find customer name column in the file")
-        if not price_col:
-            raise ValueError("Could not find price/amount column in the file")
+        prepared = load_prepared_lines(file_path)
+        return number_invoice_lines(prepared, start_invoice_number, invoice_date, name_mapping, confirmed_only)
+    
+    except Exception as e:
+        logger.exception("Error in transform_data: %s", e)
+        raise ValueError(f"Error transforming data: {str(e)}")
+
+def load_prepared_lines(file_path):
+    """
+    Return prepare_invoice_lines for a file, from the result cache when possible
+    
+    Returns:
+        pd.DataFrame: Prepared lines (shared, do not modify in place)
+    """
+    def prepare():
+        # Reuse the frame parsed during upload when the file has not changed
+        df = load_dataset(file_path)
+        logger.debug("File contents loaded (%d rows). Columns: %s", len(df), list(df.columns))
+        return prepare_invoice_lines(df)
+    
+    return cached_frame(prepared_key(file_path), prepare)
+
+def drop_billed_lines(prepared):
+    """
+    Leave out prepared lines whose order was exported before (see order_history)
+    
+    Customer codes are renumbered in the same first-seen order, so customers
+    left without lines take no invoice number.
+    
+    Args:
+        prepared (pd.DataFrame): Lines from prepare_invoice_lines (not modified)
         
-        print(f"Using {name_col} as customer name column")
-        print(f"Using {price_col} as price column")
-        if date_col:
-            print(f"Using {date_col} as date column")
-        if id_col:
-            print(f"Using {id_col} as ID column")
-        if house_col:
-            print(f"Using {house_col} as house/address column")
-        if note_col:
-            print(f"Using {note_col} as note column")
+    Returns:
+        pd.DataFrame: The lines still to bill (prepared itself when none were billed)
+    """
+    history = order_history.get_history()
+    if history is None:
+        return prepared
+    keep = history.billed(prepared['order_id']) < 0
+    if keep.all():
+        return prepared
+    if not keep.any():
+        raise ValueError("Every line bills an order that was already exported")
+    prepared = prepared[keep]
+    codes, _ = pd.factorize(prepared['customer_code'])
+    logger.info("Left out %d lines billed before", int((~keep).sum()))
+    return prepared.assign(customer_code=codes.astype('int64'))
+
+def prepared_key(file_path):
+    """Cache key of a file's prepared lines under the current filter rules"""
+    return result_key(file_path, f"{PREPARED_LINES}-{prefilter.rules_key()}")
+
+def transform_frame(df, start_invoice_number, invoice_date):
+    """
+    Transform an already parsed laundry service report to QuickBooks Online format
+    
+    Every step works on whole columns: prices, descriptions and service dates
+    are computed once per column (or once per distinct value) instead of once
+    per row, and the invoice/due date strings are formatted a single time.
+    
+    Args:
+        df (pd.DataFrame): Parsed report, as returned by load_dataset
+        start_invoice_number (int): Starting invoice number
+        invoice_date (datetime): Date for the invoice
         
-        # Create a basic transformation - copy needed columns to the QBO format
-        # Filter for valid rows - non-empty customer names
-        df = df.dropna(subset=[name_col])
-        df = df[df[name_col] != '']
+    Returns:
+        pd.DataFrame: Transformed dataframe ready for QBO import
+    """
+    return number_invoice_lines(prepare_invoice_lines(df), start_invoice_number, invoice_date)
+
+def prepare_invoice_lines(df):
+    """
+    Do the part of transform_frame that does not depend on invoice numbers or dates
+    
+    Args:
+        df (pd.DataFrame): Parsed report, as returned by load_dataset
         
-        # Get unique customers
-        unique_customers = df[name_col].drop_duplicates().tolist()
+    Returns:
+        pd.DataFrame: One row per invoice line with the customer, its position in
+        first-seen customer order (customer_code) and the parts of the line
+        built by _line_parts
+    """
+    # Identify needed columns from the input file (cached per header layout)
+    with metrics.timed('detect'):
+        profile = detect_columns(source_columns(df))
+    name_col = profile['name']
+    price_col = profile['price']
+    
+    # Make sure we have the minimally required columns
+    if not name_col:
+        raise ValueError("Could not find customer name column in the file")
+    if not price_col:
+        raise ValueError("Could not find price/amount column in the file")
+    
+    logger.debug("Columns used: name=%s price=%s date=%s id=%s house=%s note=%s",
+                 name_col, price_col, profile['date'], profile['id'], profile['house'], profile['note'])
+    
+    # Keep the rows that may be invoiced (named customers, valid statuses...);
+    # get_unique_customers lists the customers of these same rows
+    df = prefilter.filter_rows(df, profile)
+    if df.empty:
+        raise ValueError("No valid invoice data found in the file after processing")
+    
+    with metrics.timed('transform'):
+        df = _as_row_values(df)
         
-        # Create invoice numbers sequence
-        invoice_mapping = {}
-        current_invoice = start_invoice_number
+        # Invoice numbers follow the order in which customers first appear
+        customer_codes, _ = pd.factorize(df[name_col])
         
-        for customer in unique_customers:
-            invoice_mapping[customer] = current_invoice
-            current_invoice += 1
+        prepared = _line_parts(df, profile)
+        prepared.insert(0, 'customer', df[name_col].to_numpy())
+        prepared.insert(0, 'customer_code', customer_codes.astype('int64'))
+    return prepared
+
+def number_invoice_lines(prepared, start_invoice_number, invoice_date, name_mapping=None, confirmed_only=False):
+    """
+    Finish prepared invoice lines with invoice numbers, dates and customer names
+    
+    Names are looked up once per customer and spread to the lines through the
+    customer codes. Customers left out with confirmed_only do not use up an
+    invoice number.
+    
+    Args:
+        prepared (pd.DataFrame): Lines from prepare_invoice_lines (not modified)
+        start_invoice_number (int): Invoice number of the first customer
+        invoice_date (datetime): Date for the invoice
+        name_mapping (dict): Optional original to new customer names
+        confirmed_only (bool): Leave out customers missing from name_mapping
         
-        # Build the QBO dataframe row by row
-        rows = []
+    Returns:
+        pd.DataFrame: Transformed dataframe ready for QBO import
+    """
+    with metrics.timed('number'):
+        customers = number_customers(prepared, start_invoice_number, name_mapping, confirmed_only)
+        codes = prepared['customer_code'].to_numpy()
+        invoice_numbers = customers['invoice_no'].to_numpy()[codes]
+        
+        included = invoice_numbers >= 0
+        if not included.all():
+            if not included.any():
+                raise ValueError("None of the confirmed customers were found in the file")
+            prepared = prepared[included]
+            codes = codes[included]
+            invoice_numbers = invoice_numbers[included]
+        
+        # One category per distinct name (two customers may be renamed alike)
+        name_codes, names = pd.factorize(customers['name'].to_numpy())
+        row_names = pd.Categorical.from_codes(name_codes[codes], categories=names)
+        qbo_df = _assemble_lines(prepared, row_names, invoice_numbers, invoice_date)
+    with metrics.timed('blank'):
+        blank_repeated_invoice_fields(qbo_df)
+    metrics.observe_memory('qbo_frame', int(qbo_df.memory_usage(deep=True).sum()))
+    
+    logger.info("Created %d invoice rows for QuickBooks Online import", len(qbo_df))
+    
+    return qbo_df
+
+def number_customers(prepared, start_invoice_number, name_mapping=None, confirmed_only=False):
+    """
+    Give every customer of a prepared file its name and invoice number
+    
+    Args:
+        prepared (pd.DataFrame): Lines from prepare_invoice_lines
+        start_invoice_number (int): Invoice number of the first included customer
+        name_mapping (dict): Optional original to new customer names
+        confirmed_only (bool): Leave out customers missing from name_mapping
         
-        for _, row in df.iterrows():
-            customer = row[name_col]
-            # Check if price can be converted to float
-            try:
-                price = float(row[price_col])
-            except:
-                # Try to extract numeric part
-                price_str = str(row[price_col])
-                price_str = ''.join(c for c in price_str if c.isdigit() or c == '.' or c == ',')
-                price_str = price_str.replace(',', '.')
-                try:
-                    price = float(price_str)
-                except:
-                    price = 0
-            
-            # Create a description with the requested format
-            description = ""
-            
-            # Add house/address if available
-            if house_col and house_col in row and pd.notna(row[house_col]) and row[house_col] != '':
-                description = f"{row[house_col]}, "
-            
-            # Add order ID
-            if id_col and id_col in row and pd.notna(row[id_col]) and row[id_col] != '':
-                order_id = row[id_col]
-            else:
-                order_id = invoice_mapping[customer]  # Use invoice number as fallback
-                
-            description += f"/ order id: {order_id}"
-            
-            # Add note if available
-            if note_col and note_col in row and pd.notna(row[note_col]) and row[note_col] != '':
-                description += f" / Notes: {row[note_col]}"
-            
-            # Add date if available
-            if date_col and date_col in row and pd.notna(row[date_col]):
-                try:
-                    service_date = pd.to_datetime(row[date_col]).strftime('%d/%m/%Y')
-                except:
-                    service_date = invoice_date.strftime('%d/%m/%Y')
-            else:
-                service_date = invoice_date.strftime('%d/%m/%Y')
-            
-            # Create a QBO row
-            qbo_row = {
-                '*InvoiceNo': invoice_mapping[customer],
-                '*Customer': customer,
-                '*InvoiceDate': invoice_date.strftime('%d/%m/%Y'),
-                '*DueDate': (invoice_date + timedelta(days=4)).strftime('%d/%m/%Y'),
-                'Item(Product/Service)': 'Linhas de Lavanderia:Services',
-                'ItemDescription': description,
-                'ItemQuantity': 1,
-                '*ItemAmount': price,
-                'Service Date': service_date
-            }
-            
-            rows.append(qbo_row)
+    Returns:
+        pd.DataFrame: One row per customer_code (first-seen order) with the
+        original customer, its name, whether the name comes from name_mapping
+        (renamed), and its invoice number (-1 when left out; customers with
+        the same name share one)
+    """
+    codes = prepared['customer_code'].to_numpy()
+    _, first_rows = np.unique(codes, return_index=True)
+    originals = prepared['customer'].to_numpy()[first_rows]
+    
+    renamed = np.zeros(len(originals), dtype=bool)
+    names = originals
+    if name_mapping is not None:
+        mapped = confirmed_names(originals, name_mapping)
+        renamed = ~pd.isna(mapped)
+        names = np.where(renamed, mapped, originals.astype(object))
+    
+    # Customers confirmed under the same name (spellings of one customer)
+    # share an invoice, numbered in first-seen order
+    included = renamed if confirmed_only else np.ones(len(originals), dtype=bool)
+    invoice_numbers = np.full(len(originals), -1, dtype='int64')
+    if included.any():
+        name_codes, _ = pd.factorize(pd.Series(names, dtype=object)[included])
+        invoice_numbers[included] = start_invoice_number + name_codes
+    return pd.DataFrame({
+        'customer': originals,
+        'name': names,
+        'renamed': renamed,
+        'invoice_no': invoice_numbers.astype('int64'),
+    })
+
+def confirmed_names(customers, name_mapping):
+    """
+    Look up the new name of each customer in name_mapping
+    
+    Customers are matched as they are, then as text: mappings that went
+    through JSON (the session, a names file) have string keys for numeric
+    customer names.
+    
+    Args:
+        customers (array-like): Original names, one per customer
+        name_mapping (dict): Original to new customer names
         
-        # Convert list of rows to DataFrame
-        if not rows:
-            raise ValueError("No valid invoice data found in the file after processing")
-            
-        qbo_df = pd.DataFrame(rows)
+    Returns:
+        np.ndarray: New names, None where the customer is not in name_mapping
+    """
+    originals = pd.Series(customers, dtype=object)
+    names = originals.map(name_mapping)
+    missing = names.isna().to_numpy()
+    if missing.any():
+        names[missing] = originals[missing].astype(str).map(name_mapping)
+    return np.asarray(names.astype(object).where(names.notna(), None), dtype=object)
+
+def build_invoice_lines(df, profile, invoice_numbers, invoice_date):
+    """
+    Build one QBO invoice line per input row, without blanking repeated fields
+    
+    Args:
+        df (pd.DataFrame): Filtered input rows
+        profile (dict): Column roles, as returned by detect_columns
+        invoice_numbers (np.ndarray): Invoice number of every row
+        invoice_date (datetime): Date for the invoice
         
-        # Set blank customer names for all but first occurrence of each invoice
-        for inv_num in qbo_df['*InvoiceNo'].unique():
-            mask = qbo_df['*InvoiceNo'] == inv_num
-            indices = qbo_df[mask].index
-            if len(indices) > 1:  # If there are multiple rows for this invoice
-                qbo_df.loc[indices[1:], '*Customer'] = ''  # Clear customer name for all but first row
-                qbo_df.loc[indices[1:], '*InvoiceDate'] = ''  # Clear invoice date for all but first row
-                qbo_df.loc[indices[1:], '*DueDate'] = ''  # Clear due date for all but first row
-                
-        print(f"Created {len(qbo_df)} invoice rows for QuickBooks Online import")
+    Returns:
+        pd.DataFrame: QBO lines in input order
+    """
+    return _assemble_lines(_line_parts(df, profile), df[profile['name']].to_numpy(), invoice_numbers, invoice_date)
+
+def _line_parts(df, profile):
+    """
+    Compute the parts of every invoice line that do not depend on invoice numbers or dates
+    
+    Returns:
+        pd.DataFrame: amount; description, with its prefix and suffix for the
+        rows without an order ID (has_order_id is False), where the invoice
+        number stands in for it; the order ID itself ('' where missing);
+        service date (has_service_date is False where the invoice date stands
+        in for it)
+    """
+    prefix, order_ids, has_id, suffix = _description_parts(df, profile['id'], profile['house'], profile['note'])
+    service_dates, has_date = _service_dates(df, profile['date'])
+    return pd.DataFrame({
+        'amount': _coerce_prices(df[profile['price']]),
+        'description': prefix + order_ids + suffix,
+        'has_order_id': has_id,
+        'desc_prefix': np.where(has_id, '', prefix).astype(object),
+        'desc_suffix': np.where(has_id, '', suffix).astype(object),
+        'order_id': order_ids,
+        'service_date': service_dates,
+        'has_service_date': has_date,
+    })
+
+def _assemble_lines(parts, customers, invoice_numbers, invoice_date):
+    """
+    Build the QBO columns from line parts, customers, invoice numbers and the invoice date
+    
+    Columns that repeat a few values (customers, dates, the item) are
+    categorical, so each distinct string is held once rather than once per line.
+    """
+    invoice_date_str = invoice_date.strftime('%d/%m/%Y')
+    due_date_str = (invoice_date + timedelta(days=4)).strftime('%d/%m/%Y')
+    
+    qbo_df = pd.DataFrame({
+        '*InvoiceNo': invoice_numbers,
+        '*Customer': _categorical(customers),
+        '*InvoiceDate': _constant(invoice_date_str, len(parts)),
+        '*DueDate': _constant(due_date_str, len(parts)),
+        'Item(Product/Service)': _constant('Linhas de Lavanderia:Services', len(parts)),
+        'ItemDescription': _descriptions(parts, invoice_numbers),
+        'ItemQuantity': np.ones(len(parts), dtype='int8'),
+        '*ItemAmount': parts['amount'].to_numpy(),
+        'Service Date': _categorical(np.where(parts['has_service_date'].to_numpy(),
+                                              parts['service_date'].to_numpy(), invoice_date_str).astype(object)),
+        ORDER_ID: parts['order_id'].to_numpy(),
+    })
+    return qbo_df
+
+def _categorical(values):
+    """
+    Store a column once per distinct value, with '' among the categories for blanking
+    
+    Categories keep the values' own types (e.g. numeric customer names), so
+    the CSV output is the same as for a plain object column.
+    """
+    if not isinstance(values, pd.Categorical):
+        codes, uniques = pd.factorize(values)
+        values = pd.Categorical.from_codes(codes, categories=uniques)
+    if '' not in values.categories:
+        values = values.add_categories([''])
+    return values
+
+def _constant(value, length):
+    """A categorical column holding the same value on every line"""
+    return pd.Categorical.from_codes(np.zeros(length, dtype='int8'), categories=[value, ''])
+
+def blank_repeated_invoice_fields(qbo_df, repeated=None):
+    """
+    Clear *Customer, *InvoiceDate and *DueDate on every line of an invoice but the first
+    
+    QuickBooks only reads these fields from the first line of each invoice.
+    Repeated lines are found in a single pass with duplicated(), so the cost
+    grows with the number of rows rather than rows times invoices.
+    
+    Args:
+        qbo_df (pd.DataFrame): QBO frame, modified in place
+        repeated (np.ndarray): Optional mask of lines to clear, for callers that
+            know about invoice lines outside this frame
         
-        return qbo_df
+    Returns:
+        pd.DataFrame: The same frame
+    """
+    if repeated is None:
+        repeated = qbo_df['*InvoiceNo'].duplicated().to_numpy()
+    if repeated.any():
+        for col in ['*Customer', '*InvoiceDate', '*DueDate']:
+            column = qbo_df[col]
+            if isinstance(column.dtype, pd.CategoricalDtype) and '' not in column.cat.categories:
+                column = column.cat.add_categories([''])
+            qbo_df[col] = column.mask(repeated, '')
+    return qbo_df
+
+def _as_row_values(df):
+    """
+    Give the columns the types the values had when the report was read row by row
     
-    except Exception as e:
-        print(f"Error in transform_data: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise ValueError(f"Error transforming data: {str(e)}")
+    Rows taken from a frame whose columns are all numeric are upcast to a single
+    numeric type, so an integer ID column is then seen as floats.
+    """
+    dtypes = df.dtypes.tolist()
+    if all(pd.api.types.is_numeric_dtype(t) and not pd.api.types.is_bool_dtype(t) for t in dtypes):
+        common = np.result_type(*dtypes)
+        if any(t != common for t in dtypes):
+            return df.astype(common)
+    return df
+
+def _map_values(values, func):
+    """
+    Apply a scalar function to an object column, calling it once per distinct value
+    
+    Values are keyed on type as well as value so that e.g. 1, 1.0 and True,
+    which compare equal, are still converted separately.
+    
+    Returns:
+        np.ndarray: Object array with func applied to every value
+    """
+    cache = {}
+    result = []
+    append = result.append
+    for value in values:
+        try:
+            key = (type(value), value)
+            converted = cache.get(key, _MISSING)
+            if converted is _MISSING:
+                converted = cache[key] = func(value)
+        except TypeError:
+            # Unhashable value
+            converted = func(value)
+        append(converted)
+    converted_values = np.empty(len(result), dtype=object)
+    converted_values[:] = result
+    return converted_values
+
+_MISSING = object()
 
-def save_to_csv(df, output_path):
+def _price_value(value):
+    """Convert a single price cell, extracting the numeric part when needed"""
+    try:
+        return float(value)
+    except:
+        # Try to extract numeric part
+        price_str = str(value)
+        price_str = ''.join(c for c in price_str if c.isdigit() or c == '.' or c == ',')
+        price_str = price_str.replace(',', '.')
+        try:
+            return float(price_str)
+        except:
+            return 0
+
+def _coerce_prices(prices):
+    """
+    Convert the price column to numbers
+    
+    Numeric columns are cast in one step; text columns only go through the
+    character-filter fallback once per distinct value. Prices that could not
+    be read at all become 0.
+    
+    Returns:
+        np.ndarray: float64 amounts, or int64 zeros if no price could be read
+    """
+    if pd.api.types.is_numeric_dtype(prices.dtype):
+        return prices.to_numpy(dtype='float64')
+    
+    converted = _map_values(prices.astype(object), _price_value)
+    unreadable = np.fromiter((type(v) is int for v in converted), dtype=bool, count=len(converted))
+    if unreadable.all():
+        return np.zeros(len(converted), dtype='int64')
+    return converted.astype('float64')
+
+def _text_values(values):
+    """Format a column the way an f-string formats each cell"""
+    return np.asarray(values.astype(object).map(str), dtype=object)
+
+def _present(df, col):
+    """Mask of rows where an optional column has a non-empty value"""
+    if not col or col not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+    values = df[col]
+    return (values.notna() & (values != '')).to_numpy()
+
+def _description_parts(df, id_col, house_col, note_col):
+    """
+    Build the parts of the ItemDescription column: "<house>, / order id: <id> / Notes: <note>"
+    
+    Returns:
+        tuple: (prefix up to "order id: ", order IDs ('' where missing), mask of
+        rows with an order ID, suffix with the note or '')
+    """
+    prefix = np.full(len(df), '', dtype=object)
+    
+    # Add house/address if available
+    has_house = _present(df, house_col)
+    if has_house.any():
+        prefix[has_house] = _text_values(df[house_col][has_house]) + ', '
+    prefix = prefix + '/ order id: '
+    
+    # Add order ID; the invoice number is used where it is missing (see _descriptions)
+    order_ids = np.full(len(df), '', dtype=object)
+    has_id = _present(df, id_col)
+    if has_id.any():
+        order_ids[has_id] = _text_values(df[id_col][has_id])
+    
+    # Add note if available
+    suffix = np.full(len(df), '', dtype=object)
+    has_note = _present(df, note_col)
+    if has_note.any():
+        suffix[has_note] = ' / Notes: ' + _text_values(df[note_col][has_note])
+    
+    return prefix, order_ids, has_id, suffix
+
+def _descriptions(parts, invoice_numbers):
+    """Complete the descriptions, using the row's invoice number where the order ID is missing"""
+    has_id = parts['has_order_id'].to_numpy()
+    if has_id.all():
+        return parts['description'].to_numpy(dtype=object)
+    descriptions = parts['description'].to_numpy(dtype=object, copy=True)
+    missing = ~has_id
+    numbers, positions = np.unique(invoice_numbers[missing], return_inverse=True)
+    order_ids = np.array([str(n) for n in numbers], dtype=object)[positions]
+    descriptions[missing] = (parts['desc_prefix'].to_numpy(dtype=object)[missing] + order_ids
+                             + parts['desc_suffix'].to_numpy(dtype=object)[missing])
+    return descriptions
+
+def _service_dates(df, date_col):
+    """
+    Format the service date of every row as dd/mm/yyyy
+    
+    Dates are parsed once per distinct value. Rows without a readable date
+    get '' and use the invoice date (see _assemble_lines).
+    
+    Returns:
+        tuple: (formatted dates, mask of rows with a readable date)
+    """
+    service_dates = np.full(len(df), '', dtype=object)
+    readable = np.zeros(len(df), dtype=bool)
+    if not date_col or date_col not in df.columns:
+        return service_dates, readable
+    
+    dates = df[date_col]
+    has_date = dates.notna().to_numpy()
+    if not has_date.any():
+        return service_dates, readable
+    dates = dates[has_date]
+    
+    if pd.api.types.is_datetime64_any_dtype(dates.dtype):
+        # Reports cover a few weeks, so format each distinct day only once
+        codes, uniques = pd.factorize(dates)
+        formatted = np.asarray(uniques.strftime('%d/%m/%Y'), dtype=object)
+        service_dates[has_date] = formatted[codes]
+        return service_dates, has_date
+    
+    def format_date(value):
+        try:
+            return pd.to_datetime(value).strftime('%d/%m/%Y')
+        except:
+            return ''
+    
+    service_dates[has_date] = _map_values(dates.astype(object), format_date)
+    return service_dates, service_dates != ''
+
+
+def qbo_columns(df):
+    """The columns of a transformed frame that go into the QBO CSV"""
+    return [col for col in df.columns if col != ORDER_ID]
+
+def save_to_csv(df, output_path, header=True):
     """
     Save the transformed dataframe to a CSV file
     
+    The lines' order IDs are recorded as exported when an order history is
+    configured (see order_history).
+    
     Args:
         df (pd.DataFrame): Transformed dataframe
-        output_path (str): Path to save the CSV file
+        output_path (str or file): Path to save the CSV file, or an open text file
+            (opened with encoding='utf-8-sig' and newline='') to append to
+        header (bool): Write the column names first
         
     Returns:
         str: Path to the saved CSV file
     """
     try:
-        df.to_csv(output_path, index=False, encoding='utf-8-sig')
+        with metrics.timed('serialize'):
+            df.to_csv(output_path, index=False, encoding='utf-8-sig', header=header, columns=qbo_columns(df))
+        order_history.record_export(df)
         return output_path
     except Exception as e:
         raise Exception(f"Error saving CSV: {str(e)}")
 
+def iter_csv(frames):
+    """
+    Write transformed frames (e.g. consecutive slices of one frame) as one CSV, piece by piece
+    
+    The pieces joined are the bytes save_to_csv writes for the frames put
+    together; only one frame's text is held at a time. Each frame's order IDs
+    are recorded as exported before its piece is yielded.
+    
+    Args:
+        frames (iterable): Transformed dataframes with the same columns
+    
+    Yields:
+        bytes: The CSV of each frame, the first with the byte order mark and header
+    """
+    first = True
+    for df in frames:
+        with metrics.timed('serialize'):
+            text = df.to_csv(index=False, header=first, columns=qbo_columns(df))
+        order_history.record_export(df)
+        yield (('\ufeff' + text) if first else text).encode('utf-8')
+        first = False
+
 def get_unique_customers(file_path):
     """
     Extract unique customer names from the input file
     
+    The customers are taken from the prepared invoice lines, so the filter
+    rules (see prefilter) run once per upload and the confirm page lists
+    exactly the customers that get invoices.
+    
     Args:
         file_path (str): Path to the Excel or CSV file
         
@@ -302,82 +603,16 @@ def get_unique_customers(file_path):
         list: List of unique customer names
     """
     try:
-        # Determine file type based on extension
-        file_extension = file_path.lower().split('.')[-1] if '.' in file_path else ''
-        
-        # Read the file based on its extension
-        if file_extension == 'csv':
-            print("Reading CSV file for customer extraction...")
-            df = pd.read_csv(file_path)
-        else:
-            # Try multiple Excel reading engines if it's an Excel file
-            try:
-                print("Attempting to read Excel file with default engine for customer extraction...")
-                df = pd.read_excel(file_path)
-            except Exception as e1:
-                print(f"Error with default engine: {str(e1)}")
-                try:
-                    print("Trying with engine='openpyxl'...")
-                    df = pd.read_excel(file_path, engine='openpyxl')
-                except Exception as e2:
-                    print(f"Error with openpyxl engine: {str(e2)}")
-                    try:
-                        print("Trying with engine='xlrd'...")
-                        df = pd.read_excel(file_path, engine='xlrd')
-                    except Exception as e3:
-                        print(f"Error with xlrd engine: {str(e3)}")
-                        # If Excel reading fails completely, try CSV as last resort
-                        try:
-                            print("Trying to read as CSV...")
-                            df = pd.read_csv(file_path)
-                        except Exception as e4:
-                            print(f"Error reading as CSV: {str(e4)}")
-                            print(f"Could not read file with any available method. Returning empty customer list.")
-                            return []
+        prepared = load_prepared_lines(file_path)
         
-        # Log the column names to help with debugging
-        print(f"Columns in file: {df.columns.tolist()}")
-        
-        # Check if 'Name' column exists - try case-insensitive match if not
-        if 'Name' not in df.columns:
-            # Try to find a column that might contain customer names
-            name_cols = [col for col in df.columns if 'name' in col.lower()]
-            if name_cols:
-                name_col = name_cols[0]
-                print(f"Using '{name_col}' as the customer name column")
-            else:
-                # If can't find a name column, check if the first column might contain names
-                if len(df.columns) > 0:
-                    if len(df.columns) > 1:
-                        name_col = df.columns[1]  # Often the second column is for names
-                    else:
-                        name_col = df.columns[0]  # Use first column as fallback
-                    print(f"Using column '{name_col}' as a fallback for customer names")
-                else:
-                    raise ValueError("Could not identify a suitable customer name column")
-        else:
-            name_col = 'Name'
-        
-        # Filter out rows with missing names or total rows
-        df = df.dropna(subset=[name_col])
-        df = df[df[name_col] != '']
-        
-        # Filter rows by Status if the column exists
-        if 'Status' in df.columns:
-            valid_statuses = ['Delivery', 'Production', 'Open']
-            df = df[df['Status'].isin(valid_statuses)]
-            print(f"Filtered to {len(df)} rows with status in {valid_statuses}")
-        else:
-            print("No 'Status' column found, not filtering by status")
-        
-        # Get unique customer names
-        unique_customers = df[name_col].unique().tolist()
-        print(f"Found {len(unique_customers)} unique customers")
+        # Customer codes follow first-seen order, so the first line of each code names it
+        unique_customers = prepared['customer'][~prepared['customer_code'].duplicated()].tolist()
+        logger.debug("Found %d unique customers", len(unique_customers))
         
         return unique_customers
     
     except Exception as e:
-        print(f"Error in get_unique_customers: {str(e)}")
+        logger.error("Error in get_unique_customers: %s", e)
         # Return an empty list as a fallback to allow the app to continue
         return []
 
@@ -402,48 +637,18 @@ def validate_file(file_path):
     
     # Try to read the file
     try:
-        if file_extension == 'csv':
-            print("Reading CSV file...")
-            df = pd.read_csv(file_path)
-        else:
-            # Try multiple Excel reading engines if it's an Excel file
-            try:
-                print("Attempting to read Excel file with default engine...")
-                df = pd.read_excel(file_path)
-            except Exception as e1:
-                print(f"Error with default engine: {str(e1)}")
-                try:
-                    print("Trying with engine='openpyxl'...")
-                    df = pd.read_excel(file_path, engine='openpyxl')
-                except Exception as e2:
-                    print(f"Error with openpyxl engine: {str(e2)}")
-                    try:
-                        print("Trying with engine='xlrd'...")
-                        df = pd.read_excel(file_path, engine='xlrd')
-                    except Exception as e3:
-                        print(f"Error with xlrd engine: {str(e3)}")
-                        # If CSV with xlsx extension, try reading as CSV
-                        try:
-                            print("Trying to read as CSV...")
-                            df = pd.read_csv(file_path)
-                        except Exception as e4:
-                            print(f"Error reading as CSV: {str(e4)}")
-                            raise ValueError(f"Could not read file with any available method. Last error: {str(e3)}")
-        
-        print(f"File loaded successfully with {len(df)} rows and columns: {df.columns.tolist()}")
+        df = load_dataset(file_path)
         
-        # Check for minimum required columns for functionality
-        required_columns = ['Name', 'Price']
+        logger.debug("File loaded successfully with %d rows and columns: %s", len(df), list(df.columns))
         
-        # Look for variations of required column names
-        name_columns = [col for col in df.columns if 'name' in col.lower()]
-        price_columns = [col for col in df.columns if any(x in col.lower() for x in ['price', 'amount', 'value', 'cost'])]
+        # Check for minimum required columns, using the same detection as transform_data
+        profile = detect_columns(source_columns(df))
         
-        if not name_columns:
-            print("Warning: No 'Name' column found. Looking for a suitable column to use as customer name.")
+        if not profile['name']:
+            logger.warning("No 'Name' column found. Looking for a suitable column to use as customer name.")
             # We'll handle this in get_unique_customers
         
-        if not price_columns:
+        if not profile['price']:
             raise ValueError("No column found for price/amount information. This is required for invoicing.")
             
         return True